@@ -27,6 +27,7 @@ class Permissions(Enum):
     set_owner = 10
     set_voice = 5
     start_game = 5
+    view_latency = 5
 
 class Ability(object):
     """
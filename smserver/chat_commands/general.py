@@ -174,7 +174,7 @@ class AddFriend(ChatPlugin):
                     return
                 friendship.state = 1
                 serv.send_message("Accepted friend request from %s" % with_color(message), to="me")
-            serv.session.commit()
+            serv.session.flush()
 
 
 class Ignore(ChatPlugin):
@@ -217,7 +217,7 @@ class Ignore(ChatPlugin):
                 friendship.user1_id = user.id
                 friendship.user2_id = newignore.id
                 serv.send_message("%s ignored" % with_color(message), to="me")
-            serv.session.commit()
+            serv.session.flush()
 
 
 
@@ -236,7 +236,7 @@ class Unignore(ChatPlugin):
             friendship = serv.session.query(models.Friendship).filter_by(user1_id = user.id).filter_by(user2_id = newignore.id).filter_by(state = 2).first()
             if friendship:
                 serv.session.delete(friendship)
-                serv.session.commit()
+                serv.session.flush()
                 serv.send_message("%s unignored" % with_color(message), to="me")
                 return
             serv.send_message("%s is not currently ignored. Cant unignore" % with_color(message), to="me")
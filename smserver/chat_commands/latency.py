@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+
+from smserver import models, ability
+from smserver.chathelper import with_color
+from smserver.chatplugin import ChatPlugin
+
+
+class ChatLatency(ChatPlugin):
+    command = "latency"
+    helper = "Show the ping of the players of the room, or of a user. /latency [user]"
+    permission = ability.Permissions.view_latency
+
+    def __call__(self, serv, message):
+        if message:
+            user = serv.session.query(models.User).filter_by(name=message, online=True).first()
+            if not user:
+                serv.send_message("Could not find %s online" % with_color(message), to="me")
+                return
+
+            conn = serv.server.find_connection(user.connection_token)
+            if not conn:
+                serv.send_message("%s is not connected to this server process" % with_color(message), to="me")
+                return
+
+            connections = [conn]
+        elif serv.conn.room:
+            connections = serv.server.room_connections(serv.conn.room)
+        else:
+            connections = serv.server.connections
+
+        for conn in connections:
+            users = models.User.online_from_ids(conn.users, serv.session)
+            serv.send_message(
+                "%s: %s" % (
+                    ", ".join(user.fullname_colored(serv.conn.room) for user in users) or conn.ip,
+                    conn.latency),
+                to="me")
@@ -22,7 +22,7 @@ class ChatMaxUsers(ChatPlugin):
             return
 
         serv.room.max_users = value
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message("Room max_users set to: %s" % message)
 
 
@@ -34,7 +34,7 @@ class ChatMOTD(ChatPlugin):
 
     def __call__(self, serv, message):
         serv.room.motd = message
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message("Room MOTD set to: %s" % message)
 
 
@@ -46,7 +46,7 @@ class ChatDescription(ChatPlugin):
 
     def __call__(self, serv, message):
         serv.room.description = message
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message("Room description set to: %s" % message)
 
 
@@ -64,7 +64,7 @@ class ChatRoomHidden(ChatPlugin):
             serv.room.hidden = True
             msg = "The room is no more visible"
 
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message(msg)
 
 
@@ -82,7 +82,7 @@ class ChatRoomFree(ChatPlugin):
             serv.room.free = True
             msg = "This room is now free"
 
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message(msg)
 
 
@@ -100,7 +100,7 @@ class ChatRoomReqSong(ChatPlugin):
             serv.room.reqsong = True
             msg = "This room now requires all players to have the song"
 
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message(msg)
 
 
@@ -118,7 +118,7 @@ class ChatRoomShowPoints(ChatPlugin):
             serv.room.show_points = True
             msg = "This room now shows each score's MIGS points"
 
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message(msg)
 
 
@@ -136,7 +136,7 @@ class ChatRoomShowBests(ChatPlugin):
             serv.room.show_bests = True
             msg = "This room now shows best scores on song select"
 
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message(msg)
 
 
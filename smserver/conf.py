@@ -44,6 +44,12 @@ class Conf(dict):
                         help="Port to listen to (default: 8765)",
                         default=8765)
 
+    parser.add_argument('--workers', '--server.workers',
+                        dest='server.workers',
+                        type=int,
+                        help="Number of worker processes, sharing the same ports (default: 1)",
+                        default=1)
+
     parser.add_argument('-users', '--server.max_users',
                         dest='server.max_users',
                         type=int,
@@ -28,7 +28,7 @@ class CreateRoomController(StepmaniaController):
             status=1,
         )
         self.session.add(room)
-        self.session.commit()
+        self.session.flush()
 
         self.log.info("New room %s created by player %s" % (room.name, self.conn.ip))
 
@@ -42,10 +42,8 @@ class CreateRoomController(StepmaniaController):
             self.log.info("Player %s enter in room %s" % (user.name, room.name))
 
         roomspacket = models.Room.smo_list(self.session, self.active_users)
-        for conn in self.server.connections:
-            if conn.room == None:
-                conn.send(roomspacket)
-                self.server.send_user_list_lobby(conn, self.session)
+        self.server.sendlobby(roomspacket)
+        self.server.send_user_list_lobby(None, self.session)
         self.send(smpacket.SMPacketServerNSSMONL(
             packet=room.to_packet()
         ))
@@ -3,16 +3,13 @@
 
 from smserver.smutils import smpacket
 from smserver.stepmania_controller import StepmaniaController
-from smserver import models
 
 class DiscoveryController(StepmaniaController):
     command = smpacket.SMClientCommand.NSCFormatted
     require_login = False
+    require_session = False
 
     def handle(self):
-        self.send(smpacket.SMPacketServerNSCFormatted(
-            server_port=self.server.config.server["port"],
-            server_name=self.server.config.server["name"],
-            nb_players=models.User.nb_onlines(self.session)
-        ))
+        packet, cache = self.server.discovery_packet()
+        self.conn.send(packet, cache)
 
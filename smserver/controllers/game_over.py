@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import datetime
-
 from smserver.smutils import smpacket
 from smserver.stepmania_controller import StepmaniaController
 from smserver import models
@@ -24,7 +22,7 @@ class GameOverController(StepmaniaController):
         if "start_at" not in self.conn.songstats:
             return
 
-        song_duration = datetime.datetime.now() - self.conn.songstats["start_at"]
+        song_duration = self.conn.song_time()
 
         for user in self.active_users:
             if self.conn.songstats["filehash"]:
@@ -81,7 +79,7 @@ class GameOverController(StepmaniaController):
             xp = songstat.calc_xp(self.server.config.score.get("xpWeight"), self.conn.songstats[user.pos]["extranotes"])
             user.xp += xp
 
-            self.session.commit()
+            self.session.flush()
             self.send_message( 
                 (songstat.pretty_result(room_id=self.room.id,
                 color=True, date=False, toasty=True, points=self.room.show_points, userfirst=True) + 
@@ -100,6 +98,8 @@ class GameOverController(StepmaniaController):
             self.conn.songstats = {0: {"data": []}, 1: {"data": []}}
             self.conn.song = None
 
+        self.server.check_end_game(self.room)
+
     def create_stats(self, user, raw_stats, duration, filehash, ssr, simfile_id, chart_id):
         songstat = models.SongStat(
             song_id=self.room.active_song.id,
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import datetime
+import time
 
 from smserver.smutils import smpacket
 from smserver.stepmania_controller import StepmaniaController
@@ -30,6 +30,9 @@ class StartGameRequestController(StepmaniaController):
             self.packet["song_artist"],
             self.session)
 
+        # Kept with the stats, so the score updates don't query the database
+        names = dict((user.pos, user.name) for user in self.active_users)
+
         with self.conn.mutex:
             self.conn.song_id = song.id
             self.conn.songs[song.id] = True
@@ -40,6 +43,7 @@ class StartGameRequestController(StepmaniaController):
                     "difficulty": self.packet["first_player_difficulty"],
                     "options": self.packet["first_player_options"],
                     "best_score": song.best_score_value(self.packet["first_player_feet"]),
+                    "player_name": names.get(0),
                     "chartkey": self.packet["first_player_chartkey"],
                     "rate": self.packet["rate"],
                     "offsetacum": 0,
@@ -59,6 +63,7 @@ class StartGameRequestController(StepmaniaController):
                     "difficulty": self.packet["second_player_difficulty"],
                     "options": self.packet["second_player_options"],
                     "best_score": song.best_score_value(self.packet["second_player_feet"]),
+                    "player_name": names.get(1),
                     "chartkey": self.packet["second_player_chartkey"],
                     "rate": self.packet["rate"],
                     "offsetacum": 0,
@@ -74,16 +79,15 @@ class StartGameRequestController(StepmaniaController):
                     "extranotes": []
                    },
                 "filehash": self.packet["filehash"],
-                "start_at": datetime.datetime.now(),
+                "start_at": time.monotonic(),
                 "options": self.packet["song_options"],
                 "course_title": self.packet["course_title"]
                 }
             self.conn.wait_start = True
-        for player in self.server.player_connections(self.room.id):
-            with player.mutex:
-                if player.wait_start is False:
-                    self.log.debug("Room %s waiting for other player to start the game" % self.room.name)
-                    return
+
+        if not self.server.ready_to_start(self.room, self.conn):
+            self.log.debug("Room %s waiting for other player to start the game" % self.room.name)
+            return
 
         self.launch_song(self.room, song, self.server)
 
@@ -94,12 +98,16 @@ class StartGameRequestController(StepmaniaController):
         server.log.info("Room %s start a new song %s" % (room.name, song.fullname))
         server.send_user_list(room)
 
-        for player in server.ingame_connections(room.id):
+        # The closest players get the start later, so everyone receives it
+        # at the same time.
+        packet = smpacket.SMPacketServerNSCGSR()
+        cache = {}
+        for player, delay, start_at in server.release_schedule(server.ingame_connections(room.id)):
             with player.mutex:
-                player.songstats["start_at"] = datetime.datetime.now()
+                player.songstats["start_at"] = start_at
                 player.wait_start = False
                 player.ingame = True
                 player.dp = 0
 
-            player.send(smpacket.SMPacketServerNSCGSR())
+            server.send_later(delay, player, packet, cache)
 
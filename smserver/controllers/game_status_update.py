@@ -1,8 +1,6 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-import datetime
-
 from smserver import models
 from smserver.smutils import smpacket
 from smserver.models import song_stat
@@ -12,6 +10,7 @@ from smserver.chathelper import with_color
 class GameStatusUpdateController(StepmaniaController):
     command = smpacket.SMClientCommand.NSCGSU
     require_login = False
+    require_session = False
 
     def handle(self):
         if not self.conn.room:
@@ -19,7 +18,7 @@ class GameStatusUpdateController(StepmaniaController):
 
         if "start_at" not in self.conn.songstats:
             return
-        stats = {"time": datetime.datetime.now() - self.conn.songstats.get("start_at"),
+        stats = {"time": self.conn.song_time(),
                  "stepid": self.packet["step_id"],
                  "grade": self.packet["grade"],
                  "score": self.packet["score"],
@@ -84,10 +83,12 @@ class GameStatusUpdateController(StepmaniaController):
                 self.conn.songstats[pid]["toasties"] += 1
 
     def beat_best_score(self):
-        user = [user for user in self.users if user.pos == self.packet["player_id"]][0]
+        name = self.conn.songstats[self.packet["player_id"]].get("player_name")
+        if not name:
+            return
 
         message = "%s just beat the best score on %s(%s)" % (
-            user.name,
+            name,
             models.SongStat.DIFFICULTIES.get(self.conn.songstats[self.packet["player_id"]]["difficulty"]),
             self.conn.songstats[self.packet["player_id"]]["feet"]
         )
@@ -8,6 +8,7 @@ from smserver.stepmania_controller import StepmaniaController
 class HelloController(StepmaniaController):
     command = smpacket.SMClientCommand.NSCHello
     require_login = False
+    require_session = False
 
     def handle(self):
         self.conn.stepmania_version = self.packet["version"]
@@ -85,7 +85,7 @@ class LoginController(StepmaniaController):
         if user.id not in self.conn.users:
             self.conn.users.append(user.id)
 
-        self.session.commit()
+        self.session.flush()
 
         self.server.enter_room(self.room, self.conn.token)
 
@@ -97,7 +97,7 @@ class LoginController(StepmaniaController):
         ))
 
         self.send(models.Room.smo_list(self.session, self.active_users))
-        self.server.send_sd_running_status()
+        self.server.send_sd_running_status(self.session)
         friends = self.session.query(models.Friendship).filter_by(state = 1).filter((models.Friendship.user1_id == user.id) | (models.Friendship.user2_id == user.id)).all()
         for friend in friends:
             if friend.user1_id == user.id:
@@ -105,7 +105,7 @@ class LoginController(StepmaniaController):
             else:
                 friendid = friend.user1_id
             friendconn = self.server.find_connection(friendid)
-            self.server.send_friend_list(friendid, friendconn)
+            self.server.send_friend_list(friendid, friendconn, self.session)
             frienduser = self.session.query(models.User).filter_by(id = friendid).first()
             if frienduser.online == True and frienduser.friend_notifications == True and friendconn:
 
@@ -116,7 +116,7 @@ class LoginController(StepmaniaController):
                 self.send_message(
                     "Your friend %s is online" % with_color(frienduser.name),
                     self.conn)
-        self.server.send_friend_list(user.id, self.conn)
+        self.server.send_friend_list(user.id, self.conn, self.session)
         
     def _send_server_resume(self, nb_onlines, max_users):
         self.send_message(self.server.config.server.get("motd", ""), to="me")
@@ -58,24 +58,13 @@ class RequestStartGameController(StepmaniaController):
         self.conn.song = song.id
         self.conn.songs[song.id] = True
 
-        hashpacket = smpacket.SMPacketServerNSCRSG(
+        self.sendplayers(self.room.id, smpacket.SMPacketServerNSCRSG(
                 usage=1,
                 song_title=song.title,
                 song_subtitle=song.subtitle,
                 song_artist=song.artist,
                 song_hash=self.packet["song_hash"]
-                )
-        nonhashpacket = smpacket.SMPacketServerNSCRSG(
-                usage=1,
-                song_title=song.title,
-                song_subtitle=song.subtitle,
-                song_artist=song.artist
-                )
-        for conn in self.server.player_connections(self.room.id):
-            if conn.stepmania_version < 4:
-                conn.send(nonhashpacket)
-            else:
-                conn.send(hashpacket)
+                ))
 
     def check_song_presence(self, song):
         with self.conn.mutex:
@@ -122,35 +111,23 @@ class RequestStartGameController(StepmaniaController):
         game = models.Game(room_id=self.room.id, song_id=song.id)
 
         self.session.add(game)
-        self.session.commit()
+        self.session.flush()
 
         self.send_message("%s started the song %s" % (self.colored_user_repr(self.room.id), with_color(song.fullname)) )
 
         self.room.status = 2
         self.room.active_song = song
         self.room.active_song_hash = self.packet["song_hash"]
+        self.server.open_start_barrier(self.room, song)
 
-        hashpacket = smpacket.SMPacketServerNSCRSG(
+        self.sendplayers(self.room.id, smpacket.SMPacketServerNSCRSG(
                 usage=2,
                 song_title=song.title,
                 song_subtitle=song.subtitle,
                 song_artist=song.artist,
                 song_hash=self.packet["song_hash"]
-                )
-        nonhashpacket = smpacket.SMPacketServerNSCRSG(
-                usage=2,
-                song_title=song.title,
-                song_subtitle=song.subtitle,
-                song_artist=song.artist
-                )
-        for conn in self.server.player_connections(self.room.id):
-            if conn.stepmania_version < 4:
-                conn.send(nonhashpacket)
-            else:
-                conn.send(hashpacket)
+                ))
         
         roomspacket = models.Room.smo_list(self.session, self.active_users)
-        for conn in self.server.connections:
-            if conn.room == None:
-                conn.send(roomspacket)
-                self.server.send_user_list_lobby(conn, self.session)
+        self.server.sendlobby(roomspacket)
+        self.server.send_user_list_lobby(None, self.session)
@@ -9,7 +9,7 @@ class SMOController(StepmaniaController):
     require_login = False
 
     def handle(self):
-        if not self.packet["packet"]:
+        if self.packet["packet"] is None:
             return None
 
         self.server.handle_packet(self.session, self.conn, self.packet["packet"])
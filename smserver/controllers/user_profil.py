@@ -19,7 +19,7 @@ class UserProfilController(StepmaniaController):
 
             self.reconnect_user(user)
 
-        self.server.send_sd_running_status()
+        self.server.send_sd_running_status(self.session)
 
         if self.conn.room:
             self.server.send_user_list(self.room)
@@ -29,7 +29,7 @@ class UserProfilController(StepmaniaController):
             return
 
         user.online = True
-        self.session.commit()
+        self.session.flush()
         self.server.enter_room(self.room, self.conn.token)
         self.log.info("User %s connected" % user.name)
 
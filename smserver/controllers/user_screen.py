@@ -28,10 +28,8 @@ class UserStatusController(StepmaniaController):
                         self.session.delete(room)
                         self.conn.room = None
             roomspacket = models.Room.smo_list(self.session, self.active_users)
-            for conn in self.server.connections:
-                if conn.room == None:
-                    conn.send(roomspacket)
-                    self.server.send_user_list_lobby(conn, self.session)
+            self.server.sendlobby(roomspacket)
+            self.server.send_user_list_lobby(None, self.session)
 
         if not self.conn.spectate:
             for user in self.active_users:
@@ -8,6 +8,51 @@ from sqlalchemy.orm import sessionmaker
 
 from smserver.models import schema
 
+class LazySession(object):
+    """
+        Proxy of a SQLAlchemy session, only created on its first use.
+
+        Commit, rollback and close do nothing if the session has not been
+        used.
+
+        :param factory: Callable returning a new session
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._session = None
+
+    @property
+    def started(self):
+        """ True once the session has been created """
+
+        return self._session is not None
+
+    def __getattr__(self, name):
+        if self._session is None:
+            self._session = self._factory()
+
+        return getattr(self._session, name)
+
+    def commit(self):
+        """ Commit the session if used """
+
+        if self._session is not None:
+            self._session.commit()
+
+    def rollback(self):
+        """ Rollback the session if used """
+
+        if self._session is not None:
+            self._session.rollback()
+
+    def close(self):
+        """ Close the session if used """
+
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
 class DataBase(object):
     """
         The DataBase class hold information about a given database.
@@ -73,6 +118,23 @@ class DataBase(object):
         finally:
             session.close()
 
+    @contextmanager
+    def lazy_session_scope(self):
+        """
+            Same as session_scope, but the session is only created if used
+            (see :class:`LazySession`).
+        """
+
+        session = LazySession(lambda: self.session())
+        try:
+            yield session
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
     @property
     def _database_url(self):
         """
@@ -45,7 +45,7 @@ class Ban(schema.Base):
         if fixed:
             ban.fixed = fixed
 
-        session.commit()
+        session.flush()
         return ban
 
     @classmethod
@@ -73,7 +73,7 @@ class Ban(schema.Base):
             return False
 
         session.delete(ban)
-        session.commit()
+        session.flush()
         return True
 
     @classmethod
@@ -31,7 +31,7 @@ class Chart(schema.Base):
         if not chart:
             chart = cls(chartkey=chartkey, simfile_id=simfile_id)
             session.add(chart)
-            session.commit()
+            session.flush()
 
         return chart
 
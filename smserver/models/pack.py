@@ -28,7 +28,7 @@ class Pack(schema.Base):
         if not pack:
             pack = cls(name=name)
             session.add(pack)
-            session.commit()
+            session.flush()
 
         return pack
 
@@ -26,6 +26,6 @@ class PackSimfile(schema.Base):
         if not pack:
             packsong = cls(pack_id=pack_id, song_id=song_id)
             session.add(packsong)
-            session.commit()
+            session.flush()
 
         return packsong
@@ -39,5 +39,5 @@ class Privilege(schema.Base):
             session.add(priv)
 
         priv.level = level
-        session.commit()
+        session.flush()
         return priv
@@ -45,7 +45,7 @@ class RankedChart(schema.Base):
             for songstat in songstats:
                 songstat.ssr = 0
         session.delete(self)
-        session.commit()
+        session.flush()
 
     @staticmethod
     def calc_ssr(rating, dppercent):
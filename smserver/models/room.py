@@ -237,7 +237,7 @@ class Room(schema.Base):
     @classmethod
     def reset_room_status(cls, session):
         session.query(cls).update({"status": 0})
-        session.commit()
+        session.flush()
 
     @classmethod
     def init_from_hashes(cls, hrooms, session):
@@ -269,7 +269,7 @@ class Room(schema.Base):
 
             room.static = True
 
-            session.commit()
+            session.flush()
 
             for name in hroom.get("moderators", []):
                 usr = session.query(user.User).filter_by(name=name).first()
@@ -31,6 +31,6 @@ class Simfile(schema.Base):
         if not simfile:
             simfile = cls(song_id=song_id, file_hash=file_hash)
             session.add(simfile)
-            session.commit()
+            session.flush()
 
         return simfile
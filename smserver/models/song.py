@@ -71,12 +71,11 @@ class Song(schema.Base):
         return "%s (%s)" % (self.title, self.artist)
 
     @classmethod
-    def find_or_create(cls, title, subtitle, artist, session, commit=True):
+    def find_or_create(cls, title, subtitle, artist, session):
         song = session.query(cls).filter_by(title=title, artist=artist, subtitle=subtitle).first()
         if not song:
             song = cls(title=title, artist=artist, subtitle=subtitle)
             session.add(song)
-            if commit:
-                session.commit()
+            session.flush()
 
         return song
@@ -166,7 +166,7 @@ class User(schema.Base):
         session = object_session(self)
         if not room_id:
             self.rank = level
-            session.commit()
+            session.flush()
             return level
 
         priv = Privilege.find_or_update(room_id, self.id, session, level=level)
@@ -244,7 +244,7 @@ class User(schema.Base):
         user.online = True
         user.pos = pos
 
-        session.commit()
+        session.flush()
 
         return user
 
@@ -294,7 +294,7 @@ class User(schema.Base):
         user.online = False
         user.pos = None
         user.room_id = None
-        session.commit()
+        session.flush()
         return user
 
     @classmethod
@@ -307,4 +307,4 @@ class User(schema.Base):
             user.status = UserStatus.room_selection.value
             user.room_id = None
 
-        session.commit()
+        session.flush()
@@ -11,9 +11,29 @@ except ImportError:
     pass
 
 class StepmaniaPlugin(object):
+    require_session = True
+    """
+        Specify if the plugin use the database. Without it, the hooks get no
+        session (None).
+    """
+
     def __init__(self, server):
         self.server = server
 
+    def handles(self, command):
+        """ Return True if the plugin define a hook for this command """
+
+        name = "on_%s" % command.name.lower()
+        func = getattr(type(self), name, None)
+        if func is None:
+            return False
+
+        # Dispatch the SMO packets to their own hooks
+        if name == "on_nssmonl":
+            return True
+
+        return func is not getattr(StepmaniaPlugin, name, None)
+
     def on_packet(self, session, serv, packet):
         pass
 
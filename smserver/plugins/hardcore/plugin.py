@@ -34,7 +34,7 @@ class HardcoreChatPlugin(chatplugin.ChatPlugin):
             serv.room.mode = "hardcore"
             msg = "The room is now in hardcore mode"
 
-        serv.session.commit()
+        serv.session.flush()
         serv.send_message(msg)
 
 
@@ -3,16 +3,20 @@
 
 import sys
 import datetime
+from functools import partial
+from itertools import chain
 
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import object_session
 
 from smserver.pluginmanager import PluginManager
 from smserver.authplugin import AuthPlugin
 from smserver.database import DataBase
 from smserver.watcher import StepmaniaWatcher
+from smserver.controllers.game_start_request import StartGameRequestController
 from smserver import conf, logger, models, sdnotify, __version__
 from smserver.chathelper import with_color
-from smserver.smutils import smthread, smpacket
+from smserver.smutils import smthread, smpacket, smconn
 
 def with_session(func):
     """ Wrap the function with a sqlalchemy session.
@@ -44,7 +48,7 @@ class StepmaniaServer(smthread.StepmaniaServer):
             server.StepmaniaServer(config).start()
     """
 
-    def __init__(self, config=None):
+    def __init__(self, config=None, role=None, state=None):
         """
             Take a configuration and initialize the server:
 
@@ -55,8 +59,16 @@ class StepmaniaServer(smthread.StepmaniaServer):
             * Initialize the connection handler
 
             If no configuration are passed, it will use the default one.
+
+            In multi-process mode (see :mod:`smserver.supervisor`), the
+            ``supervisor`` role initialize the database and run the global
+            tasks without listening, and each ``worker`` listen on the same
+            ports (with SO_REUSEPORT), sharing its state through the given
+            state backend.
         """
 
+        self.role = role
+
         self.sd_notify = sdnotify.SDNotify()
 
         if not config:
@@ -81,7 +93,8 @@ class StepmaniaServer(smthread.StepmaniaServer):
             driver=config.database.get("driver"),
         )
 
-        self._init_database()
+        if role != "worker":
+            self._init_database()
 
         self.log.debug("Load plugins...")
         self.sd_notify.status("Load plugins...")
@@ -94,6 +107,7 @@ class StepmaniaServer(smthread.StepmaniaServer):
 
         self.plugins = self._init_plugins()
         self.controllers = self._init_controllers()
+        self.handlers = self._init_handlers(self.controllers, self.plugins)
         self.chat_commands = self._init_chat_commands()
         self.log.debug("Plugins loaded")
 
@@ -112,18 +126,50 @@ class StepmaniaServer(smthread.StepmaniaServer):
         for server in config.additional_servers:
             servers.append((server["ip"], server["port"], server.get("type")))
 
-        smthread.StepmaniaServer.__init__(self, servers)
+        if role == "supervisor":
+            shared_loop = config.server.get("shared_loop", False)
+            fixed = [server_type for _, _, server_type in servers
+                     if not self.can_handoff(server_type, shared_loop)]
+            if fixed:
+                # The players of a room would be split between the workers
+                raise RuntimeError(
+                    "Multi-process mode is not supported by the %s servers: use the"
+                    " classic type, without shared_loop" % ", ".join(
+                        sorted(set(str(server_type) for server_type in fixed))))
+
+            servers = []
+
+        smthread.StepmaniaServer.__init__(
+            self, servers,
+            max_frame_size=config.server.get("max_frame_size"),
+            send_buffer=config.server.get("send_buffer"),
+            shared_loop=config.server.get("shared_loop", False),
+            reuse_port=role == "worker",
+            state=state,
+            handler_threads=config.server.get("handler_threads", 8),
+            max_pending_packets=config.server.get("max_pending_packets", 256),
+            idle_timeout=config.server.get("readtimeout"))
         for ip, port, server_type in servers:
             self.log.info("Server %s listening on %s:%s", server_type, ip, port)
 
         self.watcher = StepmaniaWatcher(self)
 
+        # Last game ended in each room
+        self._ended_games = {}
+        self._start_barriers = {}
+
         self.started_at = datetime.datetime.now()
 
+        self.nb_onlines = 0
+        self._discovery = None
+
     def start(self):
         """ Start all the threads """
 
-        self.watcher.start()
+        if self.loop:
+            self.watcher.schedule(self.loop)
+        else:
+            self.watcher.start()
         self.sd_notify.ready()
         self.send_sd_running_status()
 
@@ -136,8 +182,11 @@ class StepmaniaServer(smthread.StepmaniaServer):
         self.sd_notify.status("Stopping...")
 
         self.log.info("Disconnect all client...")
-        for connection in self.connections:
-            connection.close()
+        for connection in list(self.connections):
+            if self.loop:
+                smconn.call_soon(self.loop, connection.close)
+            else:
+                connection.close()
 
         self.log.info("Closing all the threads...")
 
@@ -145,10 +194,15 @@ class StepmaniaServer(smthread.StepmaniaServer):
         for server in self._servers:
             server.stop()
 
-        self.watcher.join()
+        if not self.loop:
+            self.watcher.join()
+
         for server in self._servers:
             server.join()
 
+        self.executor.shutdown()
+        self.state.stop()
+
     def reload(self):
         """ Reload configuration files """
 
@@ -160,8 +214,12 @@ class StepmaniaServer(smthread.StepmaniaServer):
         self.config.reload()
 
         self.log.info("Reload plugins")
-        self.plugins = self._init_plugins(True)
-        self.controllers = self._init_controllers(True)
+        plugins = self._init_plugins(True)
+        controllers = self._init_controllers(True)
+        handlers = self._init_handlers(controllers, plugins)
+
+        # The packets being handled keep using the previous table
+        self.plugins, self.controllers, self.handlers = plugins, controllers, handlers
         self.chat_commands = self._init_chat_commands(True)
 
         self.log.info("Plugins reloaded")
@@ -169,12 +227,22 @@ class StepmaniaServer(smthread.StepmaniaServer):
         self.send_sd_running_status()
         self.sd_notify.ready()
 
-    def send_sd_running_status(self):
-        """ Send running status to systemd """
+    def send_sd_running_status(self, session=None):
+        """
+            Send running status to systemd
 
-        with self.db.session_scope() as session:
-            nb_onlines = models.User.nb_onlines(session)
+            :param session: The session of the current packet, to count the
+                users not yet commited. Use a new session by default.
+        """
+
+        if session is None:
+            with self.db.session_scope() as session:
+                self.send_sd_running_status(session)
+            return
+
+        nb_onlines = models.User.nb_onlines(session)
 
+        self.nb_onlines = nb_onlines
         max_users = self.config.server.get("max_users", -1)
 
         self.sd_notify.status(
@@ -186,9 +254,33 @@ class StepmaniaServer(smthread.StepmaniaServer):
             )
         )
 
+    def discovery_packet(self):
+        """
+            Return the NSCFormatted packet answering the discovery requests,
+            and the cache to encode it with.
+
+            The packet is only rebuilt when the number of players change.
+        """
+
+        discovery = self._discovery
+        if discovery is None or discovery[0] != self.nb_onlines:
+            nb_onlines = self.nb_onlines
+            packet = smpacket.SMPacketServerNSCFormatted(
+                server_port=self.config.server["port"],
+                server_name=self.config.server["name"],
+                nb_players=nb_onlines
+            )
+            discovery = self._discovery = (nb_onlines, packet, {})
+
+        return discovery[1], discovery[2]
+
+    def add_connection(self, conn):
+        """ Add a new connection, checked in the handler threads """
+
+        self.execute(conn, self._accept_connection, conn)
+
     @with_session
-    def add_connection(self, session, conn):
-        """ Add a new connection """
+    def _accept_connection(self, session, conn):
         if models.Ban.is_ban(session, conn.ip):
             self.log.info("Reject connection from ban ip %s", conn.ip)
             conn.close()
@@ -201,11 +293,11 @@ class StepmaniaServer(smthread.StepmaniaServer):
         ))
 
         smthread.StepmaniaServer.add_connection(self, conn)
-        self.send_sd_running_status()
+        self.send_sd_running_status(session)
 
-    @with_session
-    def on_packet(self, session, serv, packet):
-        self.handle_packet(session, serv, packet)
+    def on_packet(self, serv, packet):
+        with self.db.lazy_session_scope() as session:
+            self.handle_packet(session, serv, packet)
 
     def handle_packet(self, session, serv, packet):
         """
@@ -213,32 +305,42 @@ class StepmaniaServer(smthread.StepmaniaServer):
 
             It will launch every controllers that fetch the packet requirement
             and try to run every plugins.
-        """
-
-        for controller in self.controllers.get(packet.command, []):
-            app = controller(self, serv, packet, session)
 
-            if app.require_login and not app.active_users:
-                self.log.info("Action forbidden %s for user %s" % (packet.command, serv.ip))
-                continue
+            The session is only given to the controllers and plugins which
+            require it, and is only created if one of them use it. All the
+            handlers share the same unit of work, commited once the packet
+            is handled: the models and handlers only flush their changes.
+        """
 
+        for handler, require_session, owner in self.handlers.get(packet.command, ()):
             try:
-                app.handle()
+                handler(session if require_session else None, serv, packet)
             except Exception as err:
-                self.log.exception("Message %s %s %s",
-                                          type(controller).__name__, controller.__module__, err)
-            session.commit()
+                self.log.exception("Message %s %s %s", owner.__name__, owner.__module__, err)
+                self._rollback_on_error(session, err)
 
-        for app in self.plugins:
-            func = getattr(app, "on_%s" % packet.command.name.lower(), None)
-            if not func:
-                continue
-            try:
-                func(session, serv, packet)
-            except Exception as err:
-                self.log.exception("Message %s %s %s",
-                                          type(app).__name__, app.__module__, err)
-            session.commit()
+    def _run_controller(self, controller, session, serv, packet):
+        """ Instantiate the controller for the packet and run it """
+
+        app = controller(self, serv, packet, session)
+
+        if app.require_login and not app.active_users:
+            self.log.info("Action forbidden %s for user %s" % (packet.command, serv.ip))
+            return
+
+        app.handle()
+
+    def _rollback_on_error(self, session, err):
+        """
+            A failed database operation leaves the unit of work unusable,
+            cancel it so the next handlers can still use the session.
+        """
+
+        if session is None or not isinstance(err, SQLAlchemyError):
+            return
+
+        self.log.error("Cancel the changes of the packet: %s", err)
+        session.rollback()
 
 
     @with_session
@@ -257,7 +359,7 @@ class StepmaniaServer(smthread.StepmaniaServer):
 
         models.Connection.remove(conn.token, session)
 
-        self.send_sd_running_status()
+        self.send_sd_running_status(session)
 
         users = models.User.online_from_ids(conn.users, session)
         if not users:
@@ -274,7 +376,7 @@ class StepmaniaServer(smthread.StepmaniaServer):
                 else:
                     friendid = friend.user1_id
                 friendconn = self.find_connection(friendid)
-                self.send_friend_list(friendid, friendconn)
+                self.send_friend_list(friendid, friendconn, session)
                 frienduser = session.query(models.User).filter_by(id = friendid).first()
                 if frienduser.online == True and frienduser.friend_notifications == True and not friendconn == None:
                     self.send_message(
@@ -289,12 +391,160 @@ class StepmaniaServer(smthread.StepmaniaServer):
             )
 
             self.send_user_list(room)
+            self.check_end_game(room)
         else:
             for conn in self.connections:
                 if conn.room == None:
                     self.send_user_list_lobby(conn, session)
 
 
+    def game_start_delay(self, room_id):
+        """
+            Time given to the players of a room to send their NSCGSR once the
+            song is selected, in seconds: the requests of the slowest player
+            arrive later.
+        """
+
+        return self.config.server.get("start_timeout", 3) + self.room_latency(room_id)
+
+    def open_start_barrier(self, room, song):
+        """
+            Wait for the players of the room to be ready to start the song.
+
+            The song starts once all the players having the song sent their
+            NSCGSR (see :meth:`ready_to_start`), or at the end of the start
+            delay for the ones ready. If no one is ready, the game ends.
+
+            The song is given explicitly: the active song id of the room is
+            only updated once flushed.
+        """
+
+        tokens = [conn.token for conn in self.player_connections(room.id)
+                  if conn.songs.get(song.id) is not False]
+
+        barrier = smthread.StartBarrier(tokens)
+        with self.mutex:
+            previous = self._start_barriers.get(room.id)
+            self._start_barriers[room.id] = barrier
+
+        # A song selected again replace the previous barrier
+        if previous is not None and previous.timer is not None:
+            previous.timer.cancel()
+
+        # The timeout query the database: run it in the handler threads
+        barrier.timer = self.watcher.call_later(
+            self.game_start_delay(room.id),
+            self.execute, ("room", room.id), self._start_timeout, room.id, barrier)
+
+    def ready_to_start(self, room, conn):
+        """
+            Record that the connection is ready to start the song of the
+            room. Return True if the song has to start now.
+        """
+
+        barrier = self._start_barriers.get(room.id)
+        if barrier is None:
+            # Song selected before a restart: wait for all the players
+            for player in self.player_connections(room.id):
+                if player.wait_start is False:
+                    return False
+
+            return True
+
+        if not barrier.arrive(conn.token):
+            return False
+
+        barrier.timer.cancel()
+        self._close_start_barrier(room.id, barrier)
+        return True
+
+    def _close_start_barrier(self, room_id, barrier):
+        with self.mutex:
+            if self._start_barriers.get(room_id) is barrier:
+                del self._start_barriers[room_id]
+
+    @with_session
+    def _start_timeout(self, session, room_id, barrier):
+        # Replaced by the barrier of another song
+        if self._start_barriers.get(room_id) is not barrier:
+            return
+
+        if not barrier.expire():
+            return
+
+        self._close_start_barrier(room_id, barrier)
+
+        room = session.query(models.Room).get(room_id)
+        if not room or room.status != 2:
+            return
+
+        if not barrier.arrived:
+            self.check_end_game(room, start_expired=True)
+            return
+
+        self.log.info("Room %s start without %s players", room.name,
+                      len(barrier.expected) - len(barrier.arrived))
+        StartGameRequestController.launch_song(room, room.active_song, self)
+
+    def send_later(self, delay, conn, packet, cache=None):
+        """ Send the packet to the connection after delay seconds """
+
+        # Below the precision of the watcher
+        if delay < 0.001:
+            conn.send(packet, cache)
+            return
+
+        self.watcher.call_later(delay, conn.send, packet, cache)
+
+    def check_end_game(self, room, start_expired=False):
+        """
+            End the game of the room once none of its players is in game.
+
+            Called when a player finish the song or leave the room, and when
+            the delay to start the song is over.
+
+            :param room: The room to check, from the session of the caller
+            :param bool start_expired: End the game even if the song has not
+                started.
+            :type room: smserver.models.room.Room
+        """
+
+        if room.status != 2:
+            return
+
+        for conn in self.player_connections(room.id):
+            if conn.ingame is True:
+                return
+
+        if not room.ingame and not start_expired:
+            return
+
+        game = room.last_game
+
+        # The last players may finish at the same time
+        with self.mutex:
+            if self._ended_games.get(room.id) == game.id:
+                return
+
+            self._ended_games[room.id] = game.id
+
+        session = object_session(room)
+
+        self.log.info("Room %s finish song, last song: %s" % (room.name, room.active_song_id))
+        room.status = 1
+        room.ingame = False
+
+        game.end_at = datetime.datetime.now()
+        game.active = False
+        self.sendplayers(room.id, game.scoreboard_packet)
+        self.send_message(
+            "Game ended %s" % with_color(room.active_song.fullname),
+            room
+        )
+
+        self.sendlobby(models.Room.smo_list(session))
+        self.send_user_list_lobby(None, session)
+
     def send_user_list(self, room):
         """
             Send a NSCUUL packet to update the user list for a given room
@@ -304,6 +554,8 @@ class StepmaniaServer(smthread.StepmaniaServer):
     def send_user_list_lobby(self, conn, session):
         """
             Send a NSCUUL packet to update the user list for the lobby
+
+            If conn is None, send it to all the connections in the lobby
         """
         users = session.query(models.User).filter_by(online = 1).filter_by(room_id = None).all()
         packet =  smpacket.SMPacketServerNSCCUUL(
@@ -312,31 +564,43 @@ class StepmaniaServer(smthread.StepmaniaServer):
             players=[{"status": u.enum_status.value, "name": u.name}
                      for u in users]
             )
+
+        if conn is None:
+            self.sendlobby(packet)
+            return
+
         conn.send(packet)
 
 
-    def send_friend_list(self, userid, conn):
+    def send_friend_list(self, userid, conn, session=None):
         """
             Send a FLU packet to update the friend list for a user
+
+            :param session: The session of the current packet. Use a new
+                session by default.
         """
         if conn == None:
             return
+
+        if session is None:
+            with self.db.session_scope() as session:
+                self.send_friend_list(userid, conn, session)
+            return
+
         usernames = []
         userstates = []
-        with self.db.session_scope() as session:
-            friends = session.query(models.Friendship).filter_by(state = 1).filter((models.Friendship.user1_id == userid) | (models.Friendship.user2_id == userid)).all()
-
-            for friend in friends:
-                if friend.user1_id == userid:
-                    frienduser = session.query(models.User).filter_by(id = friend.user2_id).first()
-                else:
-                    frienduser = session.query(models.User).filter_by(id = friend.user1_id).first()
-                usernames.append(frienduser.name)
-                if frienduser.online == True:
-                    userstates.append(1 + frienduser.status)
-                else:
-                    userstates.append(0)
+        friends = session.query(models.Friendship).filter_by(state = 1).filter((models.Friendship.user1_id == userid) | (models.Friendship.user2_id == userid)).all()
 
+        for friend in friends:
+            if friend.user1_id == userid:
+                frienduser = session.query(models.User).filter_by(id = friend.user2_id).first()
+            else:
+                frienduser = session.query(models.User).filter_by(id = friend.user1_id).first()
+            usernames.append(frienduser.name)
+            if frienduser.online == True:
+                userstates.append(1 + frienduser.status)
+            else:
+                userstates.append(0)
 
         packet = smpacket.SMPacketServerFLU(
             nb_players=len(usernames),
@@ -407,26 +671,17 @@ class StepmaniaServer(smthread.StepmaniaServer):
             user.has_song = False
 
         self.add_to_room(token, room.id)
+        self.route_to_room(token, room.id)
 
         #Ask client if they have the selected song
         if room.active_song:
-            hashpacket = smpacket.SMPacketServerNSCRSG(
+            self.sendconnection(token, smpacket.SMPacketServerNSCRSG(
                     usage=1,
                     song_title=room.active_song.title,
                     song_subtitle=room.active_song.subtitle,
                     song_artist=room.active_song.artist,
-                    song_hash=room.active_song_hash 
-                    )
-            nonhashpacket = smpacket.SMPacketServerNSCRSG(
-                    usage=1,
-                    song_title=room.active_song.title,
-                    song_subtitle=room.active_song.subtitle,
-                    song_artist=room.active_song.artist
-                    )
-            if conn.stepmania_version < 4:
-                conn.send(nonhashpacket)
-            else:
-                conn.send(hashpacket)
+                    song_hash=room.active_song_hash
+                    ))
 
         self.send_user_list(room)
 
@@ -467,6 +722,7 @@ class StepmaniaServer(smthread.StepmaniaServer):
 
         self.log.info("%s leave the room %s", models.User.users_repr(users, room.id), room.name)
         self.send_user_list(room)
+        self.check_end_game(room)
 
         return True
 
@@ -522,6 +778,33 @@ class StepmaniaServer(smthread.StepmaniaServer):
 
         return controllers
 
+    def _init_handlers(self, controllers, plugins):
+        """
+            Build the table of the handlers of each command: a tuple of
+            (handler, require_session, owner), the controllers first, then
+            the hooks of the plugins defining one.
+
+            The handlers are called with (session, connection, packet).
+        """
+
+        handlers = {}
+
+        for command, classes in controllers.items():
+            handlers[command] = [
+                (partial(self._run_controller, controller), controller.require_session, controller)
+                for controller in classes
+            ]
+
+        for app in plugins:
+            for command in chain(smpacket.SMClientCommand, smpacket.SMOClientCommand):
+                if not app.handles(command):
+                    continue
+
+                func = getattr(app, "on_%s" % command.name.lower())
+                handlers.setdefault(command, []).append((func, app.require_session, type(app)))
+
+        return dict((command, tuple(funcs)) for command, funcs in handlers.items())
+
     def _init_chat_commands(self, force_reload=False):
         chat_commands = {}
 
@@ -570,6 +853,12 @@ class StepmaniaServer(smthread.StepmaniaServer):
 def main():
     config = conf.Conf(*sys.argv[1:])
 
+    if config.server.get("workers", 1) > 1:
+        from smserver.supervisor import Supervisor
+
+        Supervisor(config, config.server["workers"]).start()
+        return
+
     StepmaniaServer(config).start()
 
 if __name__ == "__main__":
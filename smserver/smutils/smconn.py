@@ -3,24 +3,82 @@
 Base module for handling all type of connection
 """
 
+import asyncio
 import datetime
 import logging
+import socket
+import threading
+import time
 import uuid
 
 from threading import Lock, Thread
 
-from smserver.smutils import smpacket
+from smserver.smutils import smpacket, smframe, smlatency
+
+def call_soon(loop, callback, *args):
+    """
+        Schedule the callback on the loop from any thread.
+
+        Use the cheaper call_soon when already running in the loop thread.
+    """
+
+    if getattr(loop, "_thread_id", None) == threading.get_ident():
+        return loop.call_soon(callback, *args)
+
+    return loop.call_soon_threadsafe(callback, *args)
+
+def reuse_address(sock, reuse_port=False):
+    """
+        Allow to bind the socket again right after a restart, and with
+        reuse_port, to bind it from several processes (the kernel balance the
+        connections between them).
+    """
+
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+SEND_BUFFER = {
+    "high_water": 64 * 1024,
+    "low_water": 16 * 1024,
+    "max_size": 1024 * 1024,
+}
 
 class StepmaniaConn(object):
     logger = logging.getLogger('stepmania')
     ENCODING = "binary"
     ALLOWED_PACKET = []
 
+    # Packets for which only the latest one is kept when the client is too
+    # slow, with the option distinguishing the packets to keep.
+    COALESCE_PACKETS = {
+        smpacket.SMServerCommand.NSCGSU: "section",
+        smpacket.SMServerCommand.NSCCUUL: None,
+    }
+
+    # Set by the transports able to hand their socket to another worker
+    HANDOFF = False
+
+    # Attributes following the connection when it is handed to another worker
+    HANDOFF_ATTRIBUTES = (
+        "token", "ip", "port", "users", "room", "song", "spectate",
+        "chat_timestamp", "stepmania_version", "stepmania_name",
+    )
+
     """ A stepmania connection is represented by a token in the database """
 
     def __init__(self, serv, ip, port):
         self.mutex = Lock()
 
+        self._outbound = []
+        self._outbound_size = 0
+        self._outbound_mutex = Lock()
+        self._write_mutex = Lock()
+        self._flush_scheduled = False
+        self._throttled = False
+        self._overflowed = False
+        self._flooded = False
+
         self._serv = serv
         self.ip = ip
         self.port = port
@@ -32,18 +90,64 @@ class StepmaniaConn(object):
 
         self.songs = {}
         self.song = None
-        self.songstats = {0: {"data": []}, 1: {"data": []}}
+        self._songstats = {0: {"data": []}, 1: {"data": []}}
 
-        self.wait_start = False
+        self._wait_start = False
         self.ingame = False
-        self.spectate = False
+        self._spectate = False
 
         self.chat_timestamp = False
 
         self.last_ping = datetime.datetime.now()
+        self.last_activity = time.monotonic()
+        self.latency = smlatency.LatencyStats()
         self.stepmania_version = None
         self.stepmania_name = None
 
+        self.handoff_to = None
+
+    # The server index the connections of each room on these attributes
+    @property
+    def spectate(self):
+        """ True if the connection is in spectator mode """
+
+        return self._spectate
+
+    @spectate.setter
+    def spectate(self, value):
+        self._spectate = value
+        self._serv.refresh_connection(self)
+
+    @property
+    def wait_start(self):
+        """ True if the connection wait for the game to start """
+
+        return self._wait_start
+
+    @wait_start.setter
+    def wait_start(self, value):
+        self._wait_start = value
+        self._serv.refresh_connection(self)
+
+    @property
+    def songstats(self):
+        """ Stats of the song being played, with its start time once started """
+
+        return self._songstats
+
+    @songstats.setter
+    def songstats(self, value):
+        self._songstats = value
+        self._serv.refresh_connection(self)
+
+    def song_time(self):
+        """
+            Time elapsed in the song being played, from the moment the
+            client received the start (``start_at``, on the monotonic clock).
+        """
+
+        return datetime.timedelta(seconds=max(0, time.monotonic() - self._songstats["start_at"]))
+
     def run(self):
         """ Start to listen for incomming data """
         for data in self.received_data():
@@ -57,43 +161,264 @@ class StepmaniaConn(object):
     def received_data(self):
         pass
 
+    def handoff_state(self):
+        """ Per-connection state to send with the socket to another worker """
+
+        state = dict((attr, getattr(self, attr)) for attr in self.HANDOFF_ATTRIBUTES)
+        state["songs"] = list(self.songs.items())
+        return state
+
+    def restore(self, state):
+        """ Restore the state of a connection handed by another worker """
+
+        for attr in self.HANDOFF_ATTRIBUTES:
+            setattr(self, attr, state[attr])
+
+        self.songs = dict(state["songs"])
+
+    def frame_parser(self):
+        """ Return a new parser for the binary frames of this connection """
+
+        return smframe.SMFrameParser(self._serv.max_frame_size)
+
     def _on_data(self, data):
         """ Action to perform on new data """
 
+        self.last_activity = time.monotonic()
+
+        if self._flooded:
+            return None
+
+        if self._serv.queue_full(self):
+            self._flooded = True
+            self.logger.warning("connection %s drop: %s packets waiting to be handled",
+                                self.ip, self._serv.max_pending_packets)
+            self._abort()
+            return None
+
         packet = smpacket.SMPacket.from_(self.ENCODING, data)
-        if not packet:
+        if packet is None:
+            if isinstance(data, memoryview):
+                data = bytes(data)
+
             self.logger.info("packet %s drop from %s", data, self.ip)
             return None
 
         self.logger.debug("Packet received from %s: %s", self.ip, packet)
 
         if self.ALLOWED_PACKET and packet.command not in self.ALLOWED_PACKET:
-            self.logger.debug("packet %s ignored from %s", data, self.ip)
+            self.logger.debug("packet %s ignored from %s", packet, self.ip)
             return None
 
         if packet.command == smpacket.SMClientCommand.NSCPingR:
             self.last_ping = datetime.datetime.now()
+            self.latency.pong_received(self.last_activity)
 
-        self._serv.on_packet(self, packet)
+        self._dispatch(packet)
 
-    def send(self, packet):
-        """ How to send a new packet """
+    def _dispatch(self, packet):
+        """
+            Queue the packet to be handled by the server threads, after the
+            packets previously received on this connection.
+        """
 
-        if packet.command == smpacket.SMServerCommand.NSCCM and self.chat_timestamp:
-            packet["message"] = "[%s] %s" % (
-                datetime.datetime.now().strftime("%X"),
-                packet["message"]
-            )
+        self._serv.execute(self, self._serv.on_packet, self, packet)
+
+    def send(self, packet, cache=None):
+        """
+            How to send a new packet
+
+            :param packet: The packet to send
+            :param dict cache: Encoded packets, shared by all the connections
+                of a broadcast to encode each variant of the packet only once.
+        """
 
         self.logger.debug("packet send to %s: %s", self.ip, packet)
-        self._send_data(packet.to_(self.ENCODING))
+
+        data = self.encode(packet, cache)
+        size = sum(len(chunk) for chunk in data)
+        key = self._coalesce_key(packet)
+        limits = self._serv.send_buffer
+
+        with self._outbound_mutex:
+            if self._overflowed:
+                return
+
+            if key is not None and self._throttled:
+                self._drop_queued(key)
+
+            pending = self._outbound_size + self._buffered_size() + size
+            if pending > limits["max_size"]:
+                self._overflowed = True
+                self._outbound = []
+                self._outbound_size = 0
+            else:
+                self._outbound.append((key, data))
+                self._outbound_size += size
+
+                if self._flush_scheduled:
+                    return
+
+                self._flush_scheduled = True
+
+        if self._overflowed:
+            self.logger.warning("connection %s drop: %s bytes waiting to be sent",
+                                self.ip, pending)
+            self._abort()
+            return
+
+        self._schedule_flush()
+
+    def _coalesce_key(self, packet):
+        if packet.command not in self.COALESCE_PACKETS:
+            return None
+
+        option = self.COALESCE_PACKETS[packet.command]
+        return (packet.command, packet.get(option) if option else None)
+
+    def _drop_queued(self, key):
+        """ Remove the queued packet with the same coalesce key """
+
+        for idx, (queued_key, data) in enumerate(self._outbound):
+            if queued_key == key:
+                del self._outbound[idx]
+                self._outbound_size -= sum(len(chunk) for chunk in data)
+                return
+
+    def encode(self, packet, cache=None):
+        """
+            Encode the packet for this connection, using the cache if given.
+
+            Return the chunks to write: size header and data for the binary
+            encoding, so they can be written without being concatenated.
+        """
+
+        variant = self.packet_variant(packet)
+        if cache is None:
+            return self._encode_variant(packet, variant)
+
+        key = (self.ENCODING, variant)
+        data = cache.get(key)
+        if data is None:
+            data = cache[key] = self._encode_variant(packet, variant)
+
+        return data
+
+    def _encode_variant(self, packet, variant):
+        packet = self._variant_packet(packet, variant)
+
+        if self.ENCODING == "binary":
+            data = packet.data
+            return (smframe.HEADER.pack(len(data)), data)
+
+        return (packet.to_(self.ENCODING),)
+
+    def packet_variant(self, packet):
+        """
+            Return the variant of the packet to send to this connection, None
+            if the packet is sent as is.
+
+            Chat messages are prefixed by the time if the user asked for it,
+            and clients older than version 4 don't get the song hash.
+        """
+
+        if packet.command == smpacket.SMServerCommand.NSCCM and self.chat_timestamp:
+            return ("timestamp", datetime.datetime.now().strftime("%X"))
+
+        if packet.command == smpacket.SMServerCommand.NSCRSG and (self.stepmania_version or 0) < 4:
+            return ("nohash",)
+
+        return None
+
+    @staticmethod
+    def _variant_packet(packet, variant):
+        if not variant:
+            return packet
+
+        opts = dict(packet.opts)
+        if variant[0] == "timestamp":
+            opts["message"] = "[%s] %s" % (variant[1], opts.get("message"))
+        elif variant[0] == "nohash":
+            opts.pop("song_hash", None)
+
+        return packet.__class__(**opts)
+
+    def _schedule_flush(self):
+        """
+            Called on the first packet queued since the last flush.
+
+            Flush immediately by default, transports running in an event
+            loop flush once per loop iteration instead.
+        """
+
+        self.flush()
+
+    def flush(self):
+        """
+            Write all the packets queued.
+
+            Once the data waiting in the transport exceed the high water mark,
+            the packets are kept in the queue (only the latest of the
+            coalesced packets) until it goes back under the low water mark.
+        """
+
+        limits = self._serv.send_buffer
+
+        with self._write_mutex:
+            with self._outbound_mutex:
+                self._flush_scheduled = False
+
+                if self._throttled and self._buffered_size() > limits["low_water"]:
+                    items = []
+                else:
+                    self._throttled = False
+                    items, self._outbound = [data for _, data in self._outbound], []
+                    self._outbound_size = 0
+
+            self._write(items)
+
+            with self._outbound_mutex:
+                if self._buffered_size() > limits["high_water"]:
+                    self._throttled = True
+
+                if self._throttled and not self._flush_scheduled:
+                    self._flush_scheduled = self._wait_writable()
+
+    def _buffered_size(self):
+        """ Number of bytes written but not yet sent by the transport """
+
+        return 0
+
+    def _wait_writable(self):
+        """
+            Called when the client is too slow. Return True if the transport
+            will call flush once its buffer is under the low water mark, False
+            to wait for the next packet sent.
+        """
+
+        return False
+
+    def _abort(self):
+        """ Close a connection which doesn't read its data """
+
+        self.close()
+
+    def _write(self, items):
+        """
+            Write the queued packets, each one given as a tuple of chunks.
+
+            Transports able to write many buffers at once override it.
+        """
+
+        for item in items:
+            self._send_data(item[0] if len(item) == 1 else b"".join(item))
 
     def _send_data(self, data):
         pass
 
     def close(self):
         """ Close the connection """
-        self._serv.on_disconnect(self)
+        self._serv.execute(self, self._serv.on_disconnect, self)
 
 
 class SMThread(Thread):
@@ -111,3 +436,46 @@ class SMThread(Thread):
 
     def stop(self):
         self.logger.debug("Closing thread: %s", self)
+
+
+class SMLoopThread(SMThread):
+    """
+        Run all the listeners on a single event loop.
+
+        Each listener define a ``listen`` coroutine which start listening on
+        the given loop.
+    """
+
+    def __init__(self, server, loop, listeners):
+        SMThread.__init__(self, server, None, None)
+        self.loop = loop
+        self.listeners = listeners
+        self._continue = True
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            for listener in self.listeners:
+                self.loop.run_until_complete(listener.listen())
+        except RuntimeError:
+            # Stopped before listening
+            pass
+
+        # The loop may have been stopped while starting the listeners
+        if self._continue:
+            self.loop.run_forever()
+
+        self.loop.close()
+        SMThread.run(self)
+
+    def stop(self):
+        SMThread.stop(self)
+        self._continue = False
+        self.loop.call_soon_threadsafe(self._close_listeners)
+
+    def _close_listeners(self):
+        for listener in self.listeners:
+            listener.stop()
+
+        self.loop.stop()
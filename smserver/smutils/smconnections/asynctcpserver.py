@@ -6,7 +6,7 @@ import socket
 import asyncio
 import asyncio.streams
 
-from smserver.smutils import smconn
+from smserver.smutils import smconn, smframe
 
 class AsyncSocketClient(smconn.StepmaniaConn):
     ENCODING = "binary"
@@ -18,60 +18,71 @@ class AsyncSocketClient(smconn.StepmaniaConn):
         self.task = None
         self.loop = loop
 
+        self.writer.transport.set_write_buffer_limits(
+            high=serv.send_buffer["high_water"],
+            low=serv.send_buffer["low_water"])
+
     @asyncio.coroutine
     def run(self):
-        full_data = b''
-        size = None
-        data_left = b''
+        parser = self.frame_parser()
 
         while True:
-            if len(data_left) > 0:
-                data = data_left
-                data_left = b""
-            else:
-                data = (yield from self.reader.read(8192))
+            data = (yield from self.reader.read(8192))
 
             if data == b'':
                 break
 
-            if not size:
-                if len(data) < 5:
-                    self.logger.info("packet %s drop: to short" % (data))
-                    continue
+            try:
+                frames = parser.feed(data)
+            except smframe.SMFrameError as err:
+                self.logger.info("connection %s drop: %s", self.ip, err)
+                break
 
-                full_data = data[:4]
-                data = data[4:]
-                size = int.from_bytes(full_data[:4], byteorder='big')
+            for frame in frames:
+                self._on_data(frame)
 
-            if len(data) < size - len(full_data):
-                full_data += data
-                continue
+        self.close()
 
-            payload_size = len(full_data) - 4 + size
-            full_data += data[:payload_size]
+    def _schedule_flush(self):
+        smconn.call_soon(self.loop, self.flush)
 
-            self._on_data(full_data)
+    def _write(self, items):
+        if items:
+            self.writer.writelines([chunk for item in items for chunk in item])
 
-            data_left = data[payload_size:]
-            full_data = b""
-            size = None
+    def _buffered_size(self):
+        return self.writer.transport.get_write_buffer_size()
 
-        self.close()
+    def _wait_writable(self):
+        self.loop.create_task(self._drain())
+        return True
+
+    @asyncio.coroutine
+    def _drain(self):
+        try:
+            yield from self.writer.drain()
+        except ConnectionError:
+            return
+
+        self.flush()
+
+    def _abort(self):
+        smconn.call_soon(self.loop, self.close)
 
     def _send_data(self, data):
         self.writer.write(data)
-        self.loop.create_task(self.writer.drain())
 
     def close(self):
-        self._serv.on_disconnect(self)
+        self._serv.execute(self, self._serv.on_disconnect, self)
         self.writer.close()
 
 
 class AsyncSocketServer(smconn.SMThread):
-    def __init__(self, server, ip, port):
+    def __init__(self, server, ip, port, loop=None):
         smconn.SMThread.__init__(self, server, ip, port)
 
-        self.loop = asyncio.new_event_loop()
+        self.shared_loop = loop is not None
+        self.loop = loop or asyncio.new_event_loop()
         self._serv = None
         self.clients = {}
 
@@ -91,11 +102,17 @@ class AsyncSocketServer(smconn.SMThread):
 
         client.task.add_done_callback(client_done)
 
+    @asyncio.coroutine
+    def listen(self):
+        """ Start listening on the loop """
+
+        options = {"reuse_port": True} if self.server.reuse_port else {}
+
+        self._serv = yield from asyncio.streams.start_server(
+            self._accept_client, self.ip, self.port, loop=self.loop, **options)
+
     def run(self):
-        self._serv = self.loop.run_until_complete(
-            asyncio.streams.start_server(self._accept_client,
-                                         self.ip, self.port,
-                                         loop=self.loop))
+        self.loop.run_until_complete(self.listen())
         self.loop.run_forever()
         self.loop.close()
         smconn.SMThread.run(self)
@@ -110,5 +127,7 @@ class AsyncSocketServer(smconn.SMThread):
             for sock in self._serv.sockets:
                 sock.shutdown(socket.SHUT_RDWR)
 
-        self.loop.stop()
+        if not self.shared_loop:
+            self.loop.stop()
+
         self._serv.close()
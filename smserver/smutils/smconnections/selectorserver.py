@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+import base64
+import collections
+import socket
+import threading
+
+try:
+    import selectors
+except ImportError:
+    from asyncio import selectors
+
+from smserver.smutils import smconn, smframe
+from smserver.smutils.smconnections.smtcpsocket import sendmsg_all
+
+RECV_SIZE = 8192
+
+class SelectorConn(smconn.StepmaniaConn):
+    """
+        Non blocking connection, driven by the selector of its server.
+
+        The packets are sent straight from the calling thread, the data which
+        can't be written without blocking are kept until the socket is
+        writable again.
+    """
+
+    ENCODING = "binary"
+    HANDOFF = True
+
+    def __init__(self, serv, ip, port, conn, listener):
+        smconn.StepmaniaConn.__init__(self, serv, ip, port)
+        self._conn = conn
+        self._conn.setblocking(False)
+        self._listener = listener
+        self._parser = self.frame_parser()
+        self._unsent = []
+        self._watch_write = False
+        self._closed = False
+
+        # Packets received and not yet handled, kept to follow the
+        # connection if it is handed to another worker.
+        self._pending = collections.deque()
+        self._dispatch_mutex = threading.RLock()
+
+    def on_readable(self):
+        """ Read the available data and handle each complete frame """
+
+        try:
+            data = self._conn.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        if data == b'':
+            self.close()
+            return
+
+        try:
+            frames = self._parser.feed(data)
+        except smframe.SMFrameError as err:
+            self.logger.info("connection %s drop: %s", self.ip, err)
+            self.close()
+            return
+
+        self._handle_frames(frames)
+
+    def _handle_frames(self, frames):
+        for frame in frames:
+            if self._closed:
+                return
+
+            self._on_data(frame)
+
+    def _dispatch(self, packet):
+        with self._dispatch_mutex:
+            self._pending.append(packet)
+            if self.handoff_to is None:
+                self._serv.execute(self, self._handle_packet)
+
+    def _handle_packet(self):
+        with self._dispatch_mutex:
+            # Wait for the handoff, or already handed
+            if self.handoff_to is not None or not self._pending:
+                return
+
+            packet = self._pending.popleft()
+
+        self._serv.on_packet(self, packet)
+
+        if self.handoff_to is not None:
+            self._listener.defer(self._listener.handoff, self)
+
+    def on_writable(self):
+        """ Send the data left by the previous writes """
+
+        self.flush()
+
+    def _write(self, items):
+        if self._closed:
+            return
+
+        chunks = self._unsent + [chunk for item in items for chunk in item]
+        if not chunks:
+            return
+
+        try:
+            self._unsent = sendmsg_all(self._conn, chunks)
+        except OSError:
+            self._unsent = []
+            self._abort()
+            return
+
+        if bool(self._unsent) != self._watch_write:
+            self._watch_write = bool(self._unsent)
+            self._listener.call_soon(self._listener.update, self)
+
+    def _buffered_size(self):
+        return sum(len(chunk) for chunk in self._unsent)
+
+    def _wait_writable(self):
+        return True
+
+    def _abort(self):
+        # Never close in the middle of a write: the writer may be iterating
+        # over the connections of the server.
+        self._listener.defer(self.close)
+
+    def _send_data(self, data):
+        self._write([(data,)])
+
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._listener.call_soon(self._listener.remove, self)
+        smconn.StepmaniaConn.close(self)
+
+
+class SelectorServer(smconn.SMThread):
+    """
+        Classic TCP server, serving all the clients from a single thread with
+        the best selector available on the platform (epoll, kqueue, ...).
+    """
+
+    def __init__(self, server, ip, port):
+        smconn.SMThread.__init__(self, server, ip, port)
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        smconn.reuse_address(self._socket, self.server.reuse_port)
+        self._socket.bind((self.ip, self.port))
+        self._socket.listen(128)
+        self._socket.setblocking(False)
+
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+
+        self._callbacks = collections.deque()
+        self._thread_id = None
+        self._continue = True
+        self.clients = {}
+
+    def call_soon(self, callback, *args):
+        """
+            Run the callback in the selector thread: directly if already in
+            it, on the next iteration of the loop otherwise.
+        """
+
+        if self._thread_id == threading.get_ident():
+            callback(*args)
+            return
+
+        self.defer(callback, *args)
+
+    def defer(self, callback, *args):
+        """ Run the callback in the selector thread, on the next iteration """
+
+        self._callbacks.append((callback, args))
+        try:
+            self._wakeup_w.send(b'\0')
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            return
+
+    def update(self, client):
+        """ Watch the client for writes as long as some data are not sent """
+
+        if client.fileno not in self.clients:
+            return
+
+        events = selectors.EVENT_READ
+        if client._watch_write:
+            events |= selectors.EVENT_WRITE
+
+        self._selector.modify(client._conn, events, client)
+
+    def remove(self, client):
+        """ Stop watching a closed client """
+
+        if self.clients.pop(client.fileno, None) is None:
+            return
+
+        self._selector.unregister(client._conn)
+        client._conn.close()
+
+    def handoff(self, client):
+        """
+            Hand the client socket to another worker, with the data not yet
+            handled or sent.
+        """
+
+        with client._dispatch_mutex:
+            worker, client.handoff_to = client.handoff_to, None
+            packets = list(client._pending)
+            client._pending.clear()
+
+        if client._closed:
+            return
+
+        with client._write_mutex:
+            with client._outbound_mutex:
+                output = b"".join(
+                    [bytes(chunk) for chunk in client._unsent] +
+                    [bytes(chunk) for _, item in client._outbound for chunk in item])
+                client._closed = True
+
+        state = client.handoff_state()
+        state["listener"] = type(self).__name__
+        frames = [packet.binary for packet in packets]
+        state["input"] = base64.b64encode(b"".join(frames) + bytes(client._parser._buffer)).decode()
+        state["output"] = base64.b64encode(output).decode()
+
+        if not self.server.state.handoff(worker, client._conn, state):
+            client._closed = False
+            for packet in packets:
+                client._dispatch(packet)
+            return
+
+        self.logger.debug("Connection %s handed to the worker %s", client.ip, worker)
+
+        with client._outbound_mutex:
+            client._outbound = []
+            client._outbound_size = 0
+            client._unsent = []
+
+        self.clients.pop(client.fileno, None)
+        self._selector.unregister(client._conn)
+        client._conn.close()
+        self.server.forget_connection(client)
+
+    def adopt(self, sock, state):
+        """ Take a client handed by another worker """
+
+        self.call_soon(self._adopt, sock, state)
+
+    def _adopt(self, sock, state):
+        client = SelectorConn(self.server, state["ip"], state["port"], sock, self)
+        client.restore(state)
+        client.fileno = sock.fileno()
+
+        self.clients[client.fileno] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+        self.server.register_connection(client)
+        if client.room is not None:
+            self.server.add_to_room(client.token, client.room)
+
+        output = base64.b64decode(state["output"])
+        if output:
+            client._write([(output,)])
+
+        try:
+            frames = client._parser.feed(base64.b64decode(state["input"]))
+        except smframe.SMFrameError as err:
+            self.logger.info("connection %s drop: %s", client.ip, err)
+            client.close()
+            return
+
+        client._handle_frames(frames)
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                self.logger.warning("Fail to accept a connection: %s", err)
+                return
+
+            ip, port = addr[:2]
+            client = SelectorConn(self.server, ip, port, conn, self)
+            client.fileno = conn.fileno()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self.clients[client.fileno] = client
+            self._selector.register(conn, selectors.EVENT_READ, client)
+            self.server.add_connection(client)
+
+    def _run_callbacks(self):
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        for _ in range(len(self._callbacks)):
+            callback, args = self._callbacks.popleft()
+            callback(*args)
+
+    def run(self):
+        self._thread_id = threading.get_ident()
+        self._selector.register(self._socket, selectors.EVENT_READ, None)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup_r)
+
+        while self._continue:
+            for key, events in self._selector.select():
+                if key.data is None:
+                    self._accept()
+                elif key.data is self._wakeup_r:
+                    self._run_callbacks()
+                else:
+                    self._on_event(key.data, events)
+
+        for client in list(self.clients.values()):
+            client.close()
+
+        self._run_callbacks()
+        self._selector.close()
+        self._socket.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+        smconn.SMThread.run(self)
+
+    def _on_event(self, client, events):
+        if client._closed:
+            return
+
+        try:
+            if events & selectors.EVENT_WRITE:
+                client.on_writable()
+
+            if events & selectors.EVENT_READ and not client._closed:
+                client.on_readable()
+        except Exception: #pylint: disable=broad-except
+            self.logger.exception("Error while handling the connection %s", client.ip)
+            client.close()
+
+    def stop(self):
+        smconn.SMThread.stop(self)
+
+        def stop_loop():
+            self._continue = False
+
+        self.call_soon(stop_loop)
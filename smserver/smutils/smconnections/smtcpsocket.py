@@ -1,10 +1,43 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
+import select
 import socket
 from threading import Thread
 
-from smserver.smutils import smconn
+from smserver.smutils import smconn, smframe
+
+IOV_MAX = 512
+
+def sendmsg_all(sock, chunks, flags=0):
+    """
+        Send the chunks with scatter-gather writes, without joining them.
+
+        Return the chunks which can't be sent without blocking, if
+        socket.MSG_DONTWAIT is in flags.
+
+        Fallback on a blocking sendall if sendmsg is not available.
+    """
+
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(chunks))
+        return []
+
+    idx = 0
+    while idx < len(chunks):
+        try:
+            sent = sock.sendmsg(chunks[idx:idx+IOV_MAX], [], flags)
+        except BlockingIOError:
+            break
+
+        while idx < len(chunks) and sent >= len(chunks[idx]):
+            sent -= len(chunks[idx])
+            idx += 1
+
+        if sent:
+            chunks[idx] = memoryview(chunks[idx])[sent:]
+
+    return chunks[idx:]
 
 class SocketConn(smconn.StepmaniaConn, Thread):
     ENCODING = "binary"
@@ -13,55 +46,80 @@ class SocketConn(smconn.StepmaniaConn, Thread):
         Thread.__init__(self)
         smconn.StepmaniaConn.__init__(self, serv, ip, port)
         self._conn = conn
+        self._unsent = []
+        self._wait_thread = None
 
     def received_data(self):
-        full_data = b""
-        size = None
-        data_left = b""
+        parser = self.frame_parser()
 
         while True:
-            if len(data_left) > 0:
-                data = data_left
-                data_left = b""
-            else:
-                try:
-                    data = self._conn.recv(8192)
-                except socket.error:
-                    yield None
-                    continue
+            try:
+                data = self._conn.recv(8192)
+            except socket.error:
+                yield None
+                continue
 
             if data == b'':
                 yield None
                 continue
 
-            if not size:
-                if len(data) < 5:
-                    self.logger.info("packet %s drop: to short" % (data))
-                    continue
+            try:
+                frames = parser.feed(data)
+            except smframe.SMFrameError as err:
+                self.logger.info("connection %s drop: %s", self.ip, err)
+                yield None
+                continue
 
-                full_data = data[:4]
-                data = data[4:]
-                size = int.from_bytes(full_data[:4], byteorder='big')
+            for frame in frames:
+                yield frame
+
+    def _write(self, items):
+        chunks = self._unsent + [chunk for item in items for chunk in item]
+        if not chunks:
+            return
+
+        try:
+            self._unsent = sendmsg_all(self._conn, chunks, getattr(socket, "MSG_DONTWAIT", 0))
+        except OSError:
+            self._unsent = []
+            self.close()
+            return
+
+        # The reading thread is blocked in recv: wait for the socket to be
+        # writable in another thread, only while some data are left.
+        if self._unsent and self._wait_thread is None:
+            self._wait_thread = Thread(target=self._send_when_writable)
+            self._wait_thread.daemon = True
+            self._wait_thread.start()
+
+    def _send_when_writable(self):
+        """ Send the data left once the socket is writable """
+
+        writable = []
+        while not writable:
+            try:
+                # Check again from time to time if the socket was closed
+                _, writable, _ = select.select([], [self._conn], [], 1)
+            except (OSError, ValueError):
+                return
 
-            if len(data) < size - len(full_data):
-                full_data += data
-                continue
+        with self._write_mutex:
+            self._wait_thread = None
 
-            payload_size = len(full_data) - 4 + size
-            full_data += data[:payload_size]
+        self.flush()
 
-            yield full_data
+    def _buffered_size(self):
+        return sum(len(chunk) for chunk in self._unsent)
 
-            data_left = data[payload_size:]
-            full_data = b""
-            size = None
+    def _wait_writable(self):
+        return True
 
-    def _send_data(self, data):
-        with self.mutex:
-            try:
-                self._conn.sendall(data)
-            except OSError:
-                self.close()
+    def _abort(self):
+        # Wake up the reading thread, which close the connection
+        try:
+            self._conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            self.close()
 
     def close(self):
         self._conn.close()
@@ -72,7 +130,7 @@ class SocketServer(smconn.SMThread):
         smconn.SMThread.__init__(self, server, ip, port)
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        smconn.reuse_address(self._socket, self.server.reuse_port)
         self._socket.bind((self.ip, self.port))
         self._socket.listen(5)
         self._continue = True
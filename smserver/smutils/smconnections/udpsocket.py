@@ -2,25 +2,91 @@
 # -*- coding: utf8 -*-
 
 import socket
-from threading import Thread
+import time
+import asyncio
 
 from smserver.smutils import smconn, smpacket
 
-class SocketConn(smconn.StepmaniaConn, Thread):
+RATE_LIMIT = 5
+RATE_BURST = 10
+MAX_SOURCES = 4096
+
+class RateLimiter(object):
+    """
+        Token bucket for each source IP.
+
+        Each IP can send ``burst`` datagrams at once, then ``rate`` datagrams
+        by second.
+
+        :Example:
+
+        >>> limiter = RateLimiter(rate=1, burst=2)
+        >>> [limiter.allow("1.1.1.1", now=0) for _ in range(3)]
+        [True, True, False]
+        >>> limiter.allow("2.2.2.2", now=0)
+        True
+        >>> limiter.allow("1.1.1.1", now=1)
+        True
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST, max_sources=MAX_SOURCES):
+        self.rate = rate
+        self.burst = burst
+        self.max_sources = max_sources
+        self._buckets = {}
+
+    def allow(self, ip, now=None):
+        """ Return True if the IP can send one more datagram """
+
+        if now is None:
+            now = time.monotonic()
+
+        bucket = self._buckets.get(ip)
+        if bucket is None:
+            if len(self._buckets) >= self.max_sources:
+                self._purge(now)
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+        if tokens < 1:
+            self._buckets[ip] = (tokens, now)
+            return False
+
+        self._buckets[ip] = (tokens - 1, now)
+        return True
+
+    def _purge(self, now):
+        """ Forget the IPs which have a full bucket again """
+
+        refill = float(self.burst) / self.rate
+        self._buckets = dict(
+            (ip, bucket) for ip, bucket in self._buckets.items()
+            if now - bucket[1] < refill
+        )
+
+        if len(self._buckets) >= self.max_sources:
+            self._buckets.clear()
+
+
+class DatagramConn(smconn.StepmaniaConn):
+    """
+        Datagram handled by the UDP listener, answered with the bound socket
+        (or datagram transport).
+    """
+
     ENCODING = "binary"
     ALLOWED_PACKET = [smpacket.SMClientCommand.NSCFormatted]
 
-    def __init__(self, serv, ip, port, data):
-        Thread.__init__(self)
+    def __init__(self, serv, ip, port, sock):
         smconn.StepmaniaConn.__init__(self, serv, ip, port)
-        self._data = data
-
-    def received_data(self):
-        yield self._data
+        self._sock = sock
 
     def _send_data(self, data):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock.sendto(data, (self.ip, self.port))
+        try:
+            self._sock.sendto(data, (self.ip, self.port))
+        except OSError as err:
+            self.logger.debug("Fail to answer to %s: %s", self.ip, err)
 
     def close(self):
         pass
@@ -31,9 +97,10 @@ class UDPServer(smconn.SMThread):
         smconn.SMThread.__init__(self, server, ip, port)
 
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        smconn.reuse_address(self._socket, self.server.reuse_port)
         self._socket.bind((self.ip, self.port))
         self._socket.settimeout(0.5)
+        self._limiter = RateLimiter()
         self._continue = True
 
     def run(self):
@@ -43,9 +110,14 @@ class UDPServer(smconn.SMThread):
             except socket.timeout:
                 continue
 
-            ip, port = addr
+            ip, port = addr[:2]
+            if not self._limiter.allow(ip):
+                continue
 
-            SocketConn(self.server, ip, port, data).start()
+            try:
+                DatagramConn(self.server, ip, port, self._socket)._on_data(data)
+            except Exception: #pylint: disable=broad-except
+                self.logger.exception("Error while handling a datagram from %s", ip)
 
         self._socket.close()
         smconn.SMThread.run(self)
@@ -54,3 +126,46 @@ class UDPServer(smconn.SMThread):
         smconn.SMThread.stop(self)
         self._continue = False
 
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self._limiter = RateLimiter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        ip, port = addr[:2]
+        if not self._limiter.allow(ip):
+            return
+
+        DatagramConn(self.server, ip, port, self.transport)._on_data(data)
+
+
+class AsyncUDPServer(smconn.SMThread):
+    """ UDP listener running on a shared event loop """
+
+    def __init__(self, server, ip, port, loop=None):
+        smconn.SMThread.__init__(self, server, ip, port)
+
+        self.loop = loop
+        self._transport = None
+
+    @asyncio.coroutine
+    def listen(self):
+        """ Start listening on the loop """
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        smconn.reuse_address(sock, self.server.reuse_port)
+        sock.bind((self.ip, self.port))
+
+        self._transport, _ = yield from self.loop.create_datagram_endpoint(
+            lambda: UDPProtocol(self.server), sock=sock)
+
+    def stop(self):
+        smconn.SMThread.stop(self)
+
+        if self._transport is not None:
+            self._transport.close()
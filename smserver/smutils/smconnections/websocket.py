@@ -3,6 +3,8 @@
 
 import socket
 import asyncio
+from collections import deque
+
 import websockets
 
 from smserver.smutils import smconn
@@ -16,6 +18,10 @@ class WebSocketClient(smconn.StepmaniaConn):
         self.task = None
         self.loop = loop
 
+        self._messages = deque()
+        self._messages_size = 0
+        self._sender = None
+
     @asyncio.coroutine
     def run(self):
         while True:
@@ -28,18 +34,57 @@ class WebSocketClient(smconn.StepmaniaConn):
 
         self.close()
 
+    def _schedule_flush(self):
+        smconn.call_soon(self.loop, self.flush)
+
+    def _write(self, items):
+        for item in items:
+            self._messages.append(item[0])
+            self._messages_size += len(item[0])
+
+        if self._messages and not self._sender:
+            self._sender = self.loop.create_task(self._send_messages())
+
+    @asyncio.coroutine
+    def _send_messages(self):
+        """ Send the messages one by one, in a single task """
+
+        try:
+            while self._messages:
+                message = self._messages.popleft()
+                self._messages_size -= len(message)
+                yield from self.websocket.send(message)
+
+                if self._throttled and self._buffered_size() <= self._serv.send_buffer["low_water"]:
+                    self.flush()
+        except websockets.ConnectionClosed:
+            self._messages.clear()
+            self._messages_size = 0
+        finally:
+            self._sender = None
+
+    def _buffered_size(self):
+        return self._messages_size
+
+    def _wait_writable(self):
+        return self._sender is not None
+
+    def _abort(self):
+        smconn.call_soon(self.loop, self.close)
+
     def _send_data(self, data):
         self.loop.create_task(self.websocket.send(data))
 
     def close(self):
-        self._serv.on_disconnect(self)
+        self._serv.execute(self, self._serv.on_disconnect, self)
         self.websocket.close()
 
 class WebSocketServer(smconn.SMThread):
-    def __init__(self, server, ip, port):
+    def __init__(self, server, ip, port, loop=None):
         smconn.SMThread.__init__(self, server, ip, port)
 
-        self.loop = asyncio.new_event_loop()
+        self.shared_loop = loop is not None
+        self.loop = loop or asyncio.new_event_loop()
 
         self._serv = None
         self.server = server
@@ -60,10 +105,17 @@ class WebSocketServer(smconn.SMThread):
             client.close()
             raise
 
-    def run(self):
-        self._serv = self.loop.run_until_complete(
-            websockets.serve(self._accept_client, self.ip, self.port, loop=self.loop))
+    @asyncio.coroutine
+    def listen(self):
+        """ Start listening on the loop """
 
+        options = {"reuse_port": True} if self.server.reuse_port else {}
+
+        self._serv = yield from websockets.serve(
+            self._accept_client, self.ip, self.port, loop=self.loop, **options)
+
+    def run(self):
+        self.loop.run_until_complete(self.listen())
         self.loop.run_forever()
         smconn.SMThread.run(self)
 
@@ -78,6 +130,8 @@ class WebSocketServer(smconn.SMThread):
             for sock in sockets:
                 sock.shutdown(socket.SHUT_RDWR)
 
-        self.loop.stop()
+        if not self.shared_loop:
+            self.loop.stop()
+
         self._serv.close()
 
@@ -0,0 +1,83 @@
+""" SMExecutor module
+
+Run the packet handlers out of the listener threads, keeping the order of the
+packets of each connection.
+"""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class SerialExecutor(object):
+    """
+        Run the tasks in a pool of threads, one task at a time for a given key.
+
+        The tasks submitted with the same key (a connection) are run in the
+        order of submission, never concurrently, while the tasks of different
+        keys run in parallel.
+
+        With no thread, the tasks are run inline:
+
+        >>> executor = SerialExecutor(0)
+        >>> executor.submit("conn", print, "handled")
+        handled
+    """
+
+    logger = logging.getLogger('stepmania')
+
+    def __init__(self, max_workers=None):
+        self._pool = ThreadPoolExecutor(max_workers) if max_workers != 0 else None
+        self._queues = {}
+        self._mutex = threading.Lock()
+
+    def submit(self, key, func, *args):
+        """ Run func(*args) after the tasks already submitted with this key """
+
+        if self._pool is None:
+            self._run(func, args)
+            return
+
+        with self._mutex:
+            queue = self._queues.get(key)
+            if queue is not None:
+                queue.append((func, args))
+                return
+
+            self._queues[key] = deque([(func, args)])
+
+        try:
+            self._pool.submit(self._drain, key)
+        except RuntimeError:
+            # Shutting down, run the remaining tasks in the caller thread
+            self._drain(key)
+
+    def pending(self, key):
+        """ Number of tasks of this key waiting to be run """
+
+        queue = self._queues.get(key)
+        return len(queue) if queue is not None else 0
+
+    def shutdown(self, wait=True):
+        """ Stop the threads once all the submitted tasks are done """
+
+        if self._pool is not None:
+            self._pool.shutdown(wait)
+
+    def _drain(self, key):
+        while True:
+            with self._mutex:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+
+                func, args = queue.popleft()
+
+            self._run(func, args)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception: #pylint: disable=broad-except
+            self.logger.exception("Error while running %s", func)
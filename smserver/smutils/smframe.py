@@ -0,0 +1,85 @@
+""" SMFrame module
+
+Split a stream of bytes into stepmania frames (4 bytes size + data).
+"""
+
+import struct
+
+HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 1024 * 1024
+
+
+class SMFrameError(Exception):
+    """ Raised when a frame announce a size bigger than the allowed size """
+
+class SMFrameParser(object):
+    """
+        Incremental parser of length prefixed frames.
+
+        Each complete frame (size header included) is returned as soon as it
+        is available, as a memoryview of the data received: the frames are
+        not copied. Only the end of a frame split across several reads is
+        kept in an internal buffer, and joined with the next read. Reads of
+        any size are accepted, and a read can contain several frames.
+
+        :Example:
+
+        >>> parser = SMFrameParser()
+        >>> parser.feed(b'\\x00\\x00\\x00\\x02\\x80')
+        []
+        >>> [bytes(frame) for frame in parser.feed(b'\\x01\\x00\\x00')]
+        [b'\\x00\\x00\\x00\\x02\\x80\\x01']
+        >>> [bytes(frame) for frame in parser.feed(b'\\x00\\x01\\x02')]
+        [b'\\x00\\x00\\x00\\x01\\x02']
+
+        >>> parser = SMFrameParser(max_frame_size=10)
+        >>> parser.feed(b'\\xff\\xff\\xff\\xff')
+        Traceback (most recent call last):
+        ...
+        smserver.smutils.smframe.SMFrameError: Frame of 4294967295 bytes exceed the limit of 10 bytes
+    """
+
+    def __init__(self, max_frame_size=None):
+        self.max_frame_size = max_frame_size or MAX_FRAME_SIZE
+        self._buffer = bytearray()
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+            Return the list of the frames completed by the data, as
+            memoryviews which stay valid after the next reads.
+
+            Raise SMFrameError if a frame exceed the maximum size, before
+            buffering its payload.
+        """
+
+        if self._buffer:
+            # Frame split across reads: join it with the new data
+            self._buffer += data
+            data = bytes(self._buffer)
+        elif not isinstance(data, bytes):
+            data = bytes(data)
+
+        view = memoryview(data)
+
+        frames = []
+        start = 0
+        while len(view) - start >= HEADER.size:
+            size = HEADER.unpack_from(view, start)[0]
+            if size > self.max_frame_size:
+                self._buffer = bytearray()
+                raise SMFrameError("Frame of %s bytes exceed the limit of %s bytes" % (
+                    size, self.max_frame_size))
+
+            end = start + HEADER.size + size
+            if len(view) < end:
+                break
+
+            frames.append(view[start:end])
+            start = end
+
+        self._buffer = bytearray(view[start:])
+
+        return frames
@@ -0,0 +1,116 @@
+""" SMLatency module
+
+Round trip time of the connections, measured with the ping packets.
+"""
+
+import collections
+import threading
+
+class LatencyStats(object):
+    """
+        Round trip time of a connection.
+
+        The server record the time of each ping sent, and the answers of the
+        client (in the same order) give the samples. The estimate is a moving
+        average of the samples with their mean deviation, computed like the
+        TCP retransmission timer (RFC 6298), and the samples are counted in a
+        small histogram.
+
+        All the times are in seconds, from a monotonic clock.
+
+        >>> stats = LatencyStats()
+        >>> stats.ping_sent(10.0)
+        >>> stats.pong_received(10.25)
+        0.25
+        >>> stats.rtt, stats.rttvar, stats.histogram
+        (0.25, 0.125, [0, 0, 0, 0, 1, 0, 0, 0])
+    """
+
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+
+    # Upper bounds of the histogram buckets, in milliseconds
+    BUCKETS = (10, 25, 50, 100, 250, 500, 1000, float("inf"))
+
+    # Pings without answer kept to match the late answers
+    MAX_PENDING = 8
+
+    def __init__(self):
+        self._pending = collections.deque(maxlen=self.MAX_PENDING)
+        self._mutex = threading.Lock()
+
+        self.rtt = None
+        self.rttvar = None
+        self.samples = 0
+        self.histogram = [0] * len(self.BUCKETS)
+
+    def ping_sent(self, now):
+        """ Record the time of a ping sent to the client """
+
+        with self._mutex:
+            self._pending.append(now)
+
+    def pong_received(self, now):
+        """ Match the answer of the client with the oldest ping and return the sample """
+
+        with self._mutex:
+            if not self._pending:
+                return None
+
+            sample = now - self._pending.popleft()
+            self._add_sample(sample)
+
+        return sample
+
+    def _add_sample(self, sample):
+        if self.rtt is None:
+            self.rtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar += self.BETA * (abs(self.rtt - sample) - self.rttvar)
+            self.rtt += self.ALPHA * (sample - self.rtt)
+
+        self.samples += 1
+
+        millis = sample * 1000
+        for idx, bound in enumerate(self.BUCKETS):
+            if millis <= bound:
+                self.histogram[idx] += 1
+                break
+
+    @property
+    def timeout(self):
+        """ Time to wait for an answer on top of the usual delays (0 without sample) """
+
+        if self.rtt is None:
+            return 0
+
+        return self.rtt + 4 * self.rttvar
+
+    def percentile(self, percent):
+        """
+            Upper bound of the histogram bucket holding the given percentile
+            of the samples, in milliseconds (None without sample).
+        """
+
+        if not self.samples:
+            return None
+
+        count = 0
+        for bound, bucket in zip(self.BUCKETS, self.histogram):
+            count += bucket
+            if count * 100 >= percent * self.samples:
+                return bound
+
+        return self.BUCKETS[-1]
+
+    def __str__(self):
+        if self.rtt is None:
+            return "no ping answered"
+
+        return "%.0f ms (+/- %.0f ms), p50 <= %s ms, p95 <= %s ms, %s pings" % (
+            self.rtt * 1000,
+            self.rttvar * 1000,
+            self.percentile(50),
+            self.percentile(95),
+            self.samples)
@@ -39,22 +39,33 @@
 
 from enum import Enum
 import json
+import struct
+
+_COMMANDS = {}
+_PACKET_CLASSES = {}
 
 class ParentCommand(Enum):
     @classmethod
     def get(cls, value, default=None):
+        commands = _COMMANDS.get(cls)
+        if commands is None:
+            commands = _COMMANDS[cls] = cls._commands()
+
         try:
-            return cls(value)
-        except ValueError:
-            pass
+            return commands.get(value, default)
+        except TypeError:
+            return default
+
+    @classmethod
+    def _commands(cls):
+        """ Map each value to its command, for this class and its subclasses """
 
+        commands = dict((command.value, command) for command in cls)
         for klass in cls.__subclasses__():
-            try:
-                return klass(value)
-            except ValueError:
-                pass
+            for command in klass:
+                commands.setdefault(command.value, command)
 
-        return default
+        return commands
 
 class SMCommand(ParentCommand):
     pass
@@ -129,6 +140,25 @@ class SMOServerCommand(SMOCommand):
     ROOMINFO    = 3
 
 
+def _find_nul(payload, offset):
+    """
+        Return the index of the first null byte after offset, -1 if there is
+        none.
+
+        Memoryviews can't be searched directly: search the underlying object
+        when the view covers all of it, else search a copy of the tail.
+    """
+
+    if not isinstance(payload, memoryview):
+        return payload.find(b'\x00', offset)
+
+    obj = payload.obj
+    if isinstance(obj, (bytes, bytearray)) and len(obj) == payload.nbytes:
+        return obj.find(b'\x00', offset)
+
+    end = bytes(payload[offset:]).find(b'\x00')
+    return end if end < 0 else end + offset
+
 class SMPayloadTypeAbstract(object):
     """
         Parent class for declaring new type of data.
@@ -157,6 +187,21 @@ class SMPayloadTypeAbstract(object):
 
         return payload, None
 
+    @classmethod
+    def decode_from(cls, payload, offset=0, opt=None):
+        """
+            Decode the data starting at offset, without copying the payload.
+
+            Take the payload (bytes, bytearray or memoryview), the offset
+            and option and return the number of bytes consumed and the data.
+
+            Fallback on ``decode`` for the types which only define it.
+        """
+
+        tail = bytes(payload[offset:])
+        remaining, data = cls.decode(tail, opt)
+        return len(tail) - len(remaining), data
+
 class SMPayloadTypeINT(SMPayloadTypeAbstract):
     """
         INT data encode in x bytes.
@@ -212,13 +257,31 @@ class SMPayloadTypeINT(SMPayloadTypeAbstract):
 
         """
 
+        consumed, data = SMPayloadTypeINT.decode_from(payload, 0, size)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, size=1):
+        """
+            Decode the integer starting at offset
+
+            :Example:
+
+            >>> SMPayloadTypeINT.decode_from(memoryview(b"\\x00\\x01\\x02_"), 1, size=2)
+            (2, 258)
+
+            >>> SMPayloadTypeINT.decode_from(b"\\x01", 1, size=1)
+            (0, None)
+
+        """
+
         if not size:
             size = 1
 
-        if len(payload) < size:
-            return payload, None
+        if len(payload) - offset < size:
+            return 0, None
 
-        return payload[size:], int.from_bytes(payload[:size], byteorder='big')
+        return size, int.from_bytes(payload[offset:offset+size], byteorder='big')
 
 class SMPayloadTypeINTLIST(SMPayloadTypeAbstract):
     """
@@ -281,14 +344,29 @@ class SMPayloadTypeINTLIST(SMPayloadTypeAbstract):
             (b'\\x01', None)
         """
 
+        consumed, data = SMPayloadTypeINTLIST.decode_from(payload, 0, opt)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, opt=None):
+        """
+            Decode the int list starting at offset
+
+            :Example:
+
+            >>> SMPayloadTypeINTLIST.decode_from(memoryview(b"_\\x02\\x05_"), 1, opt=(1, 2))
+            (2, [2, 5])
+        """
+
         if not opt or len(opt) != 2:
             opt = (1, 1)
 
-        if len(payload) < opt[0]*opt[1]:
-            return payload, None
+        size = opt[0]*opt[1]
+        if len(payload) - offset < size:
+            return 0, None
 
-        return payload[opt[0]*opt[1]:], [int.from_bytes(payload[i:i+opt[0]], byteorder='big')
-                                         for i in range(0, opt[0]*opt[1], opt[0])]
+        return size, [int.from_bytes(payload[i:i+opt[0]], byteorder='big')
+                      for i in range(offset, offset + size, opt[0])]
 
 class SMPayloadTypeNT(SMPayloadTypeAbstract):
     """
@@ -332,11 +410,28 @@ class SMPayloadTypeNT(SMPayloadTypeAbstract):
         """
 
 
-        tmp = payload.split(b'\x00', 1)
-        if len(tmp) < 2:
-            return payload, None
+        consumed, data = SMPayloadTypeNT.decode_from(payload, 0, opt)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, opt=None):
+        """
+            Decode the null terminated string starting at offset
+
+            :Example:
+
+            >>> SMPayloadTypeNT.decode_from(memoryview(b"_nt_string\\x00remaining"), 1)
+            (10, 'nt_string')
+
+            >>> SMPayloadTypeNT.decode_from(b"no_null", 0)
+            (0, None)
+        """
+
+        end = _find_nul(payload, offset)
+        if end < 0:
+            return 0, None
 
-        return tmp[1], tmp[0].decode('utf-8')
+        return end + 1 - offset, str(payload[offset:end], 'utf-8')
 
 class SMPayloadTypeNTLIST(SMPayloadTypeAbstract):
     """
@@ -405,20 +500,37 @@ class SMPayloadTypeNTLIST(SMPayloadTypeAbstract):
 
         """
 
-        if size:
-            tmp = payload.split(b'\x00', size)
-        else:
-            tmp = payload.split(b'\x00')
+        consumed, data = SMPayloadTypeNTLIST.decode_from(payload, 0, size)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, size=None):
+        """
+            Decode the list of null terminated strings starting at offset
+
+            :Example:
+
+            >>> SMPayloadTypeNTLIST.decode_from(memoryview(b"_string1\\x00string2\\x00_"), 1, 2)
+            (16, ['string1', 'string2'])
+        """
+
+        res = []
+        start = offset
+        while not size or len(res) < size:
+            end = _find_nul(payload, start)
+            if end < 0:
+                break
 
-        remaining_payload = tmp.pop()
+            res.append(str(payload[start:end], 'utf-8'))
+            start = end + 1
 
-        if size and len(tmp) < size:
-            tmp.extend([b'' for _ in range(size - len(tmp))])
+        if size and len(res) < size:
+            res.extend(['' for _ in range(size - len(res))])
 
-        if not tmp:
-            return payload, None
+        if not res:
+            return 0, None
 
-        return remaining_payload, [t.decode('utf-8') for t in tmp]
+        return start - offset, res
 
 class SMPayloadTypeLIST(SMPayloadTypeAbstract):
     """
@@ -442,15 +554,25 @@ class SMPayloadTypeLIST(SMPayloadTypeAbstract):
 
     @staticmethod
     def decode(payload, opt=None):
+        consumed, data = SMPayloadTypeLIST.decode_from(payload, 0, opt)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, opt=None):
         if not opt:
             opt = [1, []]
 
         res = []
+        start = offset
         for _ in range(0, opt[0]):
-            payload, tmp = SMPacket.decode(payload, opt[1])
+            if start >= len(payload):
+                break
+
+            consumed, tmp = SMPacket.decode_from(payload, start, opt[1])
+            start += consumed
             res.append(tmp)
 
-        return payload, res
+        return start - offset, res
 
 class SMPayloadTypeMAP(SMPayloadTypeAbstract):
     """
@@ -475,11 +597,19 @@ class SMPayloadTypeMAP(SMPayloadTypeAbstract):
         if not opt:
             opt = [0, {}]
 
+        consumed, data = SMPayloadTypeMAP.decode_from(payload, 0, opt)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, opt=None):
+        if not opt:
+            opt = [0, {}]
+
         size, _, sizeopt = opt[1].get(opt[0], (None, None, None))
         if not size:
-            return payload, None
+            return 0, None
 
-        return size.value.decode(payload, sizeopt)
+        return size.value.decode_from(payload, offset, sizeopt)
 
 class SMPayloadTypePacket(SMPayloadTypeAbstract):
     """
@@ -495,14 +625,29 @@ class SMPayloadTypePacket(SMPayloadTypeAbstract):
 
     @staticmethod
     def decode(payload, opt=None):
+        consumed, data = SMPayloadTypePacket.decode_from(payload, 0, opt)
+        return payload[consumed:], data
+
+    @staticmethod
+    def decode_from(payload, offset=0, opt=None):
+        """
+            Decode the packet starting at offset. The number of bytes consumed
+            is given by the packet decoder, the packet is not encoded back.
+
+            :Example:
+
+            >>> SMPayloadTypePacket.decode_from(b'_\\x00\\x00\\x00user\\x00pass\\x00_', 1, SMOPacketClient)
+            (13, <SMOPacketClientLogin player_number="0" encryption="0" username="user" password="pass">)
+        """
+
         if not opt:
             opt = SMPacket
 
-        tmp = opt.parse_data(payload)
-        if not tmp:
-            return payload, None
+        consumed, tmp = opt.parse_data_from(payload, offset)
+        if tmp is None:
+            return 0, None
 
-        return payload[len(tmp.payload):], tmp
+        return consumed, tmp
 
 
 class SMPayloadType(Enum):
@@ -520,7 +665,391 @@ class SMPayloadType(Enum):
     LIST = SMPayloadTypeLIST
     MAP = SMPayloadTypeMAP
 
-class SMPacket(object):
+
+_STRUCT_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+def _has_reference(opt):
+    """
+        Return True if the option may be replaced by a previous value.
+
+        Only strings are replaced by ``SMPacket._replace_from_options``.
+    """
+
+    if isinstance(opt, str):
+        return True
+
+    if isinstance(opt, (tuple, list)):
+        return any(_has_reference(v) for v in opt)
+
+    if isinstance(opt, dict):
+        return any(_has_reference(v) for v in opt.values())
+
+    return False
+
+class _StructStep(object):
+    """
+        Run of fixed width integers and MSN/LSN pairs, packed with a single
+        struct call.
+    """
+
+    def __init__(self):
+        self.fields = []
+        self.sizes = []
+        self.fmt = ">"
+        self.struct = None
+        self.size = 0
+
+    def add_int(self, name, size):
+        self.fields.append((name, None, 2**(size * 8)))
+        self.sizes.append(size)
+        self.fmt += _STRUCT_FORMATS[size]
+
+    def add_nibbles(self, msn, lsn):
+        self.fields.append((msn, lsn, None))
+        self.sizes.append(1)
+        self.fmt += "B"
+
+    def build(self):
+        self.struct = struct.Struct(self.fmt)
+        self.size = self.struct.size
+        return self
+
+    def encode(self, values, parts):
+        args = []
+        for name, lsn, max_size in self.fields:
+            if lsn is None:
+                value = values.get(name) or 0
+                args.append(value if value < max_size else max_size - 1)
+                continue
+
+            msn_value = values.get(name) or 0
+            lsn_value = values.get(lsn) or 0
+            args.append((min(msn_value, 15) << 4) | min(lsn_value, 15))
+
+        parts.append(self.struct.pack(*args))
+
+    def decode(self, payload, offset, opts):
+        if len(payload) - offset < self.size:
+            return self._decode_short(payload, offset, opts)
+
+        for (name, lsn, _), value in zip(self.fields, self.struct.unpack_from(payload, offset)):
+            if lsn is None:
+                opts[name] = value
+                continue
+
+            opts[name] = value >> 4
+            opts[lsn] = value & 0x0F
+
+        return offset + self.size
+
+    def _decode_short(self, payload, offset, opts):
+        """ Field by field decoding, for truncated payload """
+
+        for (name, lsn, _), size in zip(self.fields, self.sizes):
+            if len(payload) - offset < size:
+                opts[name] = None
+                if lsn is not None:
+                    opts[lsn] = None
+                continue
+
+            value = int.from_bytes(payload[offset:offset+size], byteorder='big')
+            offset += size
+            if lsn is None:
+                opts[name] = value
+                continue
+
+            opts[name] = value >> 4
+            opts[lsn] = value & 0x0F
+
+        return offset
+
+class _NTStep(object):
+    """ Null terminated string """
+
+    def __init__(self, name):
+        self.name = name
+
+    def encode(self, values, parts):
+        parts.append(SMPayloadTypeNT.encode(values.get(self.name)))
+
+    def decode(self, payload, offset, opts):
+        end = _find_nul(payload, offset)
+        if end < 0:
+            opts[self.name] = None
+            return offset
+
+        opts[self.name] = str(payload[offset:end], 'utf-8')
+        return end + 1
+
+class _TypeStep(object):
+    """ Any other type, calling the type encoder/decoder directly """
+
+    def __init__(self, size, name, opt):
+        self.type = size.value
+        self.name = name
+        self.opt = opt
+        self.dynamic = _has_reference(opt)
+
+    def resolve(self, values):
+        if not self.dynamic:
+            return self.opt
+
+        return SMPacket._replace_from_options(values, self.opt)
+
+    def encode(self, values, parts):
+        res = self.type.encode(values.get(self.name), self.resolve(values))
+        if res:
+            parts.append(res)
+
+    def decode(self, payload, offset, opts):
+        consumed, opts[self.name] = self.type.decode_from(payload, offset, self.resolve(opts))
+        return offset + consumed
+
+class _IntListStep(_TypeStep):
+    """ Integer list with a fixed integer size """
+
+    def __init__(self, size, name, opt):
+        _TypeStep.__init__(self, size, name, opt)
+        self.int_size = opt[0]
+        self.max_size = 2**(self.int_size * 8)
+        self.fmt = _STRUCT_FORMATS[self.int_size]
+
+    def encode(self, values, parts):
+        _, count = self.resolve(values)
+        if not isinstance(count, int):
+            _TypeStep.encode(self, values, parts)
+            return
+
+        data = values.get(self.name)
+        if not data:
+            data = []
+
+        if len(data) < count:
+            data.extend([0 for _ in range(count - len(data))])
+
+        max_size = self.max_size
+        parts.append(struct.pack(
+            ">%d%s" % (len(data), self.fmt),
+            *[(d if d < max_size else max_size - 1) if d else 0 for d in data]))
+
+    def decode(self, payload, offset, opts):
+        _, count = self.resolve(opts)
+        if not isinstance(count, int):
+            return _TypeStep.decode(self, payload, offset, opts)
+
+        if len(payload) - offset < self.int_size * count:
+            opts[self.name] = None
+            return offset
+
+        opts[self.name] = list(struct.unpack_from(">%d%s" % (count, self.fmt), payload, offset))
+        return offset + self.int_size * count
+
+class _ListStep(_TypeStep):
+    """ List of sub payloads, each one compiled in its own codec """
+
+    def __init__(self, size, name, opt):
+        _TypeStep.__init__(self, size, name, opt)
+        self.codec = SMPacketCodec(opt[1])
+
+    def encode(self, values, parts):
+        count = SMPacket._replace_from_options(values, self.opt[0])
+        if not isinstance(count, int):
+            _TypeStep.encode(self, values, parts)
+            return
+
+        data = values.get(self.name)
+        if not data:
+            data = []
+
+        if len(data) < count:
+            data.extend([{} for _ in range(count - len(data))])
+
+        for value in data:
+            self.codec.encode_into(value, parts)
+
+    def decode(self, payload, offset, opts):
+        count = SMPacket._replace_from_options(opts, self.opt[0])
+        if not isinstance(count, int):
+            return _TypeStep.decode(self, payload, offset, opts)
+
+        res = []
+        for _ in range(count):
+            if offset >= len(payload):
+                break
+
+            offset, value = self.codec.decode_at(payload, offset)
+            res.append(value)
+
+        opts[self.name] = res
+        return offset
+
+class SMPacketCodec(object):
+    """
+        Encoder/decoder compiled from a payload option list.
+
+        Consecutive fixed width INT and MSN/LSN pairs are packed with one
+        struct call, other types are called directly, resolving their option
+        only if it depends on a previous value.
+
+        Raise ValueError if the option list can't be compiled, in that case
+        use ``SMPacket.encode`` and ``SMPacket.decode`` instead.
+
+        :Example:
+
+        >>> codec = SMPacketCodec([
+        ...     (SMPayloadType.MSN, "player_id", None),
+        ...     (SMPayloadType.LSN, "step_id", None),
+        ...     (SMPayloadType.INT, "score", 4),
+        ...     (SMPayloadType.NT, "name", None),
+        ... ])
+        >>> codec.encode({"player_id": 1, "step_id": 4, "score": 42, "name": "abc"})
+        b'\\x14\\x00\\x00\\x00*abc\\x00'
+
+        >>> payload, opts = codec.decode(b'\\x14\\x00\\x00\\x00*abc\\x00remaining')
+        >>> payload
+        b'remaining'
+        >>> sorted(opts.items())
+        [('name', 'abc'), ('player_id', 1), ('score', 42), ('step_id', 4)]
+    """
+
+    def __init__(self, payload_option):
+        self.payload_option = payload_option
+        self.steps = self._compile(payload_option or [])
+
+    @staticmethod
+    def _compile(payload_option):
+        steps = []
+        run = None
+
+        options = list(payload_option)
+        idx = 0
+        while idx < len(options):
+            size, name, opt = options[idx]
+            idx += 1
+
+            if size == SMPayloadType.MSN:
+                if idx >= len(options) or options[idx][0] != SMPayloadType.LSN:
+                    raise ValueError("MSN %s is not followed by a LSN" % name)
+
+                if not run:
+                    run = _StructStep()
+                run.add_nibbles(name, options[idx][1])
+                idx += 1
+                continue
+
+            if size == SMPayloadType.LSN:
+                raise ValueError("LSN %s is not preceded by a MSN" % name)
+
+            if (size == SMPayloadType.INT and (opt is None or isinstance(opt, int))
+                    and (opt or 1) in _STRUCT_FORMATS):
+                if not run:
+                    run = _StructStep()
+                run.add_int(name, opt or 1)
+                continue
+
+            if run:
+                steps.append(run.build())
+                run = None
+
+            if size == SMPayloadType.NT:
+                steps.append(_NTStep(name))
+            elif (size == SMPayloadType.INTLIST and isinstance(opt, (tuple, list))
+                  and len(opt) == 2 and opt[0] in _STRUCT_FORMATS):
+                steps.append(_IntListStep(size, name, opt))
+            elif (size == SMPayloadType.LIST and isinstance(opt, (tuple, list))
+                  and len(opt) == 2 and isinstance(opt[1], list)):
+                steps.append(_ListStep(size, name, opt))
+            else:
+                steps.append(_TypeStep(size, name, opt))
+
+        if run:
+            steps.append(run.build())
+
+        return steps
+
+    @classmethod
+    def compile(cls, payload_option):
+        """
+            Return the codec for the given option list, None if it can't be
+            compiled
+        """
+
+        try:
+            return cls(payload_option)
+        except (ValueError, TypeError, KeyError, IndexError):
+            return None
+
+    def encode_into(self, values, parts):
+        for step in self.steps:
+            step.encode(values, parts)
+
+    def encode(self, values):
+        """ Encode the values into a binary payload """
+
+        parts = []
+        for step in self.steps:
+            step.encode(values, parts)
+
+        return b''.join(parts)
+
+    def decode_at(self, payload, offset):
+        """ Decode the payload starting at offset, return the new offset and the values """
+
+        opts = {}
+        for step in self.steps:
+            offset = step.decode(payload, offset, opts)
+
+        return offset, opts
+
+    def decode(self, payload):
+        """ Decode the payload, return the remaining payload and the values """
+
+        offset, opts = self.decode_at(payload, 0)
+        return payload[offset:], opts
+
+
+class SMPacketMeta(type):
+    """
+        Metaclass of the packets, compile the ``_payload`` of each packet
+        class when the class is created.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        type.__init__(cls, name, bases, attrs)
+
+        cls._codec = SMPacketCodec.compile(cls._payload)
+
+        if attrs.get("command") is not None:
+            _register_packet(cls, override=False)
+
+def _register_packet(klass, override=True):
+    """
+        Register the packet class for its command, in the command family and
+        in all the parent families (SMCommand, SMOCommand, ...).
+    """
+
+    for family in type(klass.command).__mro__:
+        if not isinstance(family, type) or not issubclass(family, ParentCommand):
+            continue
+
+        if family is ParentCommand:
+            break
+
+        key = (family, klass.command.value)
+        if override or key not in _PACKET_CLASSES:
+            _PACKET_CLASSES[key] = klass
+
+    _COMMANDS.clear()
+
+def _packet_class(command):
+    """ Return the packet class registered for this command """
+
+    try:
+        return _PACKET_CLASSES.get((type(command), command.value))
+    except AttributeError:
+        return None
+
+class SMPacket(object, metaclass=SMPacketMeta):
     """
         Main class for declare/parse packet
     """
@@ -572,11 +1101,11 @@ class SMPacket(object):
             <SMPacketServerNSCCM message="msg">
         """
 
-        klasses = [klass for klass in cls.__subclasses__() if klass.command == command]
-        if not klasses:
+        klass = cls.get_class(command)
+        if not klass:
             return None
 
-        return klasses[0](**kwargs)
+        return klass(**kwargs)
 
     @classmethod
     def get_class(cls, command):
@@ -590,11 +1119,38 @@ class SMPacket(object):
             <class 'smserver.smutils.smpacket.SMPacketServerNSCCM'>
         """
 
-        klasses = [klass for klass in cls.__subclasses__() if klass.command == command]
-        if not klasses:
+        klass = _packet_class(command)
+        if not klass or not issubclass(klass, cls):
             return None
 
-        return klasses[0]
+        return klass
+
+    @classmethod
+    def register(cls, klass):
+        """
+            Register a packet class for its command, replacing the class
+            previously registered for this command.
+
+            New subclasses are registered automatically if there is no packet
+            class for their command yet, use this method (or decorator) to
+            replace a packet class in a plugin.
+
+            :Example:
+
+            >>> from smserver.smutils.smpacket import *
+            >>> @SMPacket.register
+            ... class CustomNSCCM(SMPacketServerNSCCM):
+            ...     pass
+            >>> print(SMPacket.get_class(SMServerCommand.NSCCM).__name__)
+            CustomNSCCM
+            >>> _ = SMPacket.register(SMPacketServerNSCCM)
+        """
+
+        if klass.command is None:
+            raise ValueError("Packet class %s has no command" % klass.__name__)
+
+        _register_packet(klass)
+        return klass
 
     @property
     def binarycommand(self):
@@ -669,7 +1225,10 @@ class SMPacket(object):
             b'msg\\x00'
         """
 
-        return self.encode(self.opts, self._payload)
+        if self._codec is None:
+            return self.encode(self.opts, self._payload)
+
+        return self._codec.encode(self.opts)
 
     @property
     def json(self):
@@ -708,7 +1267,17 @@ class SMPacket(object):
             <SMPacketServerNSCCM message="msg">
         """
 
-        return cls(**cls.decode(payload, cls._payload)[1])
+        return cls(**cls._decode_at(payload, 0)[1])
+
+    @classmethod
+    def _decode_at(cls, payload, offset):
+        """ Decode the payload of this packet class starting at offset """
+
+        if cls._codec is None:
+            consumed, opts = cls.decode_from(payload, offset, cls._payload)
+            return offset + consumed, opts
+
+        return cls._codec.decode_at(payload, offset)
 
     @classmethod
     def from_json(cls, payload):
@@ -753,29 +1322,67 @@ class SMPacket(object):
         except ValueError:
             return None
 
-        command = cls._command_type.get(opts.get("_command", -1))
-        if not command:
+        try:
+            klass = _PACKET_CLASSES.get((cls._command_type, opts.get("_command", -1)))
+        except TypeError:
+            return None
+
+        if not klass:
             return None
 
-        return cls.get_class(command).from_json(data)
+        return klass.from_json(data)
 
     @classmethod
     def parse_data(cls, data):
         if not data:
             return None
 
-        command = cls._command_type.get(data[0])
-        if not command:
-            return None
+        return cls.parse_data_from(data, 0)[1]
+
+    @classmethod
+    def parse_data_from(cls, data, offset=0):
+        """
+            Decode the packet (command + payload) starting at offset.
+
+            Return the number of bytes consumed and the packet, (0, None) if
+            the command is unknown.
+
+            :Example:
+
+            >>> from smserver.smutils.smpacket import *
+            >>> SMPacket.parse_data_from(memoryview(b'___\\x87msg\\x00___'), 3)
+            (5, <SMPacketServerNSCCM message="msg">)
+        """
+
+        if len(data) <= offset:
+            return 0, None
 
-        return cls.get_class(command).from_payload(data[1:])
+        klass = _PACKET_CLASSES.get((cls._command_type, data[offset]))
+        if not klass:
+            return 0, None
+
+        end, opts = klass._decode_at(data, offset + 1)
+        return end - offset, klass(**opts)
 
     @classmethod
     def parse_binary(cls, binary):
+        """
+            Decode a full binary packet (size + command + payload).
+
+            Accept bytes, bytearray or memoryview. The payload is decoded in
+            place, without copying it.
+
+            :Example:
+
+            >>> from smserver.smutils.smpacket import *
+            >>> print(SMPacket.parse_binary(memoryview(b'\\x00\\x00\\x00\\x05\\x87msg\\x00')))
+            <SMPacketServerNSCCM message="msg">
+        """
+
         if len(binary) < 4:
             return None
 
-        return cls.parse_data(binary[4:])
+        return cls.parse_data_from(memoryview(binary), 4)[1]
 
     @classmethod
     def encode(cls, values, payload_option):
@@ -803,20 +1410,33 @@ class SMPacket(object):
 
     @classmethod
     def decode(cls, payload, payload_option):
+        consumed, opts = cls.decode_from(payload, 0, payload_option)
+        return payload[consumed:], opts
+
+    @classmethod
+    def decode_from(cls, payload, offset, payload_option):
+        """
+            Decode the payload starting at offset, return the number of bytes
+            consumed and the values.
+        """
+
         opts = {}
+        start = offset
         for size, name, opt in payload_option:
             if size == SMPayloadType.MSN:
-                opts[name] = int(cls._to_bin_str(payload[0], 8)[:4], 2)
+                opts[name] = int(cls._to_bin_str(payload[start], 8)[:4], 2)
                 continue
 
             if size == SMPayloadType.LSN:
-                opts[name] = int(cls._to_bin_str(payload[0], 8)[4:], 2)
-                payload = payload[1:]
+                opts[name] = int(cls._to_bin_str(payload[start], 8)[4:], 2)
+                start += 1
                 continue
 
-            payload, opts[name] = size.value.decode(payload, cls._replace_from_options(opts, opt))
+            consumed, opts[name] = size.value.decode_from(
+                payload, start, cls._replace_from_options(opts, opt))
+            start += consumed
 
-        return payload, opts
+        return start - offset, opts
 
     @classmethod
     def decode_json(cls, payload, payload_option):
@@ -1301,23 +1921,6 @@ class SMPacketClientXMLPacket(SMPacket):
         (SMPayloadType.NT, "xml", None),
     ]
 
-class SMPacketServerNSCPing(SMPacket):
-    """
-        Server command 128 (Ping)
-
-        This command will cause client to respond with a PingR command
-
-        :Example:
-
-        >>> from smserver.smutils import smpacket
-        >>> packet = smpacket.SMPacketServerNSCPing()
-        >>> print(packet.binary)
-        b'\\x00\\x00\\x00\\x01\\x80'
-    """
-
-    command = SMServerCommand.NSCPing
-
-
 class SMPacketClientFLU(SMPacket):
     """
         Client command 16 (FLU)
@@ -0,0 +1,506 @@
+""" SMState module
+
+Share the state of the server between several worker processes.
+
+Each worker keeps its own connections, the state backend forward the
+broadcasted packets to the other workers, and keep track of the room
+membership of every connection.
+
+The default backend (:class:`StateBackend`) is used when the server run in a
+single process: nothing has to be shared. :class:`BrokerStateBackend` connect
+to a :class:`StateBroker` listening on a Unix socket, run by the supervisor
+process.
+"""
+
+import array
+import json
+import logging
+import os
+import socket
+import threading
+from collections import defaultdict
+from contextlib import closing
+
+try:
+    import selectors
+except ImportError:
+    from asyncio import selectors
+
+from smserver.smutils import smframe, smpacket
+
+class StateBackend(object):
+    """
+        Single process backend: there is no other worker to notify.
+
+        :Example:
+
+        >>> state = StateBackend()
+        >>> state.join(1, "token")
+        >>> state.members(1)
+        {'token'}
+        >>> state.leave(1, "token")
+        >>> state.members(1)
+        set()
+    """
+
+    logger = logging.getLogger('stepmania')
+
+    def __init__(self):
+        self.server = None
+        self.worker = None
+        self._rooms = defaultdict(set)
+        self._mutex = threading.Lock()
+
+    def start(self, server):
+        """ Attach the backend to the server receiving the remote packets """
+
+        self.server = server
+
+    def stop(self):
+        """ Detach the backend """
+
+        self.server = None
+
+    def publish(self, target, packet):
+        """
+            Send the packet to the connections matching the target in the
+            other workers.
+
+            :param tuple target: Connections targeted, see
+                :meth:`smserver.smutils.smthread.StepmaniaServer.deliver`
+            :param packet: The packet to send
+        """
+
+        pass
+
+    def join(self, room_id, token):
+        """ Add a connection token to a room """
+
+        with self._mutex:
+            self._rooms[room_id].add(token)
+
+    def leave(self, room_id, token):
+        """ Remove a connection token from a room """
+
+        with self._mutex:
+            self._discard(room_id, token)
+
+    def members(self, room_id):
+        """ Tokens of all the connections in the room, in every worker """
+
+        with self._mutex:
+            return set(self._rooms.get(room_id, ()))
+
+    def room_owner(self, room_id):
+        """
+            Index of the worker running the room, None if there is only one
+            process.
+        """
+
+        return None
+
+    def handoff(self, worker, sock, state):
+        """
+            Hand a client socket to another worker.
+
+            Return False if the worker can't take the connection, which stay
+            in this process.
+        """
+
+        return False
+
+    def _discard(self, room_id, token, rooms=None):
+        if rooms is None:
+            rooms = self._rooms
+
+        tokens = rooms.get(room_id)
+        if tokens is None:
+            return
+
+        tokens.discard(token)
+        if not tokens:
+            del rooms[room_id]
+
+
+def encode_message(message):
+    """
+        Encode a broker message: a size header followed by the JSON data.
+
+        >>> encode_message({"op": "leave", "room": 1, "token": "t"})
+        b'\\x00\\x00\\x00({"op": "leave", "room": 1, "token": "t"}'
+        >>> decode_message(encode_message({"op": "leave", "room": 1, "token": "t"}))
+        {'op': 'leave', 'room': 1, 'token': 't'}
+    """
+
+    data = json.dumps(message, sort_keys=True).encode("utf-8")
+    return smframe.HEADER.pack(len(data)) + data
+
+def decode_message(frame):
+    """ Decode a frame returned by the frame parser """
+
+    return json.loads(str(frame[smframe.HEADER.size:], "utf-8"))
+
+
+class BrokerStateBackend(StateBackend):
+    """
+        Backend of a worker process, connected to the broker of the
+        supervisor on a Unix socket.
+
+        on_close is called if the broker close the connection (when the
+        supervisor exit).
+
+        Each room is run by one worker (``room_id % workers``), the clients
+        entering a room are handed to its worker: their socket is sent with
+        SCM_RIGHTS on the handoff socket of the worker, next to the broker
+        socket.
+    """
+
+    def __init__(self, path, on_close=None, worker=None, workers=1):
+        StateBackend.__init__(self)
+        self.path = path
+        self.on_close = on_close
+        self.worker = worker
+        self.workers = workers
+        self._remote_rooms = defaultdict(set)
+        self._sock = None
+        self._send_mutex = threading.Lock()
+        self._thread = None
+        self._handoff_socket = None
+
+    def start(self, server):
+        StateBackend.start(self, server)
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(self.path)
+
+        self._thread = threading.Thread(target=self._read, name="state-backend")
+        self._thread.daemon = True
+        self._thread.start()
+
+        if self.worker is None or self.workers < 2:
+            return
+
+        path = self._handoff_path(self.worker)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self._handoff_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._handoff_socket.bind(path)
+        self._handoff_socket.listen(128)
+
+        thread = threading.Thread(target=self._accept_handoffs, name="state-handoff")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        StateBackend.stop(self)
+
+        if self._handoff_socket is not None:
+            try:
+                self._handoff_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._handoff_socket.close()
+            self._handoff_socket = None
+
+        if self._sock is None:
+            return
+
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+        self._sock.close()
+        self._sock = None
+
+    def publish(self, target, packet):
+        self._send({"op": "send", "target": list(target), "packet": packet.json})
+
+    def join(self, room_id, token):
+        StateBackend.join(self, room_id, token)
+        self._send({"op": "join", "room": room_id, "token": token})
+
+    def leave(self, room_id, token):
+        StateBackend.leave(self, room_id, token)
+        self._send({"op": "leave", "room": room_id, "token": token})
+
+    def members(self, room_id):
+        with self._mutex:
+            return self._rooms.get(room_id, set()) | self._remote_rooms.get(room_id, set())
+
+    def room_owner(self, room_id):
+        if self.workers < 2 or room_id is None:
+            return None
+
+        return room_id % self.workers
+
+    def handoff(self, worker, sock, state):
+        data = json.dumps(state).encode("utf-8")
+        fds = array.array("i", [sock.fileno()])
+
+        try:
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as channel:
+                channel.connect(self._handoff_path(worker))
+                sent = channel.sendmsg([data], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+                channel.sendall(data[sent:])
+        except OSError as err:
+            self.logger.error("Fail to hand the connection %s to the worker %s: %s",
+                              state.get("ip"), worker, err)
+            return False
+
+        return True
+
+    def _handoff_path(self, worker):
+        return os.path.join(os.path.dirname(self.path), "worker-%s.sock" % worker)
+
+    def _accept_handoffs(self):
+        while True:
+            try:
+                channel, _ = self._handoff_socket.accept()
+            except (OSError, AttributeError):
+                break
+
+            with closing(channel):
+                try:
+                    self._receive_handoff(channel)
+                except Exception: #pylint: disable=broad-except
+                    self.logger.exception("Invalid connection handoff")
+
+    def _receive_handoff(self, channel):
+        fds = array.array("i")
+        data, ancdata, _, _ = channel.recvmsg(65536, socket.CMSG_LEN(fds.itemsize))
+
+        for level, kind, cdata in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - len(cdata) % fds.itemsize])
+
+        if not fds:
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=fds[0])
+
+        try:
+            chunks = [data]
+            while True:
+                chunk = channel.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+
+            state = json.loads(b"".join(chunks).decode("utf-8"))
+        except Exception:
+            sock.close()
+            raise
+
+        if self.server is None:
+            sock.close()
+            return
+
+        self.server.adopt(sock, state)
+
+    def _on_message(self, message):
+        """ Apply a message received from the broker """
+
+        operation = message["op"]
+
+        if operation == "send":
+            if self.server is None:
+                return
+
+            packet = smpacket.SMPacket.parse_json(message["packet"])
+            if packet is not None:
+                self.server.deliver(tuple(message["target"]), packet)
+            return
+
+        # The broker only send the changes made by the other workers
+        with self._mutex:
+            if operation == "sync":
+                self._remote_rooms = defaultdict(set)
+                for room_id, tokens in message["rooms"]:
+                    self._remote_rooms[room_id] = set(tokens)
+            elif operation == "join":
+                self._remote_rooms[message["room"]].add(message["token"])
+            elif operation == "leave":
+                self._discard(message["room"], message["token"], self._remote_rooms)
+
+    def _send(self, message):
+        sock = self._sock
+        if sock is None:
+            return
+
+        with self._send_mutex:
+            try:
+                sock.sendall(encode_message(message))
+            except OSError as err:
+                self.logger.error("Lost connection with the state broker: %s", err)
+
+    def _read(self):
+        parser = smframe.SMFrameParser()
+        sock = self._sock
+
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                break
+
+            if not data:
+                break
+
+            for frame in parser.feed(data):
+                try:
+                    self._on_message(decode_message(frame))
+                except Exception: #pylint: disable=broad-except
+                    self.logger.exception("Invalid message from the state broker")
+
+        self.logger.debug("State broker connection closed")
+
+        if self._sock is not None and self.on_close:
+            self.on_close()
+
+
+class StateBroker(threading.Thread):
+    """
+        Listen on a Unix socket for the workers.
+
+        Forward the packets published by a worker to all the others, and
+        keep the room membership of all the connections. When a worker
+        disconnect, its connections leave their rooms.
+    """
+
+    logger = logging.getLogger('stepmania')
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, name="state-broker")
+        self.daemon = True
+        self.path = path
+
+        self._rooms = defaultdict(set)
+        self._workers = {}
+        self._continue = True
+        self._selector = selectors.DefaultSelector()
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(path)
+        self._socket.listen(128)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+
+    def run(self):
+        self._selector.register(self._socket, selectors.EVENT_READ, None)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ, self._wakeup_r)
+
+        while self._continue:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    self._accept()
+                elif key.data is not self._wakeup_r:
+                    self._read(key.fileobj, key.data)
+
+        for sock in list(self._workers):
+            self._remove(sock)
+
+        self._selector.close()
+        self._socket.close()
+        self._wakeup_r.close()
+        self._wakeup_w.close()
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def stop(self):
+        """ Stop the broker thread """
+
+        self._continue = False
+        self._wakeup_w.send(b'\0')
+
+    def _accept(self):
+        sock, _ = self._socket.accept()
+
+        # Each worker owns the tokens of its connections
+        self._workers[sock] = set()
+        self._selector.register(sock, selectors.EVENT_READ, smframe.SMFrameParser())
+
+        self._send(sock, {
+            "op": "sync",
+            "rooms": [[room_id, sorted(tokens)] for room_id, tokens in self._rooms.items()],
+        })
+
+    def _read(self, sock, parser):
+        try:
+            data = sock.recv(65536)
+        except OSError:
+            data = b''
+
+        if not data:
+            self._remove(sock)
+            return
+
+        for frame in parser.feed(data):
+            self._on_message(sock, frame, decode_message(frame))
+
+    def _on_message(self, sock, frame, message):
+        operation = message.get("op")
+
+        if operation == "join":
+            self._rooms[message["room"]].add(message["token"])
+            self._workers[sock].add((message["room"], message["token"]))
+        elif operation == "leave":
+            self._workers[sock].discard((message["room"], message["token"]))
+            if not self._leave(message["room"], message["token"]):
+                return
+        elif operation != "send":
+            return
+
+        for worker in list(self._workers):
+            if worker is not sock:
+                self._send(worker, frame)
+
+    def _leave(self, room_id, token):
+        """
+            Remove the token from the room, unless another worker still have
+            it (the connection has been handed to this worker).
+
+            Return True if the token has been removed.
+        """
+
+        for memberships in self._workers.values():
+            if (room_id, token) in memberships:
+                return False
+
+        tokens = self._rooms.get(room_id)
+        if tokens is None:
+            return False
+
+        tokens.discard(token)
+        if not tokens:
+            del self._rooms[room_id]
+
+        return True
+
+    def _send(self, sock, message):
+        data = message if isinstance(message, (bytes, memoryview)) else encode_message(message)
+
+        try:
+            sock.sendall(data)
+        except OSError:
+            self._remove(sock)
+
+    def _remove(self, sock):
+        memberships = self._workers.pop(sock, None)
+        if memberships is None:
+            return
+
+        self._selector.unregister(sock)
+        sock.close()
+
+        for room_id, token in memberships:
+            if not self._leave(room_id, token):
+                continue
+
+            message = encode_message({"op": "leave", "room": room_id, "token": token})
+            for worker in list(self._workers):
+                self._send(worker, message)
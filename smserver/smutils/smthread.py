@@ -5,38 +5,174 @@ This module handle the orchestration between all the servers and connections.
 
 
 import sys
+import asyncio
 import datetime
 import logging
+import time
 from threading import Lock
-from collections import defaultdict
+from collections import namedtuple
+from itertools import chain
 
-from smserver.smutils import smpacket
-from smserver.smutils.smconnections import smtcpsocket, udpsocket
+from smserver.smutils import smpacket, smframe, smconn, smstate, smexecutor, smtimer
+from smserver.smutils.smconnections import smtcpsocket, selectorserver, udpsocket
 if sys.version_info[1] > 2:
     from smserver.smutils.smconnections import asynctcpserver, websocket
 
+class RoomIndex(namedtuple("RoomIndex", "members players spectators waiting ingame")):
+    """
+        Snapshot of the connections of a room, split by status.
+
+        * members: all the connections in the room
+        * players: the connections not in spectator mode
+        * spectators: the connections in spectator mode
+        * waiting: the connections waiting for the game to start
+        * ingame: the connections which have send a NSCGSR packet
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def build(cls, members):
+        """ Index the given connections """
+
+        return cls(
+            members=members,
+            players=tuple(conn for conn in members if not conn.spectate),
+            spectators=tuple(conn for conn in members if conn.spectate),
+            waiting=tuple(conn for conn in members if conn.wait_start),
+            ingame=tuple(conn for conn in members if conn.songstats.get("start_at")),
+        )
+
+EMPTY_ROOM = RoomIndex((), (), (), (), ())
+
+PING_PACKET = smpacket.SMPacketServerNSCPing()
+
+class StartBarrier(object):
+    """
+        Wait for the players expected to start a song.
+
+        Each arrival is recorded in constant time, and the barrier is
+        released only once: by the last player expected, or by the timeout.
+
+        >>> barrier = StartBarrier(["conn1", "conn2"])
+        >>> barrier.arrive("conn1")
+        False
+        >>> barrier.arrive("conn2")
+        True
+        >>> barrier.expire()
+        False
+        >>> barrier.arrived
+        ['conn1', 'conn2']
+    """
+
+    def __init__(self, expected):
+        self.expected = frozenset(expected)
+        self.arrived = []
+        self.released = False
+        self.timer = None
+        self._pending = set(self.expected)
+        self._arrived = set()
+        self._mutex = Lock()
+
+    def arrive(self, key):
+        """ Record the arrival of a player, return True if it release the barrier """
+
+        with self._mutex:
+            if self.released or key in self._arrived:
+                return False
+
+            self._arrived.add(key)
+            self.arrived.append(key)
+            self._pending.discard(key)
+            if self._pending:
+                return False
+
+            self.released = True
+            return True
+
+    def expire(self):
+        """ Release the barrier on timeout, return False if already released """
+
+        with self._mutex:
+            if self.released:
+                return False
+
+            self.released = True
+            return True
+
 class StepmaniaServer(object):
     """ Main class of the server """
 
     _logger = logging.getLogger('stepmania')
 
     SERVER_TYPE = {
-        "classic": smtcpsocket.SocketServer,
+        "classic": selectorserver.SelectorServer,
+        "thread": smtcpsocket.SocketServer,
         "udp": udpsocket.UDPServer,
         "async": asynctcpserver.AsyncSocketServer,
         "websocket": websocket.WebSocketServer if sys.version_info[1] > 2 else None
     }
 
-    def __init__(self, servers):
+    # Listeners used when all the servers share the same event loop
+    LOOP_SERVER_TYPE = {
+        "classic": asynctcpserver.AsyncSocketServer,
+        "thread": asynctcpserver.AsyncSocketServer,
+        "udp": udpsocket.AsyncUDPServer,
+        "async": asynctcpserver.AsyncSocketServer,
+        "websocket": websocket.WebSocketServer if sys.version_info[1] > 2 else None
+    }
+
+    def __init__(self, servers, max_frame_size=None, send_buffer=None, shared_loop=False,
+                 reuse_port=False, state=None, handler_threads=0, idle_timeout=None,
+                 max_pending_packets=None):
+        # The registry is copied on write: the writers publish new
+        # snapshots under the mutex, the readers use them without locking.
         self.mutex = Lock()
         self._connections = {}
+        self._connection_list = ()
+
+        self.executor = smexecutor.SerialExecutor(handler_threads)
+        self.max_pending_packets = max_pending_packets
+
+        # Deadline of each connection without activity, once checked
+        self.idle_timeout = idle_timeout
+        self.idle_timers = smtimer.TimerWheel(
+            size=int(idle_timeout) + 2,
+            now=time.monotonic()) if idle_timeout else None
+        self.reaped_connections = 0
+
+        # Encoded ping of each encoding, reused by all the pings sent
+        self._ping_cache = {}
+
+        self.reuse_port = reuse_port
+        self.state = state or smstate.StateBackend()
+
+        self.loop = asyncio.new_event_loop() if shared_loop else None
+
+        self.max_frame_size = max_frame_size or smframe.MAX_FRAME_SIZE
+        self.send_buffer = dict(smconn.SEND_BUFFER, **(send_buffer or {}))
 
         #FIXME: Handle this in a redis server if available
-        self._room_connections = defaultdict(set)
+        self._rooms = {}
+
+        if not self.loop:
+            self._servers = [self.SERVER_TYPE[server_type](self, ip, port)
+                             for ip, port, server_type in servers]
+            return
+
+        listeners = [self.LOOP_SERVER_TYPE[server_type](self, ip, port, loop=self.loop)
+                     for ip, port, server_type in servers]
+        self._servers = [smconn.SMLoopThread(self, self.loop, listeners)]
+
+    @classmethod
+    def can_handoff(cls, server_type, shared_loop=False):
+        """
+            True if the connections of this type of server can be handed to
+            another worker, to follow their room.
+        """
 
-        self._servers = []
-        for ip, port, server_type in servers:
-            self._servers.append(self.SERVER_TYPE[server_type](self, ip, port))
+        types = cls.LOOP_SERVER_TYPE if shared_loop else cls.SERVER_TYPE
+        return hasattr(types.get(server_type), "handoff")
 
     def is_alive(self):
         """ Check if all the thread are still alive """
@@ -50,6 +186,8 @@ class StepmaniaServer(object):
     def start(self):
         """ Start all the server in the list of servers """
 
+        self.state.start(self)
+
         for server in self._servers:
             server.start()
 
@@ -58,81 +196,319 @@ class StepmaniaServer(object):
 
     @property
     def connections(self):
-        """ List al the connections of this server """
+        """ Snapshot of all the connections of this server """
+
+        return self._connection_list
+
+    def _set_connection(self, token, conn):
+        """ Publish a new snapshot of the connections (with the mutex held) """
+
+        connections = dict(self._connections)
+        if conn is None:
+            connections.pop(token, None)
+        else:
+            connections[token] = conn
+
+        self._connections = connections
+        self._connection_list = tuple(connections.values())
+
+    def _set_room_members(self, room_id, members):
+        """ Publish a new snapshot of the rooms (with the mutex held) """
+
+        rooms = dict(self._rooms)
+        if members:
+            rooms[room_id] = RoomIndex.build(members)
+        else:
+            rooms.pop(room_id, None)
+
+        self._rooms = rooms
+
+    def refresh_connection(self, conn):
+        """
+            Update the indexes of the room of the connection, called when its
+            spectate, wait_start or songstats attributes change.
+        """
+
         with self.mutex:
-            return self._connections.values()
+            members = self._rooms.get(conn.room, EMPTY_ROOM).members
+            if conn in members:
+                self._set_room_members(conn.room, members)
+
+    def execute(self, conn, func, *args):
+        """
+            Run func(*args) in the handler threads, after the tasks already
+            queued for this connection (or any other key, like a room).
+        """
+
+        self.executor.submit(conn, func, *args)
+
+    def queue_full(self, conn):
+        """ True if the connection has too many packets waiting to be handled """
+
+        if self.max_pending_packets is None:
+            return False
+
+        return self.executor.pending(conn) >= self.max_pending_packets
 
     def add_connection(self, conn):
         """ Add a new connection to the server """
         self._logger.info("New connection: %s on port %s", conn.ip, conn.port)
 
+        self.register_connection(conn)
+
+    def register_connection(self, conn):
+        """ Add a connection to the connections handled by this process """
+
         with self.mutex:
-            self._connections[conn.token] = conn
+            self._set_connection(conn.token, conn)
+
+        if self.idle_timers is not None:
+            self.idle_timers.add(conn, conn.last_activity + self.idle_timeout)
+
+    def forget_connection(self, conn):
+        """
+            Remove a connection handed to another worker, without
+            disconnecting its users.
+        """
+
+        StepmaniaServer.on_disconnect(self, conn)
+
+    def reap_idle_connections(self, now=None):
+        """
+            Close the connections without any data received for more than
+            idle_timeout seconds, and return them.
+
+            Only the connections whose timer expired are checked: the active
+            ones are scheduled again at their new deadline.
+        """
+
+        if self.idle_timers is None:
+            return []
+
+        if now is None:
+            now = time.monotonic()
+
+        reaped = []
+        for conn in self.idle_timers.expire(now):
+            if self._connections.get(conn.token) is not conn:
+                continue
+
+            # Leave time to the slow connections to answer the last ping
+            deadline = conn.last_activity + self.idle_timeout + conn.latency.timeout
+            if deadline > now:
+                self.idle_timers.add(conn, deadline)
+                continue
+
+            reaped.append(conn)
+
+        for conn in reaped:
+            self._logger.info("connection %s drop: no data received for %s seconds",
+                              conn.ip, self.idle_timeout)
+            conn._abort() #pylint: disable=protected-access
+
+        self.reaped_connections += len(reaped)
+        return reaped
+
+    def listeners(self):
+        """ Iterator of all the listeners, including the ones of a shared loop """
+
+        for server in self._servers:
+            for listener in getattr(server, "listeners", [server]):
+                yield listener
+
+    def route_to_room(self, token, room_id):
+        """
+            In multi-process mode, hand the connection to the worker running
+            the room, once the current packet is handled.
+        """
+
+        worker = self.state.room_owner(room_id)
+        if worker is None or worker == self.state.worker:
+            return
+
+        conn = self.find_connection(token)
+        if conn is None or not conn.HANDOFF:
+            return
+
+        conn.handoff_to = worker
+
+    def adopt(self, sock, state):
+        """ Take a connection handed by another worker """
+
+        for listener in self.listeners():
+            if type(listener).__name__ == state["listener"]:
+                listener.adopt(sock, state)
+                return
+
+        self._logger.error("No listener %s to take the connection %s",
+                           state["listener"], state["ip"])
+        sock.close()
 
     def add_to_room(self, token, room_id):
         """ Add a connection to a new room """
 
         with self.mutex:
-            if token not in self._connections:
+            conn = self._connections.get(token)
+            if conn is None:
                 self._logger.error("Tring to add delete connection %s in a room %s", token, room_id)
                 return None
 
-            conn = self._connections[token]
             conn.room = room_id
 
-            self._room_connections[room_id].add(token)
+            members = self._rooms.get(room_id, EMPTY_ROOM).members
+            if conn not in members:
+                self._set_room_members(room_id, members + (conn,))
+
+        self.state.join(room_id, token)
 
     def del_from_room(self, token, room_id=None):
         """ remove a token from a room """
 
         with self.mutex:
-            if token not in self._connections:
+            conn = self._connections.get(token)
+            if conn is None:
                 self._logger.error("Tring to add delete connection %s in a room %s", token, room_id)
                 return None
 
-            conn = self._connections[token]
             if not room_id:
                 room_id = conn.room
 
-            if token not in self._room_connections[room_id]:
+            members = self._rooms.get(room_id, EMPTY_ROOM).members
+            if conn not in members:
                 return
 
-            self._room_connections[room_id].remove(token)
+            self._set_room_members(room_id, tuple(member for member in members if member is not conn))
             conn.room = None
 
+        self.state.leave(room_id, token)
+
     def find_connection(self, token):
         """ Find the connection where a specific user is """
 
-        with self.mutex:
-            return self._connections.get(token)
+        return self._connections.get(token)
 
     def room_connections(self, room_id):
-        """ Iterator of all the connections in a given room """
-
-        with self.mutex:
-            for token in self._room_connections.get(room_id, ()):
-                if token not in self._connections:
-                    continue
+        """ Snapshot of all the connections in a given room """
 
-                yield self._connections[token]
+        return self._rooms.get(room_id, EMPTY_ROOM).members
 
     def player_connections(self, room_id):
-        """ Iterator of all the connection's player (not spectator) """
+        """ Snapshot of all the connection's player (not spectator) """
 
-        for conn in self.room_connections(room_id):
-            if conn.spectate is True:
-                continue
+        return self._rooms.get(room_id, EMPTY_ROOM).players
 
-            yield conn
+    def spectator_connections(self, room_id):
+        """ Snapshot of all the connections in spectator mode in a given room """
+
+        return self._rooms.get(room_id, EMPTY_ROOM).spectators
+
+    def waiting_connections(self, room_id):
+        """ Snapshot of all the connections waiting for the game to start in a given room """
+
+        return self._rooms.get(room_id, EMPTY_ROOM).waiting
 
     def ingame_connections(self, room_id):
-        """ Iterator of all the connections in a given room which have send a NSCGSR packet """
+        """ Snapshot of all the connections in a given room which have send a NSCGSR packet """
 
-        for conn in self.room_connections(room_id):
-            if not conn.songstats.get("start_at"):
-                continue
+        return self._rooms.get(room_id, EMPTY_ROOM).ingame
+
+    def waiting_rooms(self):
+        """ ID of the rooms where a connection is waiting for the game to start """
 
-            yield conn
+        return [room_id for room_id, index in self._rooms.items() if index.waiting]
+
+    def room_latency(self, room_id):
+        """ Highest round trip time estimated for the players of a room, in seconds """
+
+        return max([conn.latency.rtt or 0 for conn in self.player_connections(room_id)] or [0])
+
+    @staticmethod
+    def release_schedule(connections, now=None):
+        """
+            Plan the sends of a packet to all the connections so they receive
+            it at the same time: each send waits half the difference between
+            the round trip time of the slowest connection and its own.
+
+            Return a list of ``(connection, delay, arrival)``, the slowest
+            connection first, with the arrival estimated on the monotonic
+            clock (now plus half the round trip time of the slowest one).
+
+            >>> from types import SimpleNamespace
+            >>> near = SimpleNamespace(name="near", latency=SimpleNamespace(rtt=0.25))
+            >>> far = SimpleNamespace(name="far", latency=SimpleNamespace(rtt=0.5))
+            >>> [(conn.name, delay, arrival) for conn, delay, arrival
+            ...  in StepmaniaServer.release_schedule([near, far], now=10)]
+            [('far', 0.0, 10.25), ('near', 0.125, 10.25)]
+        """
+
+        if now is None:
+            now = time.monotonic()
+
+        rtts = [(conn, conn.latency.rtt or 0) for conn in connections]
+        slowest = max([rtt for _, rtt in rtts] or [0])
+
+        return [(conn, (slowest - rtt) / 2, now + slowest / 2)
+                for conn, rtt in sorted(rtts, key=lambda item: -item[1])]
+
+    def room_tokens(self, room_id):
+        """ Tokens of all the connections in a given room, in every worker """
+
+        return self.state.members(room_id)
+
+    def deliver(self, target, packet, cache=None):
+        """
+            Send a packet to the connections of this process matching the
+            target, encoding it only once per variant.
+
+            :param tuple target: ``("all",)``, ``("lobby",)``,
+                ``("room", room_id)``, ``("ingame", room_id)``,
+                ``("players", room_id)`` or ``("token", token)``
+            :param packet: The packet to send
+            :type packet: smserver.smutils.smpacket.SMPacket
+            :param dict cache: Encoded packets to reuse, if the same packet
+                is delivered again.
+        """
+
+        kind = target[0]
+        if kind == "all":
+            connections = self.connections
+        elif kind == "lobby":
+            connections = (conn for conn in self.connections if conn.room is None)
+        elif kind == "room":
+            connections = self.room_connections(target[1])
+        elif kind == "ingame":
+            connections = self.ingame_connections(target[1])
+        elif kind == "players":
+            connections = self.player_connections(target[1])
+        elif kind == "token":
+            conn = self.find_connection(target[1])
+            connections = [conn] if conn else []
+        else:
+            return
+
+        if cache is None:
+            cache = {}
+
+        for conn in connections:
+            conn.send(packet, cache)
+
+    def send_ping(self):
+        """
+            Ping all the connections of this process, recording the time to
+            measure their round trip time. The ping is encoded only once.
+        """
+
+        now = time.monotonic()
+        for conn in self.connections:
+            conn.latency.ping_sent(now)
+
+        self.deliver(("all",), PING_PACKET, self._ping_cache)
+
+    def broadcast(self, target, packet):
+        """ Send a packet to the connections matching the target, in every worker """
+
+        self.deliver(target, packet)
+        self.state.publish(target, packet)
 
     def sendconnection(self, token, packet):
         """ Send a packet to the given connection token """
@@ -140,6 +516,9 @@ class StepmaniaServer(object):
         conn = self.find_connection(token)
         if conn:
             conn.send(packet)
+            return
+
+        self.state.publish(("token", token), packet)
 
     def sendall(self, packet):
         """
@@ -149,8 +528,17 @@ class StepmaniaServer(object):
             :type packet: smserver.smutils.smpacket.SMPacket
         """
 
-        for conn in self.connections:
-            conn.send(packet)
+        self.broadcast(("all",), packet)
+
+    def sendlobby(self, packet):
+        """
+            Send a packet to all the connections which are not in a room
+
+            :param packet: The packet to send
+            :type packet: smserver.smutils.smpacket.SMPacket
+        """
+
+        self.broadcast(("lobby",), packet)
 
     def sendroom(self, room_id, packet):
         """
@@ -161,8 +549,7 @@ class StepmaniaServer(object):
             :type packet: smserver.smutils.smpacket.SMPacket
         """
 
-        for conn in self.room_connections(room_id):
-            conn.send(packet)
+        self.broadcast(("room", room_id), packet)
 
     def sendingame(self, room_id, packet):
         """
@@ -173,8 +560,7 @@ class StepmaniaServer(object):
             :type packet: smserver.smutils.smpacket.SMPacket
         """
 
-        for conn in self.ingame_connections(room_id):
-            conn.send(packet)
+        self.broadcast(("ingame", room_id), packet)
 
     def sendplayers(self, room_id, packet):
         """
@@ -187,16 +573,25 @@ class StepmaniaServer(object):
             :type packet: smserver.smutils.smpacket.SMPacket
         """
 
-        for conn in self.player_connections(room_id):
-            conn.send(packet)
+        self.broadcast(("players", room_id), packet)
 
     def on_disconnect(self, conn):
         """ Remove a connection from the list of connections """
 
         with self.mutex:
-            self._connections.pop(conn.token, None)
-            if conn.token in self._connections.get(conn.room, ()):
-                self._connections[conn.room].remove(conn.token)
+            if self._connections.get(conn.token) is conn:
+                self._set_connection(conn.token, None)
+
+                if self.idle_timers is not None:
+                    self.idle_timers.remove(conn)
+
+            members = self._rooms.get(conn.room, EMPTY_ROOM).members
+            if conn not in members:
+                return
+
+            self._set_room_members(conn.room, tuple(member for member in members if member is not conn))
+
+        self.state.leave(conn.room, conn.token)
 
     def on_packet(self, serv, packet):
         """ Action to perform on each new packet """
@@ -204,17 +599,20 @@ class StepmaniaServer(object):
 
 
 class PacketHandler(object):
+    # Handler of each command, built once the class is defined
+    HANDLERS = {}
+
     def __init__(self, server, conn, packet):
         self.server = server
         self.packet = packet
         self.conn = conn
 
     def handle(self):
-        func = getattr(self, "on_%s" % self.packet.command.name.lower(), None)
+        func = self.HANDLERS.get(self.packet.command)
         if not func:
             return None
 
-        func()
+        func(self)
 
     def on_nscping(self):
         self.conn.send(smpacket.SMPacketServerNSCPingR())
@@ -291,3 +689,10 @@ class PacketHandler(object):
 
     def sendroom(self, room, packet):
         self.server.sendroom(room, packet)
+
+
+PacketHandler.HANDLERS = dict(
+    (command, getattr(PacketHandler, "on_%s" % command.name.lower()))
+    for command in chain(smpacket.SMClientCommand, smpacket.SMOClientCommand)
+    if hasattr(PacketHandler, "on_%s" % command.name.lower())
+)
@@ -0,0 +1,255 @@
+""" SMTimer module
+
+Timers of the server: deadlines of the idle connections and periodic tasks.
+"""
+
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+class TimerWheel(object):
+    """
+        Hashed timer wheel.
+
+        Each item is kept in the slot of its deadline, a slot covering
+        ``resolution`` seconds. Expiring the timers only visit the slots
+        elapsed since the previous call, so the work done is proportional
+        to the number of timers expired, whatever the number of items.
+
+        A wheel of ``size`` slots handles the deadlines up to
+        ``size * resolution`` seconds in the future without going around.
+
+        >>> wheel = TimerWheel(resolution=1, size=8)
+        >>> wheel.add("conn1", 2.5)
+        >>> wheel.add("conn2", 4)
+        >>> wheel.expire(2.9)
+        []
+        >>> wheel.expire(3)
+        ['conn1']
+        >>> len(wheel)
+        1
+    """
+
+    def __init__(self, resolution=1.0, size=64, now=0):
+        self.resolution = resolution
+        self._slots = [set() for _ in range(size)]
+        self._timers = {}
+        self._tick = self._tick_of(now)
+        self._mutex = threading.Lock()
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, item):
+        return item in self._timers
+
+    def _tick_of(self, deadline):
+        return int(deadline // self.resolution)
+
+    def add(self, item, deadline):
+        """ Schedule the item for the given deadline, replacing its previous one """
+
+        with self._mutex:
+            self._remove(item)
+
+            # The deadlines already elapsed go in the next slot to expire
+            index = max(self._tick_of(deadline), self._tick) % len(self._slots)
+            self._timers[item] = (deadline, index)
+            self._slots[index].add(item)
+
+    def remove(self, item):
+        """ Cancel the timer of the item, if any """
+
+        with self._mutex:
+            self._remove(item)
+
+    def _remove(self, item):
+        timer = self._timers.pop(item, None)
+        if timer is not None:
+            self._slots[timer[1]].discard(item)
+
+    def expire(self, now):
+        """ Remove and return the items with a deadline in the elapsed slots """
+
+        tick = self._tick_of(now)
+        expired = []
+
+        with self._mutex:
+            # After a long pause, go around the wheel only once
+            end = min(tick, self._tick + len(self._slots))
+            for current in range(self._tick, end):
+                slot = self._slots[current % len(self._slots)]
+
+                # The slot may hold the items of the next turns
+                due = [item for item in slot if self._tick_of(self._timers[item][0]) < tick]
+                for item in due:
+                    slot.discard(item)
+                    del self._timers[item]
+
+                expired.extend(due)
+
+            self._tick = max(tick, self._tick)
+
+        return expired
+
+
+class PeriodicTask(object):
+    """
+        Function run every period seconds (only once without period), with
+        the timings of its runs.
+    """
+
+    def __init__(self, func, period, deadline, name=None):
+        self.func = func
+        self.period = period
+        self.deadline = deadline
+        self.name = name or getattr(func, "__name__", repr(func))
+        self.cancelled = False
+
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.drift = 0
+        self.max_drift = 0
+        self.duration = 0
+        self.max_duration = 0
+        self.total_duration = 0
+
+    def stats(self):
+        """ Timings of the task: number of runs, drift and duration (in seconds) """
+
+        return {
+            "name": self.name,
+            "period": self.period,
+            "runs": self.runs,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "drift": self.drift,
+            "max_drift": self.max_drift,
+            "duration": self.duration,
+            "max_duration": self.max_duration,
+            "mean_duration": self.total_duration / self.runs if self.runs else 0,
+        }
+
+    def cancel(self):
+        """ Don't run the task anymore """
+
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+        Run periodic tasks at their deadline.
+
+        The tasks are kept in a heap ordered by deadline: each call to
+        run_due only runs the tasks due and return the deadline of the next
+        one. A task is scheduled again one period after its previous
+        deadline, so the delays don't accumulate. A task which runs past its
+        next deadline counts as an overrun, and the periods already elapsed
+        are skipped.
+
+        >>> clock = iter([0, 0, 0, 0, 1, 1, 1]).__next__
+        >>> scheduler = Scheduler(clock=clock)
+        >>> task = scheduler.add(lambda: print("tick"), period=1)
+        >>> scheduler.run_due()
+        tick
+        1
+        >>> scheduler.run_due()
+        tick
+        2
+        >>> task.runs
+        2
+    """
+
+    logger = logging.getLogger('stepmania')
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.tasks = []
+        self._heap = []
+        self._counter = itertools.count()
+        self._mutex = threading.Lock()
+
+    def add(self, func, period, delay=0, name=None):
+        """ Run func() every period seconds, the first time after delay seconds """
+
+        task = PeriodicTask(func, period, self.clock() + delay, name)
+        self.tasks.append(task)
+        self._push(task)
+        return task
+
+    def call_later(self, delay, func, *args):
+        """ Run func(*args) once, after delay seconds """
+
+        task = PeriodicTask(functools.partial(func, *args), None, self.clock() + delay,
+                            getattr(func, "__name__", None))
+        self._push(task)
+        return task
+
+    def _push(self, task):
+        with self._mutex:
+            heapq.heappush(self._heap, (task.deadline, next(self._counter), task))
+
+    def _pop_due(self, now):
+        with self._mutex:
+            while self._heap and self._heap[0][0] <= now:
+                _, _, task = heapq.heappop(self._heap)
+                if not task.cancelled:
+                    return task
+
+        return None
+
+    def next_deadline(self):
+        """ Deadline of the next task to run, None without task """
+
+        with self._mutex:
+            return self._heap[0][0] if self._heap else None
+
+    def run_due(self, now=None):
+        """ Run the tasks due, and return the deadline of the next task """
+
+        if now is None:
+            now = self.clock()
+
+        task = self._pop_due(now)
+        while task is not None:
+            self._run(task, now)
+            if task.period is not None:
+                self._push(task)
+
+            now = self.clock()
+            task = self._pop_due(now)
+
+        return self.next_deadline()
+
+    def _run(self, task, start):
+        try:
+            task.func()
+        except Exception: #pylint: disable=broad-except
+            self.logger.exception("Error while running the task %s", task.name)
+
+        end = self.clock()
+
+        task.runs += 1
+        task.drift = start - task.deadline
+        task.max_drift = max(task.max_drift, task.drift)
+        task.duration = end - start
+        task.max_duration = max(task.max_duration, task.duration)
+        task.total_duration += task.duration
+
+        if task.period is None:
+            return
+
+        task.deadline += task.period
+        if task.deadline > end:
+            return
+
+        skipped = int((end - task.deadline) // task.period) + 1
+        task.overruns += 1
+        task.skipped += skipped
+        task.deadline += skipped * task.period
+        self.logger.warning("Task %s late: run for %.3fs, %s runs skipped",
+                            task.name, task.duration, skipped)
@@ -58,6 +58,16 @@ class StepmaniaController(object):
         :rtype: bool
     """
 
+    require_session = True
+    """
+        Specify if the controller use the database. Without it, the
+        controller get no session (None) and is handled without opening one.
+
+        With it, the session is only created when first used.
+
+        :rtype: bool
+    """
+
     def __init__(self, server, conn, packet, session):
         self.server = server
         self.conn = conn
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf8 -*-
+
+"""
+    Multi-process mode.
+
+    The supervisor fork the workers, each one running a full server listening
+    on the same ports with SO_REUSEPORT, so the kernel balance the
+    connections between them. The supervisor initialize the database, owns
+    the systemd notifications and the global periodic tasks, and run the
+    state broker used by the workers to share their state.
+
+    Each room is run by one worker: a client entering a room served by
+    another worker is handed to it (see :mod:`smserver.smutils.smstate`).
+    The state shared by the workers doesn't include the games, so only the
+    servers able to hand their connections (classic, without shared_loop)
+    are supported.
+"""
+
+import logging
+import os
+import shutil
+import signal
+import socket
+import tempfile
+
+from smserver import server
+from smserver.smutils import smstate
+
+class WorkerProcess(object):
+    """ A forked worker, with the same interface than the server threads """
+
+    def __init__(self, config, index, state_path, workers):
+        self.config = config
+        self.index = index
+        self.state_path = state_path
+        self.workers = workers
+        self.pid = None
+        self.status = None
+
+    def start(self):
+        """ Fork and run the worker server in the child process """
+
+        self.pid = os.fork()
+        if self.pid:
+            return
+
+        status = 0
+        try:
+            # Only the supervisor talk to systemd
+            os.environ.pop("NOTIFY_SOCKET", None)
+
+            # Stop with the supervisor
+            state = smstate.BrokerStateBackend(
+                self.state_path,
+                on_close=lambda: os.kill(os.getpid(), signal.SIGTERM),
+                worker=self.index,
+                workers=self.workers)
+
+            worker = server.StepmaniaServer(self.config, role="worker", state=state)
+
+            signal.signal(signal.SIGTERM, lambda *_: worker.stop())
+            worker.log.info("Worker %s started (pid %s)", self.index, os.getpid())
+            worker.start()
+        except Exception: #pylint: disable=broad-except
+            logging.getLogger('stepmania').exception("Worker %s crashed", self.index)
+            status = 1
+        finally:
+            os._exit(status) #pylint: disable=protected-access
+
+    def is_alive(self):
+        """ Check if the worker process is still running """
+
+        if self.pid is None or self.status is not None:
+            return False
+
+        pid, status = os.waitpid(self.pid, os.WNOHANG)
+        if pid == 0:
+            return True
+
+        self.status = status
+        return False
+
+    def stop(self):
+        """ Ask the worker to stop """
+
+        if self.is_alive():
+            os.kill(self.pid, signal.SIGTERM)
+
+    def join(self):
+        """ Wait for the end of the worker process """
+
+        if self.pid is None or self.status is not None:
+            return
+
+        _, self.status = os.waitpid(self.pid, 0)
+
+
+class Supervisor(server.StepmaniaServer):
+    """
+        Server running the workers.
+
+        To start the server in multi-process mode::
+
+            from smserver import conf, supervisor
+
+            config = conf.Conf(*sys.argv[1:])
+
+            supervisor.Supervisor(config, workers=4).start()
+    """
+
+    def __init__(self, config, workers):
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            raise RuntimeError("Multi-process mode is not supported on this platform")
+
+        server.StepmaniaServer.__init__(self, config, role="supervisor")
+
+        self._state_dir = tempfile.mkdtemp(prefix="smserver-")
+        state_path = os.path.join(self._state_dir, "state.sock")
+
+        self.broker = smstate.StateBroker(state_path)
+        self._servers.append(self.broker)
+
+        self.workers = [WorkerProcess(config, idx, state_path, workers)
+                        for idx in range(workers)]
+
+    def is_alive(self):
+        """ Check if the broker and all the workers are still alive """
+
+        if not server.StepmaniaServer.is_alive(self):
+            return False
+
+        for worker in self.workers:
+            if not worker.is_alive():
+                return False
+
+        return True
+
+    def start(self):
+        """ Fork the workers, then start the supervisor threads """
+
+        # The database connections can't be shared with the workers
+        self.db.engine.dispose()
+
+        for worker in self.workers:
+            worker.start()
+
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+
+        server.StepmaniaServer.start(self)
+
+    def stop(self):
+        """ Stop the workers and the supervisor threads """
+
+        for worker in self.workers:
+            worker.stop()
+
+        for worker in self.workers:
+            worker.join()
+
+        server.StepmaniaServer.stop(self)
+
+        shutil.rmtree(self._state_dir, ignore_errors=True)
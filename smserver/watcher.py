@@ -1,25 +1,28 @@
 # -*- coding: utf8 -*-
 
-from threading import Thread, Lock
+from threading import Thread, Event, Lock
+from functools import partial
 import time
-import datetime
-import itertools
 import socket
 
 from smserver import models
-from smserver.smutils import smpacket
-from smserver.chathelper import with_color
-from smserver.controllers.game_start_request import StartGameRequestController
+from smserver.smutils import smpacket, smtimer
 
 class PeriodicMethods(object):
-    """ Decorator to indicate the periodicity of a methods """
+    """
+        Decorator to indicate the period of a methods, in seconds.
+
+        In multi-process mode, the methods flagged with supervisor are run by
+        the supervisor, the others (which use the connections of the process)
+        by each worker.
+    """
 
     def __init__(self):
         self.functions = []
 
-    def __call__(self, period=1):
+    def __call__(self, period=1, supervisor=False):
         def handler(func):
-            self.functions.append((func, period))
+            self.functions.append((func, period, supervisor))
             def wrapper(self, *opts):
                 func(self, *opts)
 
@@ -31,7 +34,11 @@ periodicmethod = PeriodicMethods()
 
 class StepmaniaWatcher(Thread):
     """ Secondary thread, hold by the main server.
-    Call periodically each function with a 'periodicmethod decorator' """
+    Call periodically each function with a 'periodicmethod decorator'
+
+    The scheduler of the watcher only fires the timers: the functions are
+    run by the handler threads, one at a time, each one with a database
+    session opened only if used. """
 
     UDP_PORT = 8765
     UDP_IP = "255.255.255.255"
@@ -40,48 +47,152 @@ class StepmaniaWatcher(Thread):
         Thread.__init__(self)
 
         self.server = server
-        self.fps = self.server.config.server.get("fps", 1)
-        self.mutex = Lock()
+        self.functions = self.role_functions(getattr(server, "role", None))
+        self.scheduler = smtimer.Scheduler()
+        self._tasks = [
+            (func, self.scheduler.add(partial(self.run_function, func), period, name=func.__name__))
+            for func, period in self.functions
+        ]
+
+        # Functions submitted and not yet done, with the timings of their runs
+        self._mutex = Lock()
+        self._running = set()
+        self._timings = dict((func, {
+            "runs": 0, "skipped": 0, "duration": 0, "max_duration": 0, "total_duration": 0,
+        }) for func, _ in self.functions)
+
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         self._continue = True
-
-    def force_run(self):
-        with self.server.db.session_scope() as session:
-            for func, _ in periodicmethod.functions:
+        self._wakeup = Event()
+        self._loop = None
+        self._timer = None
+
+    @staticmethod
+    def role_functions(role):
+        """ Periodic functions to run by a server with the given role """
+
+        return [
+            (func, period) for func, period, supervisor in periodicmethod.functions
+            if role is None or supervisor == (role == "supervisor")
+        ]
+
+    def run_function(self, func):
+        """
+            Submit a periodic function to the handler threads, so the timers
+            never wait for the database. A function still running at its
+            next deadline is skipped.
+        """
+
+        with self._mutex:
+            if func in self._running:
+                self._timings[func]["skipped"] += 1
+                self.server.log.warning("Task %s still running, run skipped", func.__name__)
+                return
+
+            self._running.add(func)
+
+        self.server.execute(self, self._run_function, func)
+
+    def _run_function(self, func):
+        """ Run a periodic function, in its own transaction """
+
+        start = time.monotonic()
+        try:
+            with self.server.db.lazy_session_scope() as session:
                 func(self, session)
+        finally:
+            duration = time.monotonic() - start
+            with self._mutex:
+                self._running.discard(func)
 
-                session.commit()
+                timings = self._timings[func]
+                timings["runs"] += 1
+                timings["duration"] = duration
+                timings["max_duration"] = max(timings["max_duration"], duration)
+                timings["total_duration"] += duration
+
+    def force_run(self):
+        for func, _ in self.functions:
+            self._run_function(func)
+
+    def call_later(self, delay, func, *args):
+        """ Run func(*args) once after delay seconds, from any thread """
+
+        task = self.scheduler.call_later(delay, func, *args)
+
+        # The new task may be due before the one the watcher waits for
+        if self._loop is None:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._tick)
+
+        return task
+
+    def stats(self):
+        """
+            Timings of each periodic function: drift of its deadlines, and
+            duration of its runs in the handler threads.
+        """
+
+        stats = []
+        with self._mutex:
+            for func, task in self._tasks:
+                timings = self._timings[func]
+                task_stats = task.stats()
+                task_stats.update(
+                    runs=timings["runs"],
+                    skipped=timings["skipped"],
+                    duration=timings["duration"],
+                    max_duration=timings["max_duration"],
+                    mean_duration=timings["total_duration"] / timings["runs"] if timings["runs"] else 0)
+                stats.append(task_stats)
+
+        return stats
 
     def run(self):
         self.server.log.debug("Watcher start")
-        func_map = {func: 0 for func, _ in periodicmethod.functions}
 
         while self._continue:
-            with self.server.db.session_scope() as session:
-                for func, period in periodicmethod.functions:
-                    func_map[func] += 1
-                    if func_map[func] < period:
-                        continue
+            deadline = self.scheduler.run_due()
+            if deadline is None:
+                self._wakeup.wait()
+            else:
+                self._wakeup.wait(max(0, deadline - time.monotonic()))
 
-                    func(self, session)
+            self._wakeup.clear()
 
-                    func_map[func] = 0
+        self.server.log.info("Successfully close thread: %s", self)
 
-                    session.commit()
+    def schedule(self, loop):
+        """ Run the periodic functions on the given event loop instead of a thread """
 
-            time.sleep(float(1)/self.fps)
+        self.server.log.debug("Watcher start on the event loop")
 
-        self.server.log.info("Successfully close thread: %s", self)
+        self._loop = loop
+        loop.call_soon_threadsafe(self._tick)
+
+    def _tick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if not self._continue:
+            return
+
+        deadline = self.scheduler.run_due()
+        if deadline is not None:
+            self._timer = self._loop.call_later(max(0, deadline - time.monotonic()), self._tick)
 
     def stop(self):
         """ End the loop """
 
         self.server.log.debug("Closing thread: %s", self)
         self._continue = False
+        self._wakeup.set()
 
-    @periodicmethod(5)
+    @periodicmethod(5, supervisor=True)
     def sdnotify_watchdog(self, _):
         """ Notify systemd that the service is still running """
 
@@ -90,60 +201,32 @@ class StepmaniaWatcher(Thread):
 
         self.server.sd_notify.watchdog()
 
-    @periodicmethod(5)
+    @periodicmethod(5, supervisor=True)
+    def sdnotify_status(self, session):
+        """ Refresh the number of users online in all the workers """
+
+        if self.server.role == "supervisor":
+            self.server.send_sd_running_status(session)
+
+    @periodicmethod(5, supervisor=True)
     def send_udp(self, session):
-        packet = smpacket.SMPacketServerNSCFormatted(
-            server_name=self.server.config.server["name"],
-            server_port=self.server.config.server["port"],
-            nb_players=models.User.nb_onlines(session)
-        )
+        self.server.nb_onlines = models.User.nb_onlines(session)
+        packet, _ = self.server.discovery_packet()
 
         self._sock.sendto(packet.binary, (self.UDP_IP, self.UDP_PORT))
 
     @periodicmethod(1)
     def send_ping(self, session):
-        self.server.sendall(smpacket.SMPacketServerNSCPing())
+        self.server.send_ping()
 
-    @periodicmethod(2)
-    def check_end_game(self, session):
-        sendrooms = False
-        for room in session.query(models.Room).filter_by(status=2):
-            if self.room_still_in_game(room):
-                continue
+    @periodicmethod(1)
+    def reap_idle_connections(self, _):
+        """ Close the connections which stopped to answer the pings """
 
-            self.server.log.info("Room %s finish song, last song: %s" % (room.name, room.active_song_id))
-            room.status = 1
-            room.ingame = False
-
-            game = room.last_game
-            game.end_at = datetime.datetime.now()
-            game.active = False
-            self.server.sendplayers(room.id, game.scoreboard_packet)
-            self.server.send_message(
-                "Game ended %s" % with_color(room.active_song.fullname),
-                room
-            )
-            sendrooms = True
-        if sendrooms:
-            roomspacket = models.Room.smo_list(session)
-            for conn in self.server.connections:
-                if conn.room == None:
-                    conn.send(roomspacket)
-                    self.server.send_user_list_lobby(conn, session)
-
-    def room_still_in_game(self, room):
-        for conn in self.server.player_connections(room.id):
-            if conn.ingame is True:
-                return True
-
-        if room.ingame:
-            return False
-
-        # The game is not starded yet, but no NSCGSR have been sent
-        if datetime.datetime.now() - room.last_game.created_at > datetime.timedelta(seconds=3):
-            return False
-
-        return True
+        reaped = self.server.reap_idle_connections()
+        if reaped:
+            self.server.log.info("%s idle connections closed (%s since the start)",
+                                 len(reaped), self.server.reaped_connections)
 
     @periodicmethod(1)
     def scoreboard_update(self, session):
@@ -198,43 +281,3 @@ class StepmaniaWatcher(Thread):
         packet["section"] = 2
         packet["options"] = [score["grade"] for score in scores]
         self.server.sendingame(room.id, packet)
-
-    @periodicmethod(1)
-    def send_game_start(self, session):
-        conn_in_room = itertools.filterfalse(
-            lambda x: x.room is None or x.spectate is True,
-            self.server.connections)
-
-        conns = sorted(conn_in_room, key=lambda x: x.room)
-        for room_id, room_conns in itertools.groupby(conns, key=lambda x: x.room):
-            if not room_id:
-                continue
-
-            self.check_song_start(session, room_id, room_conns)
-
-    def check_song_start(self, session, room_id, room_conns):
-        room = session.query(models.Room).get(room_id)
-        song = room.active_song
-
-        if room.status != 2:
-            return
-
-        everybody_waiting = True
-        wait_since = None
-        for conn in room_conns:
-            with conn.mutex:
-                if not conn.wait_start:
-                    everybody_waiting = False
-                    continue
-
-                if conn.songs.get(song.id) is False:
-                    continue
-
-                wait_since = conn.songstats.get("start_at", wait_since)
-
-        if everybody_waiting or (
-                wait_since and
-                datetime.datetime.now() - wait_since < datetime.timedelta(seconds=3)):
-
-            StartGameRequestController.launch_song(room, song, self.server)
-
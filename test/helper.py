@@ -19,7 +19,7 @@ class ClientTestBinary(smtcpsocket.SocketConn):
         self._serv.add_connection(self)
         self._on_data(smpacket.SMPacketClientNSCHello(name="stepmania-binary", version=40).binary)
 
-    def send(self, packet):
+    def send(self, packet, cache=None):
         self.packet_send.append(packet)
         return packet
 
@@ -34,7 +34,7 @@ class ClientTestJSON(websocket.WebSocketClient):
         self._serv.add_connection(self)
         self._on_data(smpacket.SMPacketClientNSCHello(name="stepmania-json", version=40).json)
 
-    def send(self, packet):
+    def send(self, packet, cache=None):
         self.packet_send.append(packet)
         return packet
 
@@ -51,6 +51,8 @@ class ServerTest(server.StepmaniaServer):
 
 def get_server_test():
     config = conf.Conf("--update_schema", "-c", "")
+    # Handle the packets inline, the tests check their effects right away
+    config.server["handler_threads"] = 0
 
     return ServerTest(config)
 
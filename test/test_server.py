@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
 # -*- coding: utf8 -*-
 
-from smserver import models, stepmania_controller
+import asyncio
+import contextlib
+import threading
+import time
+import mock
+import pytest
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from smserver import conf, database, models, pluginmanager, stepmania_controller
 from smserver.smutils import smpacket
+from smserver.controllers.game_start_request import StartGameRequestController
 
 from test.helper import *
 
@@ -215,6 +226,22 @@ def test_watcher_game_start(session):
 
     assert not smpacket_in(smpacket.SMPacketServerNSCGSR, client_bin.packet_send)
 
+def test_watcher_handler_threads():
+    """ The periodic functions are submitted to the handler threads, one run at a time """
+
+    watcher = server_test.watcher
+    func = watcher.functions[0][0]
+
+    with mock.patch.object(server_test, "execute") as execute:
+        watcher.run_function(func)
+        watcher.run_function(func)
+
+    execute.assert_called_once_with(watcher, watcher._run_function, func)
+    assert watcher.stats()[0]["skipped"] == 1
+
+    watcher._running.discard(func)
+    watcher._timings[func]["skipped"] = 0
+
 def test_client_bin_game_start_request(session):
     """
         Client-bin send a game start request, wait for client-json
@@ -255,3 +282,321 @@ def test_client_json_game_start_request(session):
     assert client_bin.ingame is True
     assert client_json.ingame is True
 
+
+def test_game_end_event(session):
+    """ The game ends as soon as the last player of the room finish the song """
+
+    client = server_test.add_bin_connection(ip="4.4.4.4")
+
+    song = models.Song(title="Game end", artist="Artist", subtitle="")
+    room = models.Room(name="Room game end", status=2, ingame=True, active_song=song)
+    session.add_all([song, room])
+    session.flush()
+    session.add(models.Game(room_id=room.id, song_id=song.id))
+    session.flush()
+
+    server_test.add_to_room(client.token, room.id)
+    client.ingame = True
+
+    server_test.check_end_game(room)
+    assert room.status == 2
+
+    client.ingame = False
+    server_test.check_end_game(room)
+    assert room.status == 1
+    assert room.ingame is False
+    assert room.last_game.active is False
+    assert [packet for packet in client.packet_send
+            if isinstance(packet, smpacket.SMPacketServerNSCCM) and "Game ended" in packet["message"]]
+
+    # The game is ended only once
+    room.status = 2
+    client.packet_send = []
+    server_test.check_end_game(room)
+    assert client.packet_send == []
+
+    server_test.del_from_room(client.token)
+
+def test_game_start_expired(session):
+    """ A game not started ends once the delay to start the song is over """
+
+    song = models.Song(title="Game not started", artist="Artist", subtitle="")
+    room = models.Room(name="Room game not started", status=2, active_song=song)
+    session.add_all([song, room])
+    session.flush()
+    session.add(models.Game(room_id=room.id, song_id=song.id))
+    session.flush()
+
+    server_test.check_end_game(room)
+    assert room.status == 2
+
+    server_test.check_end_game(room, start_expired=True)
+    assert room.status == 1
+
+def test_start_barrier(session):
+    """ The song starts when the last player expected is ready """
+
+    client1 = server_test.add_bin_connection(ip="5.5.5.5")
+    client2 = server_test.add_bin_connection(ip="5.5.5.6")
+
+    room = models.Room(name="Room start barrier", status=2)
+    session.add(room)
+    session.flush()
+
+    server_test.add_to_room(client1.token, room.id)
+    server_test.add_to_room(client2.token, room.id)
+
+    server_test.open_start_barrier(room, models.Song(id=4242))
+    assert not server_test.ready_to_start(room, client1)
+    assert not server_test.ready_to_start(room, client1)
+    assert server_test.ready_to_start(room, client2)
+    assert not server_test.ready_to_start(room, client2)
+
+    server_test.del_from_room(client1.token)
+    server_test.del_from_room(client2.token)
+
+def test_start_barrier_new_song(session):
+    """ The barrier expects the players having the song selected, even before a flush """
+
+    client1 = server_test.add_bin_connection(ip="5.5.5.9")
+    client2 = server_test.add_bin_connection(ip="5.5.5.10")
+
+    previous_song = models.Song(title="Barrier previous song")
+    song = models.Song(title="Barrier new song")
+    room = models.Room(name="Room start barrier new song", status=2, active_song=previous_song)
+    session.add_all([room, song])
+    session.flush()
+
+    server_test.add_to_room(client1.token, room.id)
+    server_test.add_to_room(client2.token, room.id)
+    client1.songs = {previous_song.id: False, song.id: True}
+    client2.songs = {previous_song.id: True, song.id: False}
+
+    room.active_song = song
+    assert room.active_song_id == previous_song.id
+
+    server_test.open_start_barrier(room, song)
+    assert server_test.ready_to_start(room, client1)
+
+    server_test.del_from_room(client1.token)
+    server_test.del_from_room(client2.token)
+
+def test_start_barrier_replaced(session):
+    """ The timeout of a barrier replaced by a new song selection does nothing """
+
+    room = models.Room(name="Room start barrier replaced", status=2)
+    session.add(room)
+    session.flush()
+
+    song = models.Song(id=4242)
+    with mock.patch.object(server_test.watcher, "call_later") as call_later:
+        server_test.open_start_barrier(room, song)
+        previous = server_test._start_barriers[room.id]
+        server_test.open_start_barrier(room, song)
+
+    previous.timer.cancel.assert_called_once_with()
+    barrier = server_test._start_barriers[room.id]
+    assert barrier is not previous
+
+    server_test._start_timeout(room.id, previous)
+    assert not previous.released
+    assert server_test._start_barriers[room.id] is barrier
+
+    server_test._start_timeout(room.id, barrier)
+    assert barrier.released
+    assert room.id not in server_test._start_barriers
+
+def test_start_release(session):
+    """ The start is sent first to the farthest player, to be received at the same time """
+
+    client1 = server_test.add_bin_connection(ip="5.5.5.7")
+    client2 = server_test.add_bin_connection(ip="5.5.5.8")
+    client1.latency.rtt = 0.5
+    client2.latency.rtt = 0.25
+
+    room = models.Room(name="Room start release", status=2)
+    song = models.Song(title="Start release song")
+    session.add_all([room, song])
+    session.flush()
+
+    for client in (client1, client2):
+        server_test.add_to_room(client.token, room.id)
+        client.songstats = {"start_at": time.monotonic()}
+
+    with mock.patch.object(server_test.watcher, "call_later") as call_later:
+        StartGameRequestController.launch_song(room, song, server_test)
+
+    assert client1.packet_send[-1].command == smpacket.SMServerCommand.NSCGSR
+    call_later.assert_called_once_with(0.125, client2.send, client1.packet_send[-1], mock.ANY)
+    assert client1.songstats["start_at"] == client2.songstats["start_at"]
+    assert client1.ingame and client2.ingame
+
+    server_test.del_from_room(client1.token)
+    server_test.del_from_room(client2.token)
+
+def test_shared_loop_sessions(tmpdir):
+    """ On a shared loop, the tasks using the database run in the handler threads """
+
+    config = conf.Conf("--update_schema", "-c", "")
+    config.database["database"] = str(tmpdir.join("shared_loop.db"))
+    config.server["shared_loop"] = True
+    config.server["handler_threads"] = 2
+    config.server["start_timeout"] = 0
+    serv = ServerTest(config)
+
+    threads = []
+    sessionmaker = serv.db.session
+
+    def session_factory():
+        threads.append(threading.get_ident())
+        return sessionmaker
+
+    with mock.patch.object(database.DataBase, "session", new_callable=mock.PropertyMock) as factory:
+        factory.side_effect = session_factory
+
+        serv.watcher.schedule(serv.loop)
+        serv.open_start_barrier(mock.Mock(id=4242), mock.Mock(id=4242))
+
+        # The start timeout run after the first periodic tasks
+        deadline = time.monotonic() + 5
+        while 4242 in serv._start_barriers and time.monotonic() < deadline:
+            serv.loop.run_until_complete(asyncio.sleep(0.01))
+
+        serv.watcher.stop()
+        serv.executor.shutdown()
+
+    serv.loop.close()
+
+    assert threads
+    assert threading.get_ident() not in threads
+
+def test_supervisor_handoff(tmpdir):
+    """ The workers are only started if the connections can follow their room """
+
+    from smserver.supervisor import Supervisor
+
+    config = conf.Conf("-c", "")
+    config.database["database"] = str(tmpdir.join("supervisor.db"))
+    config.server["type"] = "async"
+
+    with pytest.raises(RuntimeError):
+        Supervisor(config, 2)
+
+def test_send_later_slow_task(tmpdir):
+    """ The delayed sends don't wait for a slow periodic function """
+
+    config = conf.Conf("--update_schema", "-c", "")
+    config.database["database"] = str(tmpdir.join("send_later.db"))
+    config.server["handler_threads"] = 2
+    serv = ServerTest(config)
+
+    blocked = threading.Event()
+    release = threading.Event()
+    sent = threading.Event()
+
+    @contextlib.contextmanager
+    def slow_session():
+        blocked.set()
+        release.wait(5)
+        yield mock.Mock()
+
+    conn = mock.Mock()
+    conn.send.side_effect = lambda *args: sent.set()
+
+    with mock.patch.object(serv.db, "lazy_session_scope", slow_session):
+        serv.watcher.start()
+        try:
+            assert blocked.wait(5)
+
+            serv.send_later(0.05, conn, smpacket.SMPacketServerNSCGSR())
+            assert sent.wait(1)
+        finally:
+            release.set()
+            serv.watcher.stop()
+            serv.watcher.join()
+            serv.executor.shutdown()
+
+def test_discovery(session):
+    """ The discovery answer is only rebuilt when the number of players change """
+
+    client_bin._on_data(smpacket.SMPacketClientNSCFormatted().binary)
+    packet = client_bin.packet_send[-1]
+
+    assert packet.command == smpacket.SMServerCommand.NSCFormatted
+    assert packet["nb_players"] == models.User.nb_onlines(session)
+
+    client_bin._on_data(smpacket.SMPacketClientNSCFormatted().binary)
+    assert client_bin.packet_send[-1] is packet
+
+    server_test.nb_onlines += 1
+    client_bin._on_data(smpacket.SMPacketClientNSCFormatted().binary)
+    assert client_bin.packet_send[-1]["nb_players"] == packet["nb_players"] + 1
+    server_test.nb_onlines -= 1
+
+def test_packets_without_session():
+    """ The packets handled in memory don't open a database session """
+
+    stats = dict.fromkeys(
+        ("offsetacum", "toasties", "perfect_combo", "dp", "migsp", "holds", "taps", "jumps", "hands"), 0)
+    stats.update({"data": [], "extranotes": [], "best_score": None, "player_name": "clientbin-user1"})
+    client_bin.songstats = {0: stats, "start_at": time.monotonic()}
+
+    with mock.patch("smserver.database.DataBase.session", new_callable=mock.PropertyMock) as factory:
+        client_bin._on_data(smpacket.SMPacketClientNSCPing().binary)
+        client_bin._on_data(smpacket.SMPacketClientNSCFormatted().binary)
+        client_bin._on_data(smpacket.SMPacketClientNSCGSU(
+            player_id=0, step_id=7, grade=0, score=1000, combo=1,
+            health=100, offset=32768, note_size=1
+        ).binary)
+
+    assert not factory.called
+    assert client_bin.songstats[0]["data"][-1]["score"] == 1000
+
+def test_login_single_commit():
+    """ The handlers of a packet write their changes in a single transaction """
+
+    client = server_test.add_bin_connection(ip="3.3.3.3")
+    server_test.auth.login("commit-user", "test")
+
+    flushed = set()
+    commits = []
+    on_flush = lambda session, context: flushed.add(session)
+    on_commit = lambda session: commits.append(session) if session in flushed else None
+
+    event.listen(Session, "after_flush", on_flush)
+    event.listen(Session, "after_commit", on_commit)
+    try:
+        client._on_data(smpacket.SMPacketClientNSSMONL(
+            packet=smpacket.SMOPacketClientLogin(username="commit-user", password="test", player_number=0)
+        ).binary)
+    finally:
+        event.remove(Session, "after_flush", on_flush)
+        event.remove(Session, "after_commit", on_commit)
+
+    assert len(client.users) == 1
+    assert len(commits) == 1
+
+def test_handlers_table():
+    """ The handlers of each command are computed once, and swapped on reload """
+
+    handlers = server_test.handlers
+    hello = handlers[smpacket.SMClientCommand.NSCHello]
+    assert isinstance(hello, tuple)
+    assert [owner.__name__ for _, _, owner in hello] == ["HelloController"]
+
+    server_test.reload()
+    assert server_test.handlers is not handlers
+    assert server_test.handlers.keys() == handlers.keys()
+
+def test_plugin_hooks():
+    """ The hooks inherited from StepmaniaPlugin are not dispatched """
+
+    class Plugin(pluginmanager.StepmaniaPlugin):
+        def on_nscgsu(self, session, serv, packet):
+            pass
+
+    plugin = Plugin(server_test)
+    handlers = server_test._init_handlers({}, [plugin])
+
+    assert set(handlers) == {smpacket.SMClientCommand.NSCGSU, smpacket.SMClientCommand.NSSMONL}
+    assert handlers[smpacket.SMClientCommand.NSCGSU] == ((plugin.on_nscgsu, True, Plugin),)
@@ -0,0 +1,71 @@
+""" Test the selector based classic server """
+
+import socket
+import time
+import unittest
+
+from smserver.smutils import smpacket, smthread
+
+
+class EchoServer(smthread.StepmaniaServer):
+    def on_packet(self, serv, packet):
+        serv.send(smpacket.SMPacketServerNSCCM(message=packet["message"]))
+
+
+class SelectorServerTest(unittest.TestCase):
+    """ Test many clients served by a single thread """
+
+    def setUp(self):
+        self.server = EchoServer([("127.0.0.1", 0, "classic")])
+        self.listener = self.server._servers[0]
+        self.listener.start()
+        self.port = self.listener._socket.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.stop()
+        self.listener.join(5)
+
+    def test_echo(self):
+        clients = [socket.create_connection(("127.0.0.1", self.port)) for _ in range(20)]
+
+        for idx, client in enumerate(clients):
+            packet = smpacket.SMPacketClientNSCCM(message="message %s" % idx)
+            client.sendall(packet.binary[:3])
+            client.sendall(packet.binary[3:])
+
+        for idx, client in enumerate(clients):
+            client.settimeout(5)
+            packet = smpacket.SMPacket.parse_binary(client.recv(8192))
+            self.assertEqual(packet["message"], "message %s" % idx)
+
+        self.assertEqual(len(self.listener.clients), 20)
+        self.assertEqual(len(list(self.server.connections)), 20)
+
+        for client in clients:
+            client.close()
+
+    def test_disconnect(self):
+        client = socket.create_connection(("127.0.0.1", self.port))
+        client.sendall(smpacket.SMPacketClientNSCCM(message="msg").binary)
+        client.settimeout(5)
+        client.recv(8192)
+
+        client.close()
+        for _ in range(50):
+            if not self.listener.clients:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(self.listener.clients, {})
+        self.assertEqual(list(self.server.connections), [])
+
+    def test_stop(self):
+        client = socket.create_connection(("127.0.0.1", self.port))
+        client.settimeout(5)
+
+        self.listener.stop()
+        self.listener.join(5)
+
+        self.assertFalse(self.listener.is_alive())
+        self.assertEqual(client.recv(8192), b'')
+        client.close()
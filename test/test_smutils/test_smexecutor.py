@@ -0,0 +1,74 @@
+""" Test SMExecutor module """
+
+import threading
+import unittest
+
+from smserver.smutils import smexecutor
+
+
+class SerialExecutorTest(unittest.TestCase):
+    """ Test the executor running the packet handlers """
+
+    def setUp(self):
+        self.executor = smexecutor.SerialExecutor(4)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_order(self):
+        """ The tasks of a key run one at a time, in order """
+
+        handled = {"conn1": [], "conn2": []}
+        for idx in range(200):
+            for key in handled:
+                self.executor.submit(key, handled[key].append, idx)
+
+        self.executor.shutdown()
+        for values in handled.values():
+            self.assertEqual(values, list(range(200)))
+
+    def test_slow_task(self):
+        """ A slow task only delay the tasks of the same key """
+
+        release = threading.Event()
+        done = threading.Event()
+        handled = []
+
+        self.executor.submit("slow", release.wait, 5)
+        self.executor.submit("slow", handled.append, "slow")
+        self.executor.submit("fast", done.set)
+
+        self.assertTrue(done.wait(5))
+        self.assertEqual(handled, [])
+
+        release.set()
+        self.executor.shutdown()
+        self.assertEqual(handled, ["slow"])
+
+    def test_pending(self):
+        """ Count the tasks of a key waiting to be run """
+
+        release = threading.Event()
+        started = threading.Event()
+
+        self.executor.submit("conn", lambda: started.set() or release.wait(5))
+        self.assertTrue(started.wait(5))
+
+        self.executor.submit("conn", release.wait, 5)
+        self.executor.submit("conn", release.wait, 5)
+        self.assertEqual(self.executor.pending("conn"), 2)
+        self.assertEqual(self.executor.pending("other"), 0)
+
+        release.set()
+        self.executor.shutdown()
+        self.assertEqual(self.executor.pending("conn"), 0)
+
+    def test_error(self):
+        """ An error doesn't stop the next tasks """
+
+        handled = []
+        self.executor.submit("conn", lambda: 1 / 0)
+        self.executor.submit("conn", handled.append, 1)
+
+        self.executor.shutdown()
+        self.assertEqual(handled, [1])
@@ -0,0 +1,135 @@
+""" Test SMFrame module """
+
+import socket
+import unittest
+import mock
+
+from smserver.smutils import smframe, smpacket, smthread
+from smserver.smutils.smconnections import smtcpsocket
+
+
+class SMFrameParserTest(unittest.TestCase):
+    """ Test the incremental frame parser """
+
+    def setUp(self):
+        self.packets = [
+            smpacket.SMPacketServerNSCCM(message="message"),
+            smpacket.SMPacketServerNSCPing(),
+            smpacket.SMPacketServerNSCCM(message="m" * 20000),
+        ]
+        self.stream = b"".join(packet.binary for packet in self.packets)
+
+    def test_one_read(self):
+        """ Many frames in one read """
+
+        parser = smframe.SMFrameParser()
+        self.assertEqual(
+            parser.feed(self.stream),
+            [packet.binary for packet in self.packets])
+        self.assertEqual(len(parser), 0)
+
+    def test_no_copy(self):
+        """ The frames of a read are views of the data received """
+
+        parser = smframe.SMFrameParser()
+        frames = parser.feed(self.stream)
+        for frame in frames:
+            self.assertIsInstance(frame, memoryview)
+            self.assertIs(frame.obj, self.stream)
+
+        # The frames stay valid once the next data are received
+        parser.feed(self.stream[:10])
+        self.assertEqual(frames, [packet.binary for packet in self.packets])
+
+    def test_fragmented(self):
+        """ Frames split in reads of any size, even smaller than the header """
+
+        for chunk_size in (1, 3, 5, 4096):
+            parser = smframe.SMFrameParser()
+            frames = []
+            for idx in range(0, len(self.stream), chunk_size):
+                frames.extend(parser.feed(self.stream[idx:idx+chunk_size]))
+
+            self.assertEqual(frames, [packet.binary for packet in self.packets])
+            self.assertEqual(len(parser), 0)
+
+    def test_max_frame_size(self):
+        """ A frame bigger than the limit is refused before being buffered """
+
+        parser = smframe.SMFrameParser(max_frame_size=100)
+        self.assertEqual(parser.feed(self.packets[0].binary), [self.packets[0].binary])
+
+        with self.assertRaises(smframe.SMFrameError):
+            parser.feed(self.packets[2].binary[:10])
+
+        self.assertEqual(len(parser), 0)
+
+
+class SocketConnFramingTest(unittest.TestCase):
+    """ Test the framing of the classic TCP connection """
+
+    def test_received_data(self):
+        server = smthread.StepmaniaServer([], max_frame_size=100)
+        client_sock, server_sock = socket.socketpair()
+        conn = smtcpsocket.SocketConn(server, "127.0.0.1", 4444, server_sock)
+
+        packet = smpacket.SMPacketClientNSCCM(message="msg")
+        client_sock.sendall(packet.binary[:2])
+        received = conn.received_data()
+        client_sock.sendall(packet.binary[2:] + packet.binary)
+
+        self.assertEqual(next(received), packet.binary)
+        self.assertEqual(next(received), packet.binary)
+
+        client_sock.sendall(smpacket.SMPacketClientNSCCM(message="m" * 200).binary)
+        self.assertIsNone(next(received))
+
+        client_sock.close()
+        server_sock.close()
+
+
+class SendmsgTest(unittest.TestCase):
+    """ Test the scatter-gather writes of the classic TCP connection """
+
+    def test_partial_send(self):
+        sock = mock.Mock()
+        sock.sendmsg.side_effect = [3, 2, 4]
+
+        smtcpsocket.sendmsg_all(sock, [b"\x00\x00\x00\x01", b"\x80", b"abcd"])
+
+        sent = [[bytes(chunk) for chunk in call[0][0]] for call in sock.sendmsg.call_args_list]
+        self.assertEqual(sent, [
+            [b"\x00\x00\x00\x01", b"\x80", b"abcd"],
+            [b"\x01", b"\x80", b"abcd"],
+            [b"abcd"],
+        ])
+
+    def test_send_left(self):
+        """ The data left by a partial write are sent once the socket is writable """
+
+        server = smthread.StepmaniaServer([])
+        client_sock, server_sock = socket.socketpair()
+        server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        conn = smtcpsocket.SocketConn(server, "127.0.0.1", 4444, server_sock)
+
+        packet = smpacket.SMPacketServerNSCCM(message="m" * 200000)
+        conn.send(packet)
+        self.assertTrue(conn._unsent)
+
+        client_sock.settimeout(5)
+        parser = smframe.SMFrameParser()
+        frames = []
+        while not frames:
+            frames = parser.feed(client_sock.recv(65536))
+
+        self.assertEqual(frames, [packet.binary])
+
+        client_sock.close()
+        server_sock.close()
+
+    def test_would_block(self):
+        sock = mock.Mock()
+        sock.sendmsg.side_effect = [5, BlockingIOError]
+
+        unsent = smtcpsocket.sendmsg_all(sock, [b"\x00\x00\x00\x01", b"\x80", b"abcd"])
+        self.assertEqual([bytes(chunk) for chunk in unsent], [b"abcd"])
@@ -0,0 +1,66 @@
+""" Test SMLatency module """
+
+import unittest
+
+from smserver.smutils import smlatency
+
+
+class LatencyStatsTest(unittest.TestCase):
+    """ Test the round trip time measured with the pings """
+
+    def setUp(self):
+        self.stats = smlatency.LatencyStats()
+
+    def ping(self, sent, received):
+        self.stats.ping_sent(sent)
+        return self.stats.pong_received(received)
+
+    def test_no_sample(self):
+        """ Without answer, there is no estimate """
+
+        self.assertIsNone(self.stats.pong_received(10))
+        self.assertIsNone(self.stats.rtt)
+        self.assertIsNone(self.stats.percentile(50))
+        self.assertEqual(self.stats.timeout, 0)
+        self.assertEqual(str(self.stats), "no ping answered")
+
+    def test_moving_average(self):
+        """ The estimate follow the samples slowly """
+
+        self.assertEqual(self.ping(0, 0.1), 0.1)
+        for idx in range(1, 50):
+            self.ping(idx, idx + 0.2)
+
+        self.assertAlmostEqual(self.stats.rtt, 0.2, places=2)
+        self.assertLess(self.stats.rttvar, 0.01)
+        self.assertEqual(self.stats.samples, 50)
+
+    def test_answers_order(self):
+        """ The answers are matched with the pings in order """
+
+        self.stats.ping_sent(1)
+        self.stats.ping_sent(2)
+
+        self.assertEqual(self.stats.pong_received(2.5), 1.5)
+        self.assertEqual(self.stats.pong_received(2.5), 0.5)
+
+    def test_lost_pings(self):
+        """ Only the latest pings without answer are kept """
+
+        for idx in range(20):
+            self.stats.ping_sent(idx)
+
+        self.assertEqual(self.stats.pong_received(20), 20 - 12)
+
+    def test_histogram(self):
+        """ The samples are counted in the bucket of their duration """
+
+        self.ping(0, 0.005)
+        self.ping(1, 1.03)
+        self.ping(2, 2.04)
+        self.ping(3, 5)
+
+        self.assertEqual(self.stats.histogram, [1, 0, 2, 0, 0, 0, 0, 1])
+        self.assertEqual(self.stats.percentile(50), 50)
+        self.assertEqual(self.stats.percentile(25), 10)
+        self.assertEqual(self.stats.percentile(95), float("inf"))
@@ -0,0 +1,172 @@
+""" Test SMPacket module """
+
+import unittest
+import mock
+
+from smserver.smutils import smpacket
+
+
+class SMPacketCodecTest(unittest.TestCase):
+    """ Test the compiled packet codecs """
+
+    packets = [
+        smpacket.SMPacketClientNSCGSU(
+            player_id=1, step_id=4, grade=2, note_size=1,
+            score=123456, combo=42, health=3, offset=32000),
+        smpacket.SMPacketClientNSCGSR(
+            first_player_feet=12, second_player_feet=8,
+            song_title="title", song_subtitle="subtitle", rate=100),
+        smpacket.SMPacketServerNSCGON(
+            nb_players=2, ids=[5, 2], score=[1550, 1786], options=["a", "b"]),
+        smpacket.SMPacketServerNSCCUUL(
+            max_players=255, nb_players=2,
+            players=[{"status": 5, "name": "machin"}, {"status": 1, "name": "bidule"}]),
+        smpacket.SMPacketServerNSCGSU(section=1, nb_players=3, options=[1, 3, 5]),
+        smpacket.SMPacketServerNSSMONL(
+            packet=smpacket.SMOPacketServerRoomInfo(
+                song_title="song_title", num_players=2, players=["bidule", "truc"])),
+        smpacket.SMPacketServerNSCHello(version=128, name="server", key=5165165),
+    ]
+
+    def test_compiled(self):
+        """ Every packet class of the module is compiled """
+
+        for klass in vars(smpacket).values():
+            if isinstance(klass, type) and issubclass(klass, smpacket.SMPacket):
+                self.assertIsNotNone(klass._codec, klass)
+
+    def test_encode(self):
+        """ Compiled encoder and interpreter give the same payload """
+
+        for packet in self.packets:
+            self.assertEqual(
+                packet._codec.encode(packet.opts),
+                packet.encode(packet.opts, packet._payload))
+
+    def test_decode(self):
+        """ Compiled decoder and interpreter give the same values """
+
+        for packet in self.packets:
+            payload = packet.payload + b"remaining"
+            remaining, opts = packet._codec.decode(payload)
+            expected_remaining, expected_opts = packet.decode(payload, packet._payload)
+
+            self.assertEqual(remaining, expected_remaining)
+            self.assertEqual(
+                sorted((k, str(v)) for k, v in opts.items()),
+                sorted((k, str(v)) for k, v in expected_opts.items()))
+
+    def test_decode_memoryview(self):
+        """ Decode in place from a memoryview, at an offset """
+
+        for packet in self.packets:
+            payload = memoryview(b"prefix" + packet.payload + b"remaining")
+
+            offset, opts = packet._codec.decode_at(payload, 6)
+            consumed, expected_opts = packet.decode_from(payload, 6, packet._payload)
+            remaining, _ = packet.decode(bytes(payload[6:]), packet._payload)
+
+            self.assertEqual(offset, 6 + consumed)
+            self.assertEqual(consumed, len(payload) - 6 - len(remaining))
+            self.assertEqual(
+                sorted((k, str(v)) for k, v in opts.items()),
+                sorted((k, str(v)) for k, v in expected_opts.items()))
+
+    def test_parse_binary(self):
+        """ Parse binary packets from bytes, bytearray and memoryview """
+
+        for packet in self.packets:
+            binary = packet.binary
+            expected = str(smpacket.SMPacket.parse_data(binary[4:]))
+            for data in (binary, bytearray(binary), memoryview(binary)):
+                self.assertEqual(str(smpacket.SMPacket.parse_binary(data)), expected)
+
+    def test_nested_packet(self):
+        """ Nested packets are decoded without being encoded back """
+
+        packet = smpacket.SMPacketClientNSSMONL(
+            packet=smpacket.SMOPacketClientLogin(username="user", password="pass"))
+        binary = packet.binary
+
+        with mock.patch.object(smpacket.SMPacketCodec, "encode") as encode:
+            res = smpacket.SMPacket.parse_binary(binary)
+            self.assertFalse(encode.called)
+
+        self.assertEqual(res["packet"]["username"], "user")
+        self.assertEqual(res["packet"]["password"], "pass")
+
+        consumed, value = smpacket.SMPayloadTypePacket.decode_from(
+            binary + b"remaining", 5, smpacket.SMOPacketClient)
+        self.assertEqual(consumed, len(binary) - 5)
+        self.assertEqual(value["username"], "user")
+
+    def test_nibbles_overflow(self):
+        """ Nibbles are limited to 4 bits """
+
+        codec = smpacket.SMPacketCodec([
+            (smpacket.SMPayloadType.MSN, "msn", None),
+            (smpacket.SMPayloadType.LSN, "lsn", None),
+        ])
+
+        self.assertEqual(codec.encode({"msn": 20, "lsn": 3}), b'\xf3')
+
+    def test_truncated_payload(self):
+        """ Missing integers are decoded as None """
+
+        packet = self.packets[0]
+        self.assertEqual(
+            packet._codec.decode(packet.payload[:3]),
+            packet.decode(packet.payload[:3], packet._payload))
+
+    def test_not_compilable(self):
+        """ Fallback on the interpreter for unpaired nibbles """
+
+        self.assertIsNone(smpacket.SMPacketCodec.compile([
+            (smpacket.SMPayloadType.MSN, "msn", None),
+        ]))
+
+
+class SMPacketRegistryTest(unittest.TestCase):
+    """ Test the command to packet class registry """
+
+    def test_get_class(self):
+        """ Find the packet class of a command """
+
+        self.assertIs(
+            smpacket.SMPacket.get_class(smpacket.SMClientCommand.NSCGSU),
+            smpacket.SMPacketClientNSCGSU)
+
+        self.assertIs(
+            smpacket.SMOPacketClient.get_class(smpacket.SMOClientCommand.LOGIN),
+            smpacket.SMOPacketClientLogin)
+
+        self.assertIsNone(
+            smpacket.SMOPacketClient.get_class(smpacket.SMClientCommand.NSCGSU))
+
+    def test_parse_unknown_command(self):
+        """ Unknown commands are dropped """
+
+        self.assertIsNone(smpacket.SMPacket.parse_data(b'\x7f'))
+        self.assertIsNone(smpacket.SMPacket.parse_json('{"_command": 127}'))
+        self.assertIsNone(smpacket.SMPacket.parse_json('{"_command": [1]}'))
+
+    def test_register(self):
+        """ A plugin can replace a packet class """
+
+        class CustomPacket(smpacket.SMPacketClientNSCCM):
+            pass
+
+        packet = smpacket.SMPacketClientNSCCM(message="msg")
+
+        self.assertIsInstance(
+            smpacket.SMPacket.parse_binary(packet.binary),
+            smpacket.SMPacketClientNSCCM)
+        self.assertNotIsInstance(
+            smpacket.SMPacket.parse_binary(packet.binary), CustomPacket)
+
+        smpacket.SMPacket.register(CustomPacket)
+        try:
+            self.assertIsInstance(smpacket.SMPacket.parse_binary(packet.binary), CustomPacket)
+            self.assertIsInstance(smpacket.SMPacket.parse_json(packet.json), CustomPacket)
+        finally:
+            smpacket.SMPacket.register(smpacket.SMPacketClientNSCCM)
@@ -0,0 +1,166 @@
+""" Test SMState module """
+
+import os
+import shutil
+import socket
+import tempfile
+import time
+import unittest
+import mock
+
+from smserver.smutils import smpacket, smstate, smthread
+
+
+def wait_for(condition, timeout=5):
+    """ Wait for the other process (here, the other threads) to catch up """
+
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+
+    return condition()
+
+
+class StateBrokerTest(unittest.TestCase):
+    """ Test the broker sharing the state between the workers """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.broker = smstate.StateBroker(os.path.join(self.directory, "state.sock"))
+        self.broker.start()
+
+        self.servers = [mock.Mock(), mock.Mock()]
+        self.backends = [smstate.BrokerStateBackend(self.broker.path) for _ in self.servers]
+        for backend, server in zip(self.backends, self.servers):
+            backend.start(server)
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.stop()
+
+        self.broker.stop()
+        self.broker.join(5)
+        shutil.rmtree(self.directory)
+
+    def test_publish(self):
+        packet = smpacket.SMPacketServerNSCCM(message="msg")
+        self.backends[0].publish(("room", 2), packet)
+
+        self.assertTrue(wait_for(lambda: self.servers[1].deliver.called))
+        target, received = self.servers[1].deliver.call_args[0]
+        self.assertEqual(target, ("room", 2))
+        self.assertEqual(received.binary, packet.binary)
+        self.assertFalse(self.servers[0].deliver.called)
+
+    def test_membership(self):
+        self.backends[0].join(1, "token1")
+        self.backends[1].join(1, "token2")
+
+        for backend in self.backends:
+            self.assertTrue(wait_for(lambda: backend.members(1) == {"token1", "token2"}))
+
+        # A new worker get the current state
+        backend = smstate.BrokerStateBackend(self.broker.path)
+        backend.start(mock.Mock())
+        self.backends.append(backend)
+        self.assertTrue(wait_for(lambda: backend.members(1) == {"token1", "token2"}))
+
+        self.backends[1].leave(1, "token2")
+        self.assertTrue(wait_for(lambda: self.backends[0].members(1) == {"token1"}))
+
+    def test_worker_exit(self):
+        """ The connections of a dead worker leave their rooms """
+
+        self.backends[0].join(1, "token1")
+        self.assertTrue(wait_for(lambda: self.backends[1].members(1) == {"token1"}))
+
+        self.backends[0].stop()
+        self.assertTrue(wait_for(lambda: self.backends[1].members(1) == set()))
+
+
+class ServerStateTest(unittest.TestCase):
+    """ Test the use of the state backend by the server """
+
+    def test_broadcast(self):
+        state = mock.Mock()
+        server = smthread.StepmaniaServer([], state=state)
+        conn = mock.Mock(token="token", room=None)
+        server.add_connection(conn)
+        server.add_to_room("token", 3)
+
+        state.join.assert_called_with(3, "token")
+
+        packet = smpacket.SMPacketServerNSCCM(message="msg")
+        server.sendroom(3, packet)
+
+        conn.send.assert_called_with(packet, {})
+        state.publish.assert_called_with(("room", 3), packet)
+
+        server.on_disconnect(conn)
+        state.leave.assert_called_with(3, "token")
+
+    def test_remote_connection(self):
+        """ Packets for a connection of another worker go through the backend """
+
+        state = mock.Mock()
+        server = smthread.StepmaniaServer([], state=state)
+        packet = smpacket.SMPacketServerNSCCM(message="msg")
+
+        server.sendconnection("unknown", packet)
+        state.publish.assert_called_with(("token", "unknown"), packet)
+
+
+class HandoffTest(unittest.TestCase):
+    """ Test the handoff of a connection socket to another worker """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.broker = smstate.StateBroker(os.path.join(self.directory, "state.sock"))
+        self.broker.start()
+
+        self.servers = [mock.Mock(), mock.Mock()]
+        self.backends = [
+            smstate.BrokerStateBackend(self.broker.path, worker=idx, workers=2)
+            for idx in range(2)
+        ]
+        for backend, server in zip(self.backends, self.servers):
+            backend.start(server)
+
+    def tearDown(self):
+        for backend in self.backends:
+            backend.stop()
+
+        self.broker.stop()
+        self.broker.join(5)
+        shutil.rmtree(self.directory)
+
+    def test_room_owner(self):
+        self.assertEqual(self.backends[0].room_owner(3), 1)
+        self.assertEqual(self.backends[1].room_owner(4), 0)
+        self.assertIsNone(self.backends[0].room_owner(None))
+
+    def test_handoff(self):
+        client, sock = socket.socketpair()
+
+        state = {"ip": "127.0.0.1", "token": "token", "data": "x" * 100000}
+        self.assertTrue(self.backends[0].handoff(1, sock, state))
+        sock.close()
+
+        self.assertTrue(wait_for(lambda: self.servers[1].adopt.called))
+        received, received_state = self.servers[1].adopt.call_args[0]
+        self.assertEqual(received_state, state)
+
+        received.sendall(b"data")
+        self.assertEqual(client.recv(4), b"data")
+
+        received.close()
+        client.close()
+
+    def test_handoff_failure(self):
+        """ The connection is kept if the worker can't be reached """
+
+        client, sock = socket.socketpair()
+        self.assertFalse(self.backends[0].handoff(5, sock, {"ip": "127.0.0.1"}))
+
+        client.close()
+        sock.close()
@@ -1,10 +1,14 @@
 """ Test SMThread module """
 
+import asyncio
+import time
+import threading
 import unittest
 import mock
 
 from smserver.smutils import smconn
 from smserver.smutils import smthread
+from smserver.smutils import smpacket
 
 
 class BaseStepmaniaServerTest(unittest.TestCase):
@@ -26,6 +30,14 @@ class BaseStepmaniaServerTest(unittest.TestCase):
         self.conn1 = smconn.StepmaniaConn(self.server, "8.8.8.8", 42)
         self.conn2 = smconn.StepmaniaConn(self.server, "8.8.8.9", 42)
 
+    def test_can_handoff(self):
+        """ Only the classic server hand its connections to another worker """
+
+        self.assertTrue(smthread.StepmaniaServer.can_handoff("classic"))
+        self.assertFalse(smthread.StepmaniaServer.can_handoff("classic", shared_loop=True))
+        self.assertFalse(smthread.StepmaniaServer.can_handoff("async"))
+        self.assertFalse(smthread.StepmaniaServer.can_handoff("thread"))
+
     @mock.patch("threading.Thread.is_alive")
     def test_isalive(self, is_alive):
         """ test is_alive function """
@@ -96,6 +108,137 @@ class BaseStepmaniaServerTest(unittest.TestCase):
         self.server.del_from_room(self.conn1.token, 5)
         self.assertEqual(self.conn1.room, None)
 
+    def test_snapshots(self):
+        """ The snapshots don't change while the connections come and go """
+
+        self.server.add_connection(self.conn1)
+        self.server.add_to_room(self.conn1.token, 5)
+
+        connections = self.server.connections
+        room = self.server.room_connections(5)
+
+        self.server.add_connection(self.conn2)
+        self.server.add_to_room(self.conn2.token, 5)
+        self.server.del_from_room(self.conn1.token)
+        self.server.on_disconnect(self.conn1)
+
+        self.assertEqual(list(connections), [self.conn1])
+        self.assertEqual(list(room), [self.conn1])
+        self.assertEqual(list(self.server.connections), [self.conn2])
+        self.assertEqual(list(self.server.room_connections(5)), [self.conn2])
+
+    def test_room_indexes(self):
+        """ The room indexes follow the status of the connections """
+
+        self.server.add_connection(self.conn1)
+        self.server.add_connection(self.conn2)
+        self.server.add_to_room(self.conn1.token, 5)
+        self.server.add_to_room(self.conn2.token, 5)
+
+        self.assertEqual(self.server.player_connections(5), (self.conn1, self.conn2))
+        self.assertEqual(self.server.waiting_rooms(), [])
+
+        self.conn2.spectate = True
+        self.assertEqual(self.server.player_connections(5), (self.conn1,))
+        self.assertEqual(self.server.spectator_connections(5), (self.conn2,))
+
+        self.conn1.wait_start = True
+        self.assertEqual(self.server.waiting_connections(5), (self.conn1,))
+        self.assertEqual(self.server.waiting_rooms(), [5])
+
+        self.conn1.songstats = {"start_at": time.monotonic()}
+        self.assertEqual(self.server.ingame_connections(5), (self.conn1,))
+
+        self.server.del_from_room(self.conn1.token)
+        self.assertEqual(self.server.waiting_rooms(), [])
+        self.assertEqual(self.server.ingame_connections(5), ())
+        self.assertEqual(self.server.room_connections(5), (self.conn2,))
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._abort")
+    def test_reap_idle_connections(self, abort):
+        """ Only the connections without activity for idle_timeout are closed """
+
+        server = smthread.StepmaniaServer([], idle_timeout=10)
+        conn1 = smconn.StepmaniaConn(server, "8.8.8.8", 42)
+        conn2 = smconn.StepmaniaConn(server, "8.8.8.9", 42)
+        server.add_connection(conn1)
+        server.add_connection(conn2)
+
+        now = conn1.last_activity
+        conn2.last_activity = now + 5
+
+        self.assertEqual(server.reap_idle_connections(now + 5), [])
+        self.assertEqual(server.reap_idle_connections(now + 12), [conn1])
+        self.assertEqual(abort.call_count, 1)
+
+        # conn2 has been scheduled again at its last activity
+        self.assertIn(conn2, server.idle_timers)
+        self.assertEqual(server.reap_idle_connections(now + 14), [])
+        self.assertEqual(server.reap_idle_connections(now + 17), [conn2])
+        self.assertEqual(server.reaped_connections, 2)
+
+        server.on_disconnect(conn1)
+        server.on_disconnect(conn2)
+        self.assertEqual(len(server.idle_timers), 0)
+
+    def test_idle_timeout_disabled(self):
+        """ Without timeout, the idle connections are kept """
+
+        self.server.add_connection(self.conn1)
+        self.assertEqual(self.server.reap_idle_connections(self.conn1.last_activity + 3600), [])
+
+    def test_start_barrier(self):
+        """ The barrier is released once, by the last player or the timeout """
+
+        barrier = smthread.StartBarrier(["conn1", "conn2"])
+
+        self.assertFalse(barrier.arrive("conn1"))
+        self.assertFalse(barrier.arrive("conn1"))
+        self.assertFalse(barrier.arrive("conn3"))
+        self.assertTrue(barrier.expire())
+
+        self.assertFalse(barrier.arrive("conn2"))
+        self.assertFalse(barrier.expire())
+        self.assertEqual(barrier.arrived, ["conn1", "conn3"])
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._send_data")
+    def test_send_ping(self, send_data):
+        """ The ping is encoded once, and its time recorded for each connection """
+
+        self.server.add_connection(self.conn1)
+        self.server.add_connection(self.conn2)
+
+        with mock.patch.object(smpacket.SMPacketCodec, "encode", autospec=True,
+                               side_effect=smpacket.SMPacketCodec.encode) as encode:
+            self.server.send_ping()
+            self.server.send_ping()
+            self.assertEqual(encode.call_count, 1)
+
+        self.assertEqual(send_data.call_count, 4)
+
+        self.conn1._on_data(smpacket.SMPacketClientNSCPingR().binary)
+        self.assertEqual(self.conn1.latency.samples, 1)
+        self.assertEqual(self.conn2.latency.samples, 0)
+
+    def test_room_latency(self):
+        """ The latency of a room is the one of its slowest player """
+
+        self.server.add_connection(self.conn1)
+        self.server.add_connection(self.conn2)
+        self.server.add_to_room(self.conn1.token, 5)
+        self.server.add_to_room(self.conn2.token, 5)
+
+        self.assertEqual(self.server.room_latency(5), 0)
+
+        self.conn1.latency.ping_sent(10)
+        self.conn1.latency.pong_received(10.25)
+        self.conn2.latency.ping_sent(10)
+        self.conn2.latency.pong_received(10.5)
+        self.assertEqual(self.server.room_latency(5), 0.5)
+
+        self.conn2.spectate = True
+        self.assertEqual(self.server.room_latency(5), 0.25)
+
     @mock.patch("smserver.smutils.smconn.StepmaniaConn.send")
     def test_sendall(self, conn_send):
         """ test sending a packet to all conections """
@@ -105,3 +248,199 @@ class BaseStepmaniaServerTest(unittest.TestCase):
 
         self.server.sendall("aaaa")
         self.assertEqual(conn_send.call_count, 2)
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._send_data")
+    def test_sendroom_encode_once(self, send_data):
+        """ A broadcast packet is encoded once per variant """
+
+        self.server.add_connection(self.conn1)
+        self.server.add_connection(self.conn2)
+        self.server.add_to_room(self.conn1.token, 5)
+        self.server.add_to_room(self.conn2.token, 5)
+
+        packet = smpacket.SMPacketServerNSCCM(message="msg")
+        with mock.patch.object(smpacket.SMPacketCodec, "encode", autospec=True,
+                               side_effect=smpacket.SMPacketCodec.encode) as encode:
+            self.server.sendroom(5, packet)
+            self.assertEqual(encode.call_count, 1)
+
+        self.assertEqual(send_data.call_count, 2)
+        self.assertEqual(send_data.call_args_list[0], send_data.call_args_list[1])
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._send_data")
+    def test_sendroom_variants(self, send_data):
+        """ Chat timestamp and NSCRSG hash depend on the connection """
+
+        self.server.add_connection(self.conn1)
+        self.server.add_connection(self.conn2)
+        self.server.add_to_room(self.conn1.token, 5)
+        self.server.add_to_room(self.conn2.token, 5)
+
+        self.conn1.chat_timestamp = True
+        self.conn1.stepmania_version = 3
+        self.conn2.stepmania_version = 4
+
+        packet = smpacket.SMPacketServerNSCCM(message="msg")
+        self.server.sendroom(5, packet)
+        sent = dict(zip(
+            self.server.room_connections(5),
+            [call[0][0] for call in send_data.call_args_list]))
+
+        self.assertTrue(sent[self.conn1].endswith(b"] msg\x00"))
+        self.assertEqual(sent[self.conn2], packet.binary)
+        self.assertEqual(packet["message"], "msg")
+
+        send_data.reset_mock()
+        packet = smpacket.SMPacketServerNSCRSG(
+            usage=1, song_title="title", song_artist="artist",
+            song_subtitle="subtitle", song_hash="hash")
+        self.server.sendroom(5, packet)
+
+        datas = [call[0][0] for call in send_data.call_args_list]
+        self.assertIn(packet.binary, datas)
+        self.assertIn(smpacket.SMPacketServerNSCRSG(
+            usage=1, song_title="title", song_artist="artist",
+            song_subtitle="subtitle").binary, datas)
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._write")
+    def test_send_coalesce(self, write):
+        """ Packets queued before a flush are written at once """
+
+        self.conn1._schedule_flush = mock.Mock()
+
+        self.conn1.send(smpacket.SMPacketServerNSCPing())
+        self.conn1.send(smpacket.SMPacketServerNSCCM(message="msg"))
+        self.assertEqual(self.conn1._schedule_flush.call_count, 1)
+        self.assertFalse(write.called)
+
+        self.conn1.flush()
+        write.assert_called_once_with([
+            (b"\x00\x00\x00\x01", b"\x80"),
+            (b"\x00\x00\x00\x05", b"\x87msg\x00"),
+        ])
+
+        self.conn1.send(smpacket.SMPacketServerNSCPing())
+        self.assertEqual(self.conn1._schedule_flush.call_count, 2)
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._write")
+    def test_send_throttle(self, write):
+        """ Only the latest scoreboard is kept for a slow client """
+
+        self.server.send_buffer = {"high_water": 100, "low_water": 10, "max_size": 1000}
+        self.conn1._buffered_size = mock.Mock(return_value=200)
+
+        self.conn1.send(smpacket.SMPacketServerNSCPing())
+        self.assertEqual(write.call_count, 1)
+
+        write.reset_mock()
+        for score in range(5):
+            self.conn1.send(smpacket.SMPacketServerNSCGSU(
+                section=0, nb_players=1, options=[score]))
+            self.conn1.send(smpacket.SMPacketServerNSCGSU(
+                section=1, nb_players=1, options=[score]))
+            self.conn1.send(smpacket.SMPacketServerNSCCM(message=str(score)))
+
+        # Nothing is written until the client reads its data
+        self.assertTrue(all(call == mock.call([]) for call in write.call_args_list))
+
+        self.conn1._buffered_size.return_value = 0
+        self.conn1.flush()
+
+        sent = [smpacket.SMPacket.parse_binary(b"".join(data))
+                for data in write.call_args[0][0]]
+        self.assertEqual(
+            [(packet.command, packet.get("section"), packet.get("message"), packet.get("options"))
+             for packet in sent],
+            [(smpacket.SMServerCommand.NSCCM, None, str(score), None) for score in range(4)] +
+            [(smpacket.SMServerCommand.NSCGSU, 0, None, [4]),
+             (smpacket.SMServerCommand.NSCGSU, 1, None, [4]),
+             (smpacket.SMServerCommand.NSCCM, None, "4", None)])
+
+    @mock.patch("smserver.smutils.smconn.StepmaniaConn._write")
+    def test_send_overflow(self, write):
+        """ A client which doesn't read its data is disconnected """
+
+        self.server.send_buffer = {"high_water": 100, "low_water": 10, "max_size": 1000}
+        self.conn1._buffered_size = mock.Mock(return_value=990)
+        self.conn1._abort = mock.Mock()
+
+        self.conn1.send(smpacket.SMPacketServerNSCPing())
+        self.assertFalse(self.conn1._abort.called)
+
+        self.conn1.send(smpacket.SMPacketServerNSCCM(message="message"))
+        self.conn1.send(smpacket.SMPacketServerNSCCM(message="message"))
+        self.assertEqual(self.conn1._abort.call_count, 1)
+
+    def test_receive_flood(self):
+        """ A client sending faster than its packets are handled is disconnected """
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def on_packet(conn, packet):
+            started.set()
+            release.wait(5)
+
+        server = smthread.StepmaniaServer([], handler_threads=1, max_pending_packets=2)
+        server.on_packet = on_packet
+        conn = smconn.StepmaniaConn(server, "8.8.8.8", 42)
+        conn._abort = mock.Mock()
+
+        data = smpacket.SMPacketClientNSCPing().binary
+        conn._on_data(data)
+        self.assertTrue(started.wait(5))
+
+        conn._on_data(data)
+        conn._on_data(data)
+        self.assertFalse(conn._abort.called)
+        self.assertEqual(server.executor.pending(conn), 2)
+
+        conn._on_data(data)
+        conn._on_data(data)
+        self.assertEqual(conn._abort.call_count, 1)
+        self.assertEqual(server.executor.pending(conn), 2)
+
+        release.set()
+        server.executor.shutdown()
+
+
+class SharedLoopServerTest(unittest.TestCase):
+    """ Test running all the listeners on one event loop """
+
+    def test_listeners(self):
+        server = smthread.StepmaniaServer([
+            ("127.0.0.1", 0, "async"),
+            ("127.0.0.1", 0, "classic"),
+            ("127.0.0.1", 0, "udp"),
+        ], shared_loop=True)
+
+        self.assertEqual(len(server._servers), 1)
+        thread = server._servers[0]
+        self.assertIsInstance(thread, smconn.SMLoopThread)
+        self.assertEqual(
+            [type(listener).__name__ for listener in thread.listeners],
+            ["AsyncSocketServer", "AsyncSocketServer", "AsyncUDPServer"])
+
+        for listener in thread.listeners:
+            self.assertIs(listener.loop, server.loop)
+
+        thread.start()
+        thread.stop()
+        thread.join(5)
+        self.assertFalse(server.is_alive())
+
+    def test_call_soon(self):
+        """ Callbacks are run on the loop thread """
+
+        loop = asyncio.new_event_loop()
+        threads = []
+
+        def callback():
+            threads.append(threading.get_ident())
+            smconn.call_soon(loop, loop.stop)
+
+        smconn.call_soon(loop, callback)
+        loop.run_forever()
+        loop.close()
+
+        self.assertEqual(threads, [threading.get_ident()])
@@ -0,0 +1,159 @@
+""" Test SMTimer module """
+
+import unittest
+
+from smserver.smutils import smtimer
+
+
+class TimerWheelTest(unittest.TestCase):
+    """ Test the timer wheel used to find the idle connections """
+
+    def setUp(self):
+        self.wheel = smtimer.TimerWheel(resolution=1, size=10, now=100)
+
+    def test_expire(self):
+        """ The items are expired once their slot has elapsed """
+
+        self.wheel.add("conn1", 101.5)
+        self.wheel.add("conn2", 103)
+        self.wheel.add("conn3", 103.2)
+
+        self.assertEqual(self.wheel.expire(101.9), [])
+        self.assertEqual(self.wheel.expire(102), ["conn1"])
+        self.assertEqual(sorted(self.wheel.expire(104)), ["conn2", "conn3"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_reschedule(self):
+        """ Adding an item again replace its deadline """
+
+        self.wheel.add("conn1", 101)
+        self.wheel.add("conn1", 105)
+
+        self.assertEqual(self.wheel.expire(103), [])
+        self.assertEqual(self.wheel.expire(106), ["conn1"])
+
+    def test_remove(self):
+        """ The removed items are never expired """
+
+        self.wheel.add("conn1", 101)
+        self.wheel.remove("conn1")
+        self.wheel.remove("conn2")
+
+        self.assertNotIn("conn1", self.wheel)
+        self.assertEqual(self.wheel.expire(110), [])
+
+    def test_elapsed_deadline(self):
+        """ A deadline already elapsed is expired on the next call """
+
+        self.wheel.expire(105)
+        self.wheel.add("conn1", 102)
+
+        self.assertEqual(self.wheel.expire(105.5), [])
+        self.assertEqual(self.wheel.expire(106), ["conn1"])
+
+    def test_next_turns(self):
+        """ The deadlines after a turn of the wheel wait for their turn """
+
+        self.wheel.add("conn1", 115)
+
+        self.assertEqual(self.wheel.expire(110), [])
+        self.assertEqual(self.wheel.expire(116), ["conn1"])
+
+    def test_long_pause(self):
+        """ After a pause longer than a turn, all the late items are expired """
+
+        self.wheel.add("conn1", 101)
+        self.wheel.add("conn2", 108)
+        self.wheel.add("conn3", 150)
+
+        self.assertEqual(sorted(self.wheel.expire(140)), ["conn1", "conn2"])
+        self.assertEqual(self.wheel.expire(151), ["conn3"])
+
+
+class FakeClock(object):
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SchedulerTest(unittest.TestCase):
+    """ Test the scheduler of the periodic tasks """
+
+    def setUp(self):
+        self.clock = FakeClock(100)
+        self.scheduler = smtimer.Scheduler(clock=self.clock)
+        self.runs = []
+
+    def add(self, name, period, duration=0):
+        def func():
+            self.runs.append(name)
+            self.clock.now += duration
+
+        return self.scheduler.add(func, period, name=name)
+
+    def test_due_tasks(self):
+        """ Only the tasks due are run, at their own period """
+
+        self.add("fast", 0.5)
+        self.add("slow", 2)
+
+        self.assertEqual(self.scheduler.run_due(), 100.5)
+        self.assertEqual(sorted(self.runs), ["fast", "slow"])
+
+        self.runs = []
+        self.clock.now = 100.4
+        self.assertEqual(self.scheduler.run_due(), 100.5)
+        self.assertEqual(self.runs, [])
+
+        self.clock.now = 102
+        self.scheduler.run_due()
+        self.assertEqual(self.runs, ["fast", "slow"])
+
+    def test_drift(self):
+        """ A late run doesn't delay the next ones """
+
+        task = self.add("task", 1)
+        self.scheduler.run_due()
+
+        self.clock.now = 101.25
+        self.assertEqual(self.scheduler.run_due(), 102)
+        self.assertEqual(task.drift, 0.25)
+        self.assertEqual(task.stats()["max_drift"], 0.25)
+
+    def test_overrun(self):
+        """ The periods elapsed while the task runs are skipped """
+
+        task = self.add("task", 1, duration=2.5)
+
+        self.assertEqual(self.scheduler.run_due(), 103)
+        self.assertEqual(self.runs, ["task"])
+
+        stats = task.stats()
+        self.assertEqual(stats["overruns"], 1)
+        self.assertEqual(stats["skipped"], 2)
+        self.assertEqual(stats["max_duration"], 2.5)
+
+    def test_call_later(self):
+        """ A task added with call_later is run only once """
+
+        self.scheduler.call_later(1, self.runs.append, "once")
+        cancelled = self.scheduler.call_later(1, self.runs.append, "cancelled")
+        cancelled.cancel()
+
+        self.assertEqual(self.scheduler.run_due(), 101)
+        self.clock.now = 101
+        self.assertIsNone(self.scheduler.run_due())
+        self.assertEqual(self.runs, ["once"])
+
+    def test_error(self):
+        """ A task raising an error is still run at its next deadline """
+
+        def fail():
+            raise ValueError("fail")
+
+        task = self.scheduler.add(fail, 1)
+
+        self.assertEqual(self.scheduler.run_due(), 101)
+        self.assertEqual(task.runs, 1)